@@ -0,0 +1,334 @@
+import argparse
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import socket
+import sys
+import threading
+import time
+import typing
+
+import api
+import logs
+import tracing
+
+# ========================================================================
+# ================================ Profiling =============================
+# ========================================================================
+
+# region Profiling
+
+PROFILE_MODES: typing.Final[tuple[str, ...]] = ('sample', 'cprofile')
+# Seconds between two samples of the stacks of every thread, and the shortest interval that can be asked for
+SAMPLE_INTERVAL = 0.005
+MIN_SAMPLE_INTERVAL = 0.001
+# The longest profile that can be asked for, in seconds
+MAX_PROFILE_DURATION = 600
+
+log = logs.get_logger('admin')
+
+
+def frame_name(frame: typing.Any) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    '''
+    Profiles the live process for a set duration, then writes the results to `path`.
+    - 'sample': a background thread samples the stacks of every thread every `interval` seconds,
+      the stacks are written in the collapsed format (one 'outer;...;inner count' line per stack) ready for flamegraphs.
+      Blocked threads are sampled too, so it shows where the wall-clock time goes, not only the CPU time.
+    - 'cprofile': every request handled while profiling runs under cProfile in its handler thread (see profiled),
+      the merged statistics are written in the pstats format.
+    '''
+
+    def __init__(self, mode: str, duration: float, path: str, interval: float = SAMPLE_INTERVAL) -> None:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}' (must be one of {PROFILE_MODES})")
+        if not 0 < duration <= MAX_PROFILE_DURATION:
+            raise ValueError(f"Profile duration must be between 0 and {MAX_PROFILE_DURATION} seconds, got {duration}")
+        if not MIN_SAMPLE_INTERVAL <= interval <= duration:
+            raise ValueError(f"Sample interval must be between {MIN_SAMPLE_INTERVAL} seconds and the duration, got {interval}")
+        self.mode = mode
+        self.duration = duration
+        self.path = path
+        self.interval = interval
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self.profiles: list[cProfile.Profile] = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.started = time.time()
+
+    def start(self) -> None:
+        target = self.sample if self.mode == 'sample' else self.stopped.wait
+        threading.Thread(target=self.run, args=(target,), daemon=True).start()
+
+    def run(self, target: typing.Callable[..., typing.Any]) -> None:
+        timer = threading.Timer(self.duration, self.stopped.set)
+        timer.daemon = True
+        timer.start()
+        target()
+        timer.cancel()
+        self.write()
+
+    def sample(self) -> None:
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    @contextlib.contextmanager
+    def request(self) -> typing.Iterator[None]:
+        '''
+        Runs the request under the handler thread's cProfile profile
+        '''
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:  # another profiler is active in this thread
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def write(self) -> None:
+        global profiler
+        try:
+            if self.mode == 'sample':
+                with open(self.path, 'w', encoding='utf-8') as output:
+                    for stack, count in self.stacks.most_common():
+                        output.write(f"{stack} {count}\n")
+            else:
+                with self.lock:
+                    profiles = list(self.profiles)
+                if profiles:
+                    pstats.Stats(*profiles).dump_stats(self.path)
+            log.info("Profile written", mode=self.mode, path=self.path, seconds=f"{time.time() - self.started:.1f}")
+        except Exception as e:
+            log.error("Could not write the profile", path=self.path, error=e)
+        finally:
+            with profiler_lock:
+                if profiler is self:
+                    profiler = None
+
+
+# The profile being taken, if any, only replaced holding the lock so two admin commands can't both start one
+profiler: typing.Optional[Profiler] = None
+profiler_lock = threading.Lock()
+NOT_PROFILED = contextlib.nullcontext()
+
+
+def profiled() -> typing.ContextManager[None]:
+    '''
+    Function which returns the context to handle a request in, it's profiled while a cProfile profile is being taken
+    '''
+    current = profiler
+    if current is None or current.mode != 'cprofile' or current.stopped.is_set():
+        return NOT_PROFILED
+    return current.request()
+
+# endregion
+
+# ========================================================================
+# ================================ Slow Log ==============================
+# ========================================================================
+
+# region Slow Log
+
+
+class SlowLog:
+    '''
+    Writes the requests that took at least `threshold` seconds to `path` (JSON lines),
+    with their full expression and the time spent in each step (the spans of the request, see tracing)
+    '''
+
+    def __init__(self, threshold: float, path: str) -> None:
+        if threshold <= 0:
+            raise ValueError(f"Slow log threshold must be positive, got {threshold}")
+        self.threshold = threshold
+        self.path = path
+        self.writer = logs.Writer(open(path, 'a', encoding='utf-8'), 'json')
+
+    def __call__(self, root: tracing.Span, spans: list[tracing.Span]) -> None:
+        if root.duration < self.threshold:
+            return
+        fields: dict[str, typing.Any] = {'ms': round(root.duration * 1000, 3), **root.fields}
+        if root.trace_id and root.traced:
+            fields['trace'] = f"{root.trace_id:016x}"
+        if root.header is not None:
+            fields['expression'] = describe(root.header)
+            fields['show_steps'] = root.header.show_steps
+        # Time per step, in the order the steps started
+        fields['steps'] = [{'step': span.name, 'offset_ms': round((span.start - root.start) * 1000, 3),
+                            'ms': round(span.duration * 1000, 3), **span.fields}
+                           for span in sorted(spans, key=lambda span: span.start)]
+        self.writer.append((root.start, 'warning', tracing.component, 'Slow request', fields))
+
+    def close(self) -> None:
+        self.writer.flush()
+        self.writer.stream.close()
+
+
+def describe(request: api.CalculatorHeader) -> str:
+    '''
+    Function which returns the expression of a request as text, or a description of the data if it isn't an expression
+    '''
+    if request.method == api.CalculatorHeader.METHOD_ADMIN:
+        return f"admin {request.data.decode('utf-8', 'replace')}"
+    try:
+        return api.stringify(api.data_to_expression(request.split_conditional()[0]))
+    except Exception:
+        return f"<{len(request.data)} bytes of data that isn't an expression>"
+
+
+# The slow log being written, if any
+slow_log: typing.Optional[SlowLog] = None
+
+
+def set_slow_log(threshold: float, path: typing.Optional[str]) -> None:
+    '''
+    Function which starts writing the slow log to the path (a threshold of 0 stops it)
+    '''
+    global slow_log
+    if slow_log is not None:
+        tracing.on_request = None
+        slow_log.close()
+        slow_log = None
+    if threshold > 0:
+        slow_log = SlowLog(threshold, path or default_path('slow', 'jsonl'))
+        tracing.on_request = slow_log
+
+# endregion
+
+# ========================================================================
+# ============================= Admin Requests ===========================
+# ========================================================================
+
+# region Admin Requests
+
+# Whether admin requests are accepted (they are rejected unless the process was started with --admin)
+ENABLED = False
+COMMANDS: typing.Final[tuple[str, ...]] = ('profile', 'stop_profile', 'slow_log', 'status')
+
+
+def default_path(kind: str, extension: str) -> str:
+    return f"{tracing.component or 'process'}-{os.getpid()}-{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}"
+
+
+def status() -> dict[str, typing.Any]:
+    return {
+        'profile': None if profiler is None else {'mode': profiler.mode, 'path': profiler.path,
+                                                  'remaining': max(0.0, profiler.started + profiler.duration - time.time())},
+        'slow_log': None if slow_log is None else {'threshold': slow_log.threshold, 'path': slow_log.path},
+    }
+
+
+def execute(command: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    '''
+    Function which runs an admin command and returns its result
+    - {'command': 'profile', 'mode': 'sample' | 'cprofile', 'duration': seconds, 'interval': seconds between samples}
+    - {'command': 'stop_profile'} writes the profile being taken right away
+    - {'command': 'slow_log', 'threshold': seconds (0 = stop)}
+    - {'command': 'status'}
+    The files are always written to the default paths in the working directory (see default_path, the result has them),
+    the commands come from the network so they never choose which file the process writes.
+    '''
+    global profiler
+    name = command.get('command')
+    if name == 'profile':
+        mode = command.get('mode', 'sample')
+        extension = 'collapsed' if mode == 'sample' else 'pstats'
+        new_profiler = Profiler(mode, float(command.get('duration', 10)), default_path('profile', extension),
+                                float(command.get('interval', SAMPLE_INTERVAL)))
+        with profiler_lock:
+            if profiler is not None:
+                raise ValueError(f"A profile is already being taken (until {profiler.duration} seconds after it started)")
+            profiler = new_profiler
+        new_profiler.start()
+        log.info("Profiling", mode=new_profiler.mode, seconds=new_profiler.duration, path=new_profiler.path)
+    elif name == 'stop_profile':
+        if profiler is None:
+            raise ValueError("No profile is being taken")
+        profiler.stop()
+    elif name == 'slow_log':
+        set_slow_log(float(command.get('threshold', 0)), None)
+        log.info("Slow log", threshold=command.get('threshold', 0), path=slow_log.path if slow_log else None)
+    elif name != 'status':
+        raise ValueError(f"Unknown admin command {name!r} (must be one of {COMMANDS})")
+    return status()
+
+
+def handle(request: api.CalculatorHeader) -> api.CalculatorHeader:
+    '''
+    Function which answers an admin request (its data is a JSON command, see execute) with the JSON result,
+    or with a client error if the command failed or admin requests aren't enabled
+    '''
+    try:
+        if not ENABLED:
+            raise PermissionError("Admin requests are disabled (start the process with --admin)")
+        command = json.loads(request.data.decode('utf-8'))
+        if not isinstance(command, dict):
+            raise ValueError("An admin command must be a JSON object")
+        result = execute(command)
+    except Exception as e:
+        return api.CalculatorHeader.from_error(e, api.CalculatorHeader.STATUS_CLIENT_ERROR, False, 0)
+    return api.CalculatorHeader.from_response(json.dumps(result).encode('utf-8'), api.CalculatorHeader.STATUS_OK,
+                                              False, False, 0)
+
+
+def send(address: tuple[str, int], command: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    '''
+    Function which sends an admin command to a proxy or server and returns its result
+    '''
+    request = api.CalculatorHeader.from_request(json.dumps(command).encode('utf-8'), False, False, 0,
+                                                method=api.CalculatorHeader.METHOD_ADMIN)
+    with socket.create_connection(address) as admin_socket:
+        admin_socket.sendall(request.pack())
+        response = api.CalculatorHeader.unpack(admin_socket.recv(api.BUFFER_SIZE))
+    if response.status_code != api.CalculatorHeader.STATUS_OK:
+        raise api.CalculatorClientError(api.data_to_error(response))
+    return json.loads(response.data.decode('utf-8'))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Send an admin command to a running proxy or server (started with --admin).')
+
+    arg_parser.add_argument('-p', '--port', type=int, default=api.DEFAULT_PROXY_PORT, help='The port to connect to.')
+    arg_parser.add_argument('-H', '--host', type=str, default=api.DEFAULT_PROXY_HOST, help='The host to connect to.')
+    arg_parser.add_argument('command', choices=COMMANDS, help='The command to send.')
+    arg_parser.add_argument('-m', '--mode', type=str, choices=PROFILE_MODES, default='sample',
+                            help='profile: sample the stacks of every thread, or run the requests under cProfile.')
+    arg_parser.add_argument('-d', '--duration', type=float, default=10, help='profile: how many seconds to profile for.')
+    arg_parser.add_argument('-t', '--threshold', type=float, default=0,
+                            help='slow_log: log the requests that took at least this many seconds (0 = stop).')
+
+    args = arg_parser.parse_args()
+
+    command = {'command': args.command}
+    if args.command == 'profile':
+        command.update(mode=args.mode, duration=args.duration)
+    elif args.command == 'slow_log':
+        command.update(threshold=args.threshold)
+    print(json.dumps(send((args.host, args.port), command), indent=2))
+
+# endregion
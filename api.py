@@ -5,6 +5,10 @@ import numbers
 import struct
 import warnings
 import time
+import math
+import zlib
+import hashlib
+import socket
 
 # Predefined variables
 BUFFER_SIZE = 65536 # The buffer size is the maximum amount of data that can be received at once
@@ -12,6 +16,9 @@ DEFAULT_SERVER_HOST = "127.0.0.1" # The default host for the server
 DEFAULT_SERVER_PORT = 9999 # The default port for the server
 DEFAULT_PROXY_HOST = "127.0.0.1" # The default host for the proxy
 DEFAULT_PROXY_PORT = 9998 # The default port for the proxy
+COMPRESSION_THRESHOLD = 128 # Responses with at least this many bytes of data are compressed (if the receiver accepts it)
+COMPRESSION_LEVEL = 6 # The zlib compression level used for compressed responses
+PICKLE_PROTO = pickle.PROTO # The first byte of a pickled expression, text expressions never start with it
 
 
 
@@ -23,7 +30,7 @@ DEFAULT_PROXY_PORT = 9998 # The default port for the proxy
 
 
 '''
-protocol "Unix Time Stamp:32,Total Length:16,Res.:3,Cache:1,Steps:1,Type:1,Status Code:10,Cache Control:16,Padding:16,Data:<=65440"
+protocol "Unix Time Stamp:32,Total Length:16,Res.:3,Cache:1,Steps:1,Type:1,Status Code:10,Cache Control:16,Trace Tag:16,Data:<=65440"
 protocol:
 * Unix Time Stamp (32 bits = 4 bytes):
     The time that the packet was sent, in seconds since 1970-01-01 00:00:00 UTC
@@ -31,7 +38,22 @@ protocol:
     The total length of the packet, in bytes (including the header and the data)
     This minimum value is 12 bytes (header only)
 * Reserved (3 bits):
-    Reserved for future use (must be 0)
+    Reserved for protocol extensions, unknown bits must be 0
+    - Compressed (lowest reserved bit):
+        - For requests, whether the client accepts a compressed response (1 = accepts, 0 = doesn't accept)
+        - For responses, whether the data is compressed with zlib (1 = compressed, 0 = not compressed)
+        Old clients always send 0, so they always get uncompressed responses.
+        Data shorter than COMPRESSION_THRESHOLD bytes is never compressed.
+    - Conditional (middle reserved bit):
+        - For requests, the data is followed by a VALIDATOR_LENGTH bytes validator (a digest of a cached response).
+          The server answers with a header-only 304 (Not Modified) response if the response it would send has the same validator.
+          The pickled expression comes first, so an old server that ignores this bit still unpickles the expression.
+        - For responses, must be 0
+    - Traced (highest reserved bit):
+        - For requests, the data ends with a TRACE_CONTEXT_LENGTH bytes trace context (after the validator of a conditional request):
+          the 64-bit trace ID and the 64-bit ID of the sender's span, so the receiver records its spans as children of it.
+        - For responses, must be 0
+        It's only sent to peers that echoed the Trace Tag of an earlier traced request (see tracing), old peers never echo it.
 * Flags (3 bits):
     - Cache (1 bit):
         Whether to cache the packet or not (1 = cache/cached, 0 = don't cache/didn't cache)
@@ -41,7 +63,16 @@ protocol:
         Whether the packet is a request (1 = request, 0 = response)
 * Status Code (10 bits):
     The status code of the response (only valid if the packet is a response)
-    2xx = success, 4xx = client error, 5xx = server error, 0 = not a response
+    2xx = success, 304 = not modified, 4xx = client error, 5xx = server error, 0 = not a response
+    A 304 response has no data, its Cache Control is the new max-age of the cached response that was revalidated
+    A 503 response has no data and means the server or proxy is overloaded and didn't handle the request, try again later
+    A 504 response means a proxy was asked to answer only from its cache, and the response wasn't cached (or was stale)
+    For requests, this field holds the request method:
+    - 0 = evaluate the expression in the data (what clients send)
+    - 1 = peer, a request forwarded by a sibling proxy, which must be processed without consulting other siblings
+    - 2 = only if cached, a sibling proxy asks for a fresh cached response without contacting the server
+    - 3 = digest, a sibling proxy asks for a Bloom filter of the cached keys (the response data, see peers.CacheDigest)
+    - 4 = admin, the data is a JSON command for the receiving process itself, never forwarded (e.g. start profiling, see admin)
 * Cache Control (16 bits = 2 bytes):
     'Max-Age' value for the cache.
     If the 'Cache' flag is not set, this value is ignored.
@@ -51,10 +82,14 @@ protocol:
         * If max-age is 0, the server must recompute the response regardless of whether it is cached or not
     - For responses, this is the maximum time that the response can be cached for (in seconds)
         * If max-age is 0, the response must not be cached
-* Padding (16 bits):
-    Padding for future use (must be 0)
+* Trace Tag (16 bits):
+    The low 16 bits of the trace ID of a traced request (0 = not traced), used to be padding (always 0)
+    Responses echo the trace tag of the request, which tells the sender that the receiver supports the Traced bit
 * Data (at most 65440 bits = 8180 bytes):
     The data of the packet
+    - For requests, the expression: pickled (what client.py sends), or an infix text in UTF-8, e.g. b'3 + (4*2)/(1-5)**2**3'
+      (see calculator.Parser), so other tools can send requests without building pickles. Pickles start with the
+      PICKLE_PROTO byte (protocol 2 and later), which no UTF-8 text starts with, so the two are told apart by the first byte.
     It's at most 65440 bits because the total length is 16 bits, and the minimum value is 12 bytes (header only)
     2^16 - 12*8 = 65440
     
@@ -66,7 +101,7 @@ protocol:
 +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 |          Total Length         | Res.|C|S|T|    Status Code    |
 +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
-|         Cache Control         |            Padding            |
+|         Cache Control         |           Trace Tag           |
 +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 |                                                               |
 +                                                               +
@@ -80,11 +115,11 @@ Unix Time Stamp: 32 bits = 4 bytes -> L
 Total Length: 16 bits = 2 bytes -> H
 Reserved + Flags + Status Code: 3 bits + 3 bits + 10 bits = 2 byte -> H
 Cache Control: 16 bits = 2 bytes -> H
-Padding: 16 bits = 2 bytes -> 2x
+Trace Tag: 16 bits = 2 bytes -> H
 '''
 
 class CalculatorHeader:
-    HEADER_FORMAT: typing.Final[str] = '!LHHHxx'
+    HEADER_FORMAT: typing.Final[str] = '!LHHHH'
     HEADER_MIN_LENGTH: typing.Final[int] = struct.calcsize(HEADER_FORMAT)
     # Big enough to hold the header and a lot of data
     HEADER_MAX_LENGTH: typing.Final[int] = 2**16
@@ -95,11 +130,34 @@ class CalculatorHeader:
     MAX_CACHE_CONTROL: typing.Final[int] = 2**16 - 1
     
     STATUS_OK: typing.Final[int] = 200
+    STATUS_NOT_MODIFIED: typing.Final[int] = 304
     STATUS_CLIENT_ERROR: typing.Final[int] = 400
     STATUS_SERVER_ERROR: typing.Final[int] = 500
+    STATUS_OVERLOADED: typing.Final[int] = 503
+    STATUS_NOT_CACHED: typing.Final[int] = 504
     STATUS_UNKNOWN: typing.Final[int] = 999
 
-    def __init__(self, unix_time_stamp: int, total_length: typing.Optional[int], reserved: int, cache_result: bool, show_steps: bool, is_request: bool, status_code: int, cache_control: int, data: bytes = b'') -> None:
+    # Request methods, carried in the status code field of requests (see the protocol description above)
+    METHOD_EVALUATE: typing.Final[int] = 0
+    METHOD_PEER: typing.Final[int] = 1
+    METHOD_ONLY_IF_CACHED: typing.Final[int] = 2
+    METHOD_DIGEST: typing.Final[int] = 3
+    METHOD_ADMIN: typing.Final[int] = 4
+    METHODS: typing.Final[tuple[int, ...]] = (METHOD_EVALUATE, METHOD_PEER, METHOD_ONLY_IF_CACHED, METHOD_DIGEST, METHOD_ADMIN)
+
+    # Reserved bits (see the protocol description above)
+    RESERVED_COMPRESSED: typing.Final[int] = 0b001
+    RESERVED_CONDITIONAL: typing.Final[int] = 0b010
+    RESERVED_TRACED: typing.Final[int] = 0b100
+    RESERVED_KNOWN: typing.Final[int] = RESERVED_COMPRESSED | RESERVED_CONDITIONAL | RESERVED_TRACED
+
+    # Length of the validator of a conditional request (see response_validator)
+    VALIDATOR_LENGTH: typing.Final[int] = 16
+    # Length of the trace context of a traced request (the trace ID and the parent span ID)
+    TRACE_CONTEXT_LENGTH: typing.Final[int] = 16
+    MAX_TRACE_TAG: typing.Final[int] = 2**16 - 1
+
+    def __init__(self, unix_time_stamp: int, total_length: typing.Optional[int], reserved: int, cache_result: bool, show_steps: bool, is_request: bool, status_code: int, cache_control: int, data: bytes = b'', trace_tag: int = 0) -> None:
         self.unix_time_stamp = unix_time_stamp
         self.total_length = total_length
         if self.total_length is None:
@@ -111,15 +169,15 @@ class CalculatorHeader:
             warnings.warn(
                 f'The total length ({self.total_length}) does not match the length of the data ({len(data)})')
         self.reserved = reserved
-        if self.reserved != 0:
-            warnings.warn(f'The reserved bits ({self.reserved}) are not 0')
+        if self.reserved & ~self.RESERVED_KNOWN:
+            warnings.warn(f'The unknown reserved bits ({self.reserved}) are not 0')
         self.cache_result = cache_result
         self.show_steps = show_steps
         self.is_request = is_request
         self.status_code = status_code
-        if self.is_request and self.status_code != 0:
+        if self.is_request and self.status_code not in self.METHODS:
             warnings.warn(
-                f'The status code ({self.status_code}) is not 0 for a request')
+                f'The status code ({self.status_code}) is not a known method for a request')
         self.cache_control = cache_control
         if self.cache_control != 0 and not self.cache_result:
             warnings.warn(
@@ -134,12 +192,115 @@ class CalculatorHeader:
         if len(self.data) > self.HEADER_MAX_DATA_LENGTH:
             raise ValueError(
                 f'Invalid data length: {len(self.data)} (must be at most {self.HEADER_MAX_DATA_LENGTH} bytes)')
+        self.trace_tag = trace_tag
+        if not (0 <= self.trace_tag <= self.MAX_TRACE_TAG):
+            raise ValueError(
+                f'Invalid trace tag: {self.trace_tag} (must be between 0 and {self.MAX_TRACE_TAG} inclusive)')
 
     def __repr__(self) -> str:
-        return f'{self.__class__.__name__}(unix_time_stamp={self.unix_time_stamp}, total_length={self.total_length}, reserved={self.reserved}, cache_result={self.cache_result}, show_steps={self.show_steps}, is_request={self.is_request}, status_code={self.status_code}, cache_control={self.cache_control}, data={self.data})'
+        return f'{self.__class__.__name__}(unix_time_stamp={self.unix_time_stamp}, total_length={self.total_length}, reserved={self.reserved}, cache_result={self.cache_result}, show_steps={self.show_steps}, is_request={self.is_request}, status_code={self.status_code}, cache_control={self.cache_control}, data={self.data}, trace_tag={self.trace_tag})'
 
     def __str__(self) -> str:
-        return f'{self.__class__.__name__}({self.unix_time_stamp}, {self.total_length}, {self.reserved}, {self.cache_result}, {self.show_steps}, {self.is_request}, {self.status_code}, {self.cache_control}, {self.data})'
+        return f'{self.__class__.__name__}({self.unix_time_stamp}, {self.total_length}, {self.reserved}, {self.cache_result}, {self.show_steps}, {self.is_request}, {self.status_code}, {self.cache_control}, {self.data}, {self.trace_tag})'
+
+    @property
+    def compressed(self) -> bool:
+        '''
+        For requests, whether the sender accepts a compressed response.
+        For responses, whether the data is compressed.
+        '''
+        return bool(self.reserved & self.RESERVED_COMPRESSED)
+
+    @property
+    def method(self) -> int:
+        '''
+        The method of a request (one of METHODS), kept in the status code field
+        '''
+        return self.status_code
+
+    @property
+    def conditional(self) -> bool:
+        '''
+        Whether the request carries a validator of a cached response after its data.
+        '''
+        return bool(self.reserved & self.RESERVED_CONDITIONAL)
+
+    def make_conditional(self, validator: bytes) -> 'CalculatorHeader':
+        '''
+        Returns a conditional copy of the request, the server will only send a full response if its validator differs.
+        '''
+        if len(validator) != self.VALIDATOR_LENGTH:
+            raise ValueError(
+                f'Invalid validator length: {len(validator)} (must be {self.VALIDATOR_LENGTH} bytes)')
+        return self.copy(reserved=self.reserved | self.RESERVED_CONDITIONAL, data=self.data + validator)
+
+    def split_conditional(self) -> typing.Tuple['CalculatorHeader', typing.Optional[bytes]]:
+        '''
+        Returns the request without its validator and the validator (None if the request isn't conditional).
+        '''
+        if not (self.is_request and self.conditional):
+            return self, None
+        if len(self.data) < self.VALIDATOR_LENGTH:
+            raise ValueError(
+                f'The data is too short ({len(self.data)} bytes) to hold a validator')
+        return self.copy(reserved=self.reserved & ~self.RESERVED_CONDITIONAL, data=self.data[:-self.VALIDATOR_LENGTH]), self.data[-self.VALIDATOR_LENGTH:]
+
+    @property
+    def traced(self) -> bool:
+        '''
+        Whether the request carries a trace context after its data (and after its validator).
+        '''
+        return bool(self.reserved & self.RESERVED_TRACED)
+
+    def make_traced(self, trace_id: int, span_id: int) -> 'CalculatorHeader':
+        '''
+        Returns a traced copy of the request, the receiver records its spans in the trace as children of the span.
+        '''
+        context = trace_id.to_bytes(8, 'big') + span_id.to_bytes(8, 'big')
+        return self.copy(reserved=self.reserved | self.RESERVED_TRACED, data=self.data + context,
+                         trace_tag=trace_id & self.MAX_TRACE_TAG or 1)
+
+    def split_traced(self) -> typing.Tuple['CalculatorHeader', typing.Optional[typing.Tuple[int, int]]]:
+        '''
+        Returns the request without its trace context and the trace context (None if the request isn't traced).
+        The trace tag is kept, the response should echo it.
+        '''
+        if not (self.is_request and self.traced):
+            return self, None
+        if len(self.data) < self.TRACE_CONTEXT_LENGTH:
+            raise ValueError(
+                f'The data is too short ({len(self.data)} bytes) to hold a trace context')
+        context = self.data[-self.TRACE_CONTEXT_LENGTH:]
+        return self.copy(reserved=self.reserved & ~self.RESERVED_TRACED, data=self.data[:-self.TRACE_CONTEXT_LENGTH]), \
+            (int.from_bytes(context[:8], 'big'), int.from_bytes(context[8:], 'big'))
+
+    def copy(self, **changes: typing.Any) -> 'CalculatorHeader':
+        '''
+        Returns a copy of the header with the given fields changed, the total length is recomputed.
+        '''
+        fields = dict(unix_time_stamp=self.unix_time_stamp, reserved=self.reserved, cache_result=self.cache_result, show_steps=self.show_steps,
+                      is_request=self.is_request, status_code=self.status_code, cache_control=self.cache_control, data=self.data, trace_tag=self.trace_tag)
+        fields.update(changes)
+        return self.__class__(total_length=None, **fields)
+
+    def compress(self, threshold: int = COMPRESSION_THRESHOLD) -> 'CalculatorHeader':
+        '''
+        Returns a compressed copy of the response, or the response itself if it's too short or compression doesn't help.
+        '''
+        if self.is_request or self.compressed or len(self.data) < threshold:
+            return self
+        data = zlib.compress(self.data, COMPRESSION_LEVEL)
+        if len(data) >= len(self.data):
+            return self
+        return self.copy(reserved=self.reserved | self.RESERVED_COMPRESSED, data=data)
+
+    def decompress(self) -> 'CalculatorHeader':
+        '''
+        Returns an uncompressed copy of the response, or the response itself if it isn't compressed.
+        '''
+        if self.is_request or not self.compressed:
+            return self
+        return self.copy(reserved=self.reserved & ~self.RESERVED_COMPRESSED, data=payload(self))
 
     @staticmethod
     def pack_flags(reserved: int, cache_result: bool, show_steps: bool, is_request: bool, status_code: int) -> int:
@@ -156,27 +317,32 @@ class CalculatorHeader:
         return reserved, bool(cache_result), bool(show_steps), bool(is_request), status_code
 
     def pack(self) -> bytes:
-        return struct.pack(self.HEADER_FORMAT, self.unix_time_stamp, self.total_length, self.pack_flags(self.reserved, self.cache_result, self.show_steps, self.is_request, self.status_code), self.cache_control) + self.data
+        return struct.pack(self.HEADER_FORMAT, self.unix_time_stamp, self.total_length, self.pack_flags(self.reserved, self.cache_result, self.show_steps, self.is_request, self.status_code), self.cache_control, self.trace_tag) + self.data
 
     @classmethod
     def unpack(cls, data: bytes) -> 'CalculatorHeader':
         if len(data) < cls.HEADER_MIN_LENGTH:
             raise ValueError(
                 f'The data is too short ({len(data)} bytes) to be a valid header')
-        unix_time_stamp, total_length, flags, cache_control = struct.unpack(
+        unix_time_stamp, total_length, flags, cache_control, trace_tag = struct.unpack(
             cls.HEADER_FORMAT, data[:cls.HEADER_MIN_LENGTH])
         reserved, cache_result, show_steps, is_request, status_code = cls.unpack_flags(
             flags)
-        return cls(unix_time_stamp=unix_time_stamp, total_length=total_length, reserved=reserved, cache_result=cache_result, show_steps=show_steps, is_request=is_request, status_code=status_code, cache_control=cache_control, data=data[cls.HEADER_MIN_LENGTH:])
+        return cls(unix_time_stamp=unix_time_stamp, total_length=total_length, reserved=reserved, cache_result=cache_result, show_steps=show_steps, is_request=is_request, status_code=status_code, cache_control=cache_control, data=data[cls.HEADER_MIN_LENGTH:], trace_tag=trace_tag)
     
     
     @classmethod
-    def from_request(cls, data: bytes, show_steps: bool, cache_result: bool, cache_control: int) -> 'CalculatorHeader':
-        return cls(unix_time_stamp=int(time.time()), total_length=None, reserved=0, cache_result=cache_result, show_steps=show_steps, is_request=True, status_code=0, cache_control=cache_control, data=data)
+    def from_request(cls, data: bytes, show_steps: bool, cache_result: bool, cache_control: int, accept_compression: bool = False, method: int = 0) -> 'CalculatorHeader':
+        reserved = cls.RESERVED_COMPRESSED if accept_compression else 0
+        return cls(unix_time_stamp=int(time.time()), total_length=None, reserved=reserved, cache_result=cache_result, show_steps=show_steps, is_request=True, status_code=method, cache_control=cache_control, data=data)
     
     @classmethod
-    def from_expression(cls, expr: Expression, show_steps: bool, cache_result: bool, cache_control: int) -> 'CalculatorHeader':
-        return cls.from_request(data=pickle.dumps(expr), show_steps=show_steps, cache_result=cache_result, cache_control=cache_control)
+    def from_expression(cls, expr: Expression, show_steps: bool, cache_result: bool, cache_control: int, accept_compression: bool = False) -> 'CalculatorHeader':
+        return cls.from_request(data=pickle.dumps(expr), show_steps=show_steps, cache_result=cache_result, cache_control=cache_control, accept_compression=accept_compression)
+    
+    @classmethod
+    def from_text(cls, text: str, show_steps: bool, cache_result: bool, cache_control: int, accept_compression: bool = False) -> 'CalculatorHeader':
+        return cls.from_request(data=text.encode('utf-8'), show_steps=show_steps, cache_result=cache_result, cache_control=cache_control, accept_compression=accept_compression)
     
     @classmethod
     def from_response(cls, data: bytes, status_code: int, show_steps: bool, cache_result: bool, cache_control: int) -> 'CalculatorHeader':
@@ -186,6 +352,10 @@ class CalculatorHeader:
     def from_result(cls, result: numbers.Real, steps: list[str], cache_result: bool, cache_control: int) -> 'CalculatorHeader':
         return cls.from_response(data=pickle.dumps((result, steps)), status_code=CalculatorHeader.STATUS_OK, show_steps=bool(steps), cache_result=cache_result, cache_control=cache_control)
     
+    @classmethod
+    def from_not_modified(cls, show_steps: bool, cache_result: bool, cache_control: int) -> 'CalculatorHeader':
+        return cls.from_response(data=b'', status_code=CalculatorHeader.STATUS_NOT_MODIFIED, show_steps=show_steps, cache_result=cache_result, cache_control=cache_control)
+    
     @classmethod
     def from_error(cls, error: Exception, status_code: int, cache_result: bool, cache_control: int) -> 'CalculatorHeader':
         return cls.from_response(data=pickle.dumps(error), status_code=status_code, show_steps=False, cache_result=cache_result, cache_control=cache_control)
@@ -193,7 +363,48 @@ class CalculatorHeader:
     def __bytes__(self) -> bytes:
         return self.pack()
 
+def payload(header: CalculatorHeader) -> bytes:
+    '''
+    Returns the data of the packet, decompressed if the packet is a compressed response.
+    '''
+    if header.is_request or not header.compressed:
+        return header.data
+    try:
+        return zlib.decompress(header.data)
+    except zlib.error as e:
+        raise ValueError('Received data could not be decompressed') from e
+
+def response_validator(response: CalculatorHeader) -> bytes:
+    '''
+    Returns the validator of a response, a digest of its status code and its (uncompressed) data.
+    Two responses with the same validator carry the same result, steps or error.
+    '''
+    digest = hashlib.blake2b(digest_size=CalculatorHeader.VALIDATOR_LENGTH)
+    digest.update(response.status_code.to_bytes(2, 'big'))
+    digest.update(payload(response))
+    return digest.digest()
+
+def time_remaining(request: CalculatorHeader, response: CalculatorHeader) -> typing.Tuple[float, float]:
+    '''
+    Returns the seconds remaining before the server (the response's max-age) and before the client (the request's
+    max-age) deem the response stale, MAX_CACHE_CONTROL meaning never (infinite).
+    Caches (the proxy's and the client's private cache) only answer with responses for which both are positive.
+    '''
+    age = int(time.time()) - response.unix_time_stamp
+    res_cc = response.cache_control if response.cache_control != CalculatorHeader.MAX_CACHE_CONTROL else math.inf
+    req_cc = request.cache_control if request.cache_control != CalculatorHeader.MAX_CACHE_CONTROL else math.inf
+    return res_cc - age, req_cc - age
+
 def data_to_expression(header: CalculatorHeader) -> Expression:
+    '''
+    Returns the expression of a request, unpickled, or parsed if it's an infix text (see the Data field).
+    Parsed texts are cached (see calculator.parse), so repeated text requests are parsed once.
+    '''
+    if not header.data.startswith(PICKLE_PROTO):
+        try:
+            return parse(header.data.decode('utf-8'))
+        except UnicodeDecodeError as e:
+            raise ValueError('Received data is neither a pickled nor a text expression') from e
     try:
         expr = pickle.loads(header.data)
         if not isinstance(expr, Expression):
@@ -206,7 +417,7 @@ def data_to_expression(header: CalculatorHeader) -> Expression:
 
 def data_to_result(header: CalculatorHeader) -> typing.Tuple[numbers.Real, list[str]]:
     try:
-        result = pickle.loads(header.data)
+        result = pickle.loads(payload(header))
         if not isinstance(result, tuple) or len(result) != 2 or not isinstance(result[0], numbers.Real) or not isinstance(result[1], list):
             raise ValueError('Received data is not a valid result')
         return result
@@ -217,7 +428,7 @@ def data_to_result(header: CalculatorHeader) -> typing.Tuple[numbers.Real, list[
 
 def data_to_error(header: CalculatorHeader) -> Exception:
     try:
-        error = pickle.loads(header.data)
+        error = pickle.loads(payload(header))
         if not isinstance(error, Exception):
             raise ValueError('Received data is not an Exception')
         return error
@@ -226,6 +437,48 @@ def data_to_error(header: CalculatorHeader) -> Exception:
     except Exception as e:
         raise ValueError('Received data is not an Exception') from e
 
+def message_length(data: typing.Union[bytes, bytearray]) -> typing.Optional[int]:
+    '''
+    Returns the total length of the message at the start of the data, or None if its header wasn't received yet.
+    '''
+    if len(data) < CalculatorHeader.HEADER_MIN_LENGTH:
+        return None
+    _, total_length = struct.unpack_from('!LH', data)
+    # A malformed length takes whatever was received, unpacking it reports the error
+    return total_length if total_length >= CalculatorHeader.HEADER_MIN_LENGTH else len(data)
+
+def split_messages(buffer: bytearray) -> list[bytes]:
+    '''
+    Removes the complete messages from the start of the buffer and returns them.
+    Messages are delimited by the total length in their header, so several messages received at once
+    (pipelined requests) or a message received in several parts are split correctly.
+    '''
+    messages = []
+    while True:
+        length = message_length(buffer)
+        if length is None or len(buffer) < length:
+            return messages
+        messages.append(bytes(buffer[:length]))
+        del buffer[:length]
+
+def receive_message(connection: socket.socket, buffer: bytearray) -> bytes:
+    '''
+    Returns the next message received on the connection, the bytes received after it are kept in the buffer for the next call.
+    Once the connection is closed, returns what's left in the buffer (empty if nothing, e.g. a QUIT message otherwise).
+    '''
+    while True:
+        length = message_length(buffer)
+        if length is not None and len(buffer) >= length:
+            message = bytes(buffer[:length])
+            del buffer[:length]
+            return message
+        data = connection.recv(BUFFER_SIZE)
+        if not data:
+            message = bytes(buffer)
+            buffer.clear()
+            return message
+        buffer += data
+
 class CalculatorError(Exception):
     pass
 
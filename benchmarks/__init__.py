@@ -0,0 +1,4 @@
+'''
+Benchmarks for the calculator client, proxy and server.
+Run them from the repository root, e.g. `python -m benchmarks.compression`.
+'''
@@ -0,0 +1,75 @@
+'''
+Trace-driven comparison of the proxy cache hit ratio with and without TinyLFU admission.
+A trace is a text file with one request key per line (e.g. the expression or a digest of it).
+Without a trace, a synthetic one is generated: Zipf-distributed requests for a stable hot set,
+interrupted by scans of keys that are requested only once (like batch jobs).
+'''
+import argparse
+import random
+import typing
+
+import caching
+
+
+def synthetic_trace(length: int, keys: int, skew: float, scan_every: int, scan_length: int, seed: int) -> list[str]:
+    '''
+    Function which generates a request trace of Zipf requests with periodic one-off scans
+    '''
+    rng = random.Random(seed)
+    weights = [1 / (rank ** skew) for rank in range(1, keys + 1)]
+    population = [f"hot-{rank}" for rank in range(keys)]
+    trace, scans = [], 0
+    while len(trace) < length:
+        trace.extend(rng.choices(population, weights, k=scan_every))
+        trace.extend(f"scan-{scans}-{i}" for i in range(scan_length))
+        scans += 1
+    return trace[:length]
+
+
+def load_trace(path: str) -> list[str]:
+    with open(path) as trace_file:
+        return [line.strip() for line in trace_file if line.strip()]
+
+
+def hit_ratio(trace: typing.Iterable[str], capacity: int, admission: bool) -> float:
+    '''
+    Function which replays the trace through the proxy's cache and returns the hit ratio
+    '''
+    cache = caching.LRUCache(capacity, caching.TinyLFU(capacity) if admission else None)
+    hits = requests = 0
+    for key in trace:
+        requests += 1
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache.put(key, True)
+    return hits / requests if requests else 0.0
+
+
+def main(trace: list[str], capacities: list[int]) -> None:
+    print(f"{len(trace)} requests, {len(set(trace))} distinct keys")
+    print(f"{'capacity':>8} {'LRU':>7} {'TinyLFU':>7}")
+    for capacity in capacities:
+        print(f"{capacity:>8} {hit_ratio(trace, capacity, False):>7.2%} {hit_ratio(trace, capacity, True):>7.2%}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Proxy cache hit ratio with and without TinyLFU admission.')
+    arg_parser.add_argument('-t', '--trace', type=str, default=None,
+                            help='A trace file with one request key per line (default: a synthetic trace).')
+    arg_parser.add_argument('-c', '--capacities', type=int, nargs='+', default=[64, 128, 256, 512, 1024],
+                            help='The cache sizes to compare.')
+    arg_parser.add_argument('-n', '--length', type=int, default=200_000, help='Length of the synthetic trace.')
+    arg_parser.add_argument('-k', '--keys', type=int, default=5_000, help='Number of hot keys in the synthetic trace.')
+    arg_parser.add_argument('-s', '--skew', type=float, default=0.9, help='Zipf skew of the synthetic trace.')
+    arg_parser.add_argument('--scan_every', type=int, default=2_000, help='Hot requests between scans.')
+    arg_parser.add_argument('--scan_length', type=int, default=1_000, help='One-off requests per scan.')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic trace.')
+    args = arg_parser.parse_args()
+
+    if args.trace is not None:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.length, args.keys, args.skew, args.scan_every, args.scan_length, args.seed)
+    main(trace, args.capacities)
@@ -0,0 +1,68 @@
+'''
+Cluster-wide hit ratio and server load of several proxies, without sharing, with a consistent-hash ring,
+and with exchanged cache digests. Every request goes to a random proxy, as behind a load balancer.
+'''
+import argparse
+import random
+import socket
+import time
+
+import api
+from benchmarks import processes, workloads
+
+
+def run(mode: str, proxy_count: int, requests: list[bytes], zipf: workloads.Zipf, count: int, base_port: int,
+        digest_interval: float, rng: random.Random) -> tuple[int, float]:
+    '''
+    Function which sends `count` requests to a cluster and returns the number of requests the server got and the duration
+    '''
+    server_port = base_port
+    proxy_ports = [base_port + 1 + i for i in range(proxy_count)]
+    commands = []
+    for port in proxy_ports:
+        args = []
+        if mode != 'none':
+            for peer_port in proxy_ports:
+                if peer_port != port:
+                    args += ['--peer', f'127.0.0.1:{peer_port}']
+            args += ['--peer_mode', mode, '--digest_interval', str(digest_interval)]
+        commands.append(processes.proxy_command(port, [server_port], None, *args))
+
+    metrics_port = base_port + 1 + proxy_count
+    with processes.running(processes.server_command(server_port, None, '-mp', str(metrics_port)), *commands):
+        sockets = [socket.create_connection(('127.0.0.1', port)) for port in proxy_ports]
+        start = time.perf_counter()
+        for _ in range(count):
+            proxy_socket = rng.choice(sockets)
+            proxy_socket.sendall(requests[zipf.sample()])
+            proxy_socket.recv(api.BUFFER_SIZE)
+        duration = time.perf_counter() - start
+        for proxy_socket in sockets:
+            proxy_socket.close()
+        server_requests = processes.total(processes.scrape(('127.0.0.1', metrics_port)), 'server_responses_total')
+    return int(server_requests), duration
+
+
+def main(proxy_count: int, keys: int, count: int, skew: float, base_port: int, digest_interval: float) -> None:
+    requests = [api.CalculatorHeader.from_expression(expression, False, True, api.CalculatorHeader.MAX_CACHE_CONTROL, True).pack()
+                for expression in workloads.distinct_expressions(keys, depth=3)]
+    print(f"{proxy_count} proxies, {keys} keys, {count} requests, Zipf skew {skew}")
+    print(f"{'sharing':>8} {'server requests':>15} {'cluster hit ratio':>17} {'seconds':>8}")
+    for mode in ('none', 'ring', 'digest'):
+        rng = random.Random(0)
+        server_requests, duration = run(mode, proxy_count, requests, workloads.Zipf(keys, skew, rng), count,
+                                        base_port, digest_interval, rng)
+        print(f"{mode:>8} {server_requests:>15} {1 - server_requests / count:>17.2%} {duration:>8.2f}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Cluster-wide hit ratio and server load with cooperative proxy caching.')
+    arg_parser.add_argument('-n', '--proxies', type=int, default=3, help='Number of proxies.')
+    arg_parser.add_argument('-k', '--keys', type=int, default=1_000, help='Number of distinct expressions.')
+    arg_parser.add_argument('-r', '--requests', type=int, default=5_000, help='Number of requests.')
+    arg_parser.add_argument('-s', '--skew', type=float, default=0.9, help='Zipf skew of the requests.')
+    arg_parser.add_argument('-p', '--port', type=int, default=19_900, help='First port of the cluster.')
+    arg_parser.add_argument('--digest_interval', type=float, default=0.5, help='Seconds between digest exchanges.')
+    args = arg_parser.parse_args()
+    main(args.proxies, args.keys, args.requests, args.skew, args.port, args.digest_interval)
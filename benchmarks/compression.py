@@ -0,0 +1,46 @@
+'''
+Bandwidth and cache footprint of compressed vs. uncompressed responses on the example expressions in client.py.
+The requests are processed in-process by the server's process_request, so the numbers are exact byte counts.
+'''
+import argparse
+
+import api
+import client
+import server
+
+
+def response_sizes(expression: api.Expression, show_steps: bool, threshold: int) -> tuple[int, int]:
+    '''
+    Function which returns the packed response length without and with compression
+    '''
+    plain = server.process_request(api.CalculatorHeader.from_expression(
+        expression, show_steps, True, api.CalculatorHeader.MAX_CACHE_CONTROL))
+    compressed = server.process_request(api.CalculatorHeader.from_expression(
+        expression, show_steps, True, api.CalculatorHeader.MAX_CACHE_CONTROL, accept_compression=True))
+    # The server compresses with the default threshold, re-apply it with the requested one
+    compressed = compressed.decompress().compress(threshold)
+    return len(plain.pack()), len(compressed.pack())
+
+
+def main(threshold: int) -> None:
+    print(f"Compression threshold: {threshold} bytes, zlib level {api.COMPRESSION_LEVEL}")
+    print(f"{'#':>3} {'steps':>5} {'plain':>7} {'compressed':>10} {'ratio':>6}")
+    for show_steps in (False, True):
+        total_plain, total_compressed = 0, 0
+        for i, expression in enumerate(client.EXAMPLE_EXPRESSIONS):
+            plain, compressed = response_sizes(expression, show_steps, threshold)
+            total_plain += plain
+            total_compressed += compressed
+            print(f"{i:>3} {str(show_steps):>5} {plain:>7} {compressed:>10} {compressed / plain:>6.2f}")
+        # Every response is one cache slot in the proxy, so the totals are both the bytes on the wire
+        # for one pass over the examples and the bytes held by the proxy cache afterwards
+        print(f"{'all':>3} {str(show_steps):>5} {total_plain:>7} {total_compressed:>10} {total_compressed / total_plain:>6.2f}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Compressed vs. uncompressed response sizes.')
+    arg_parser.add_argument('-t', '--threshold', type=int, default=api.COMPRESSION_THRESHOLD,
+                            help='Only compress responses with at least this many bytes of data.')
+    args = arg_parser.parse_args()
+    main(args.threshold)
@@ -0,0 +1,245 @@
+'''
+Measures the connection modes of the report's HTTP analysis on the real client, proxy and server, against the formulas:
+- non_persistent: a new connection per request, N * (2 RTT + transmission + processing)
+- persistent: one connection used for one request at a time, RTT + N * (RTT + transmission + processing)
+- pipelined: one connection with up to D requests in flight (client.Client), RTT + max(ceil(N / D) * RTT,
+  RTT + transmission + processing + (N - 1) * max(request transmission, processing, response transmission)),
+  since the requests, their processing and the responses overlap (the link carries both directions at once)
+The client reaches the proxy through a relay (DelayShim) that adds the RTT and limits the bandwidth of the link,
+and the processing time is measured without the relay, one request at a time.
+Every request asks for a new response (max-age 0), so all the modes do the same work whatever ran before them.
+'''
+import argparse
+import csv
+import math
+import queue
+import socket
+import threading
+import time
+import typing
+
+import api
+import client
+import upstream
+from benchmarks import processes, workloads
+
+MODES: typing.Final[tuple[str, ...]] = ('non_persistent', 'persistent', 'pipelined')
+
+# ========================================================================
+# ================================ Delay Shim ============================
+# ========================================================================
+
+# region Delay Shim
+
+
+class DelayShim:
+    '''
+    A TCP relay in front of an address, emulating a slower link on the local stack: every chunk is delayed by half the RTT
+    in each direction, after waiting for its turn on a link of the given bandwidth (bytes per second, 0 = unlimited).
+    The first request of a connection waits one more RTT, like it would for TCP's handshake.
+    '''
+
+    def __init__(self, target: tuple[str, int], rtt: float, bandwidth: float = 0) -> None:
+        self.target = target
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.socket = socket.create_server(('127.0.0.1', 0))
+        self.address: tuple[str, int] = self.socket.getsockname()[:2]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:  # closed
+                return
+            threading.Thread(target=self.relay, args=(connection,), daemon=True).start()
+
+    def relay(self, connection: socket.socket) -> None:
+        accepted = time.monotonic()
+        with connection, socket.create_connection(self.target) as target_connection:
+            for sock in (connection, target_connection):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            directions = [threading.Thread(target=self.pump, args=(connection, target_connection, accepted + self.rtt)),
+                          threading.Thread(target=self.pump, args=(target_connection, connection, accepted))]
+            for direction in directions:
+                direction.start()
+            for direction in directions:
+                direction.join()
+
+    def pump(self, source: socket.socket, destination: socket.socket, link_free: float) -> None:
+        '''
+        Reads the chunks of one direction and schedules their delivery, reading doesn't wait for the delivery
+        so pipelined requests are in flight together
+        '''
+        chunks: queue.Queue[tuple[float, bytes]] = queue.Queue()
+        delivery = threading.Thread(target=self.deliver, args=(chunks, destination))
+        delivery.start()
+        while True:
+            try:
+                chunk = source.recv(api.BUFFER_SIZE)
+            except OSError:
+                chunk = b''
+            now = time.monotonic()
+            link_free = max(now, link_free) + (len(chunk) / self.bandwidth if self.bandwidth else 0)
+            chunks.put((link_free + self.rtt / 2, chunk))
+            if not chunk:
+                break
+        delivery.join()
+
+    @staticmethod
+    def deliver(chunks: queue.Queue, destination: socket.socket) -> None:
+        while True:
+            deliver_at, chunk = chunks.get()
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if not chunk:
+                    destination.shutdown(socket.SHUT_WR)
+                    return
+                destination.sendall(chunk)
+            except OSError:
+                return
+
+    def close(self) -> None:
+        self.socket.close()
+
+# endregion
+
+# ========================================================================
+# ================================= Modes ================================
+# ========================================================================
+
+# region Modes
+
+
+def exchange(connection: socket.socket, request: bytes) -> bytes:
+    connection.sendall(request)
+    response = api.receive_message(connection, bytearray())
+    if not response:
+        raise ConnectionError("The proxy closed the connection")
+    return response
+
+
+def non_persistent(address: tuple[str, int], requests: list[api.CalculatorHeader], pipeline_depth: int) -> None:
+    for request in requests:
+        with socket.create_connection(address) as connection:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            exchange(connection, request.pack())
+
+
+def persistent(address: tuple[str, int], requests: list[api.CalculatorHeader], pipeline_depth: int) -> None:
+    with socket.create_connection(address) as connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for request in requests:
+            exchange(connection, request.pack())
+
+
+def pipelined(address: tuple[str, int], requests: list[api.CalculatorHeader], pipeline_depth: int) -> None:
+    with client.Client(address, connections=1, pipeline_depth=pipeline_depth, timeout=60, retries=0) as pipelined_client:
+        for future in [pipelined_client.submit_request(request) for request in requests]:
+            future.exception()
+
+
+RUNNERS: typing.Final[dict[str, typing.Callable[[tuple[str, int], list[api.CalculatorHeader], int], None]]] = {
+    'non_persistent': non_persistent, 'persistent': persistent, 'pipelined': pipelined}
+
+
+def theory(mode: str, requests: int, rtt: float, transmission: tuple[float, float], processing: float, pipeline_depth: int) -> float:
+    '''
+    Function which returns the time the report's formulas give for the requests, in seconds
+    transmission is the time to transmit a request and a response.
+    '''
+    exchange_time = sum(transmission) + processing
+    if mode == 'non_persistent':
+        return requests * (2 * rtt + exchange_time)
+    if mode == 'persistent':
+        return rtt + requests * (rtt + exchange_time)
+    return rtt + max(math.ceil(requests / pipeline_depth) * rtt,
+                     rtt + exchange_time + (requests - 1) * max(*transmission, processing))
+
+
+def timed(runner: typing.Callable[[tuple[str, int], list[api.CalculatorHeader], int], None], address: tuple[str, int],
+          requests: list[api.CalculatorHeader], pipeline_depth: int) -> float:
+    started = time.perf_counter()
+    runner(address, requests, pipeline_depth)
+    return time.perf_counter() - started
+
+# endregion
+
+
+def main(args: argparse.Namespace) -> None:
+    expressions = workloads.distinct_expressions(args.requests, args.depth, args.seed)
+    requests = [api.CalculatorHeader.from_expression(expression, args.steps, False, 0, True) for expression in expressions]
+    request_bytes = sum(len(request.pack()) for request in requests) / len(requests)
+    rtts = [float(rtt) / 1000 for rtt in args.rtts.split(',')]
+    bandwidth = args.bandwidth * 1_000_000 / 8  # bytes per second
+
+    def run(address: tuple[str, int]) -> list[dict[str, typing.Any]]:
+        # The processing time and response size, one request at a time and straight to the proxy
+        with socket.create_connection(address) as connection:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            started = time.perf_counter()
+            response_bytes = sum(len(exchange(connection, request.pack())) for request in requests) / len(requests)
+            processing = (time.perf_counter() - started) / len(requests)
+        transmission = (request_bytes / bandwidth, response_bytes / bandwidth) if bandwidth else (0.0, 0.0)
+        print(f"{len(requests)} requests of {request_bytes:.0f} bytes, responses of {response_bytes:.0f} bytes, "
+              f"processing {processing * 1000:.3f} ms, transmission {sum(transmission) * 1000:.3f} ms")
+        rows = []
+        for rtt in rtts:
+            shim = DelayShim(address, rtt, bandwidth)
+            try:
+                for mode in MODES:
+                    measured = timed(RUNNERS[mode], shim.address, requests, args.pipeline_depth)
+                    expected = theory(mode, len(requests), rtt, transmission, processing, args.pipeline_depth)
+                    rows.append({'rtt_ms': rtt * 1000, 'bandwidth_mbps': args.bandwidth, 'mode': mode, 'requests': len(requests),
+                                 'measured_s': measured, 'theory_s': expected})
+            finally:
+                shim.close()
+        return rows
+
+    if args.proxy is not None:
+        rows = run(args.proxy)
+    else:
+        server_port, proxy_port = args.port, args.port + 1
+        logging = ['--log_level', args.log_level]
+        with processes.running(processes.server_command(server_port, None, *logging),
+                               processes.proxy_command(proxy_port, [server_port], None, *logging, *args.proxy_args)):
+            rows = run(('127.0.0.1', proxy_port))
+
+    print(f"\n{'rtt':>8} {'mode':<16} {'measured':>11} {'theory':>11} {'per request':>12} {'error':>8}")
+    for row in rows:
+        error = row['measured_s'] / row['theory_s'] - 1 if row['theory_s'] else math.nan
+        print(f"{row['rtt_ms']:>5.1f} ms {row['mode']:<16} {row['measured_s']:>9.3f} s {row['theory_s']:>9.3f} s "
+              f"{row['measured_s'] / row['requests'] * 1000:>9.3f} ms {error:>+8.1%}")
+    if args.output is not None:
+        with open(args.output, 'w', newline='', encoding='utf-8') as output:
+            writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Non-persistent, persistent and pipelined connections measured against the formulas of the report.')
+    arg_parser.add_argument('-n', '--requests', type=int, default=50, help='Requests per mode.')
+    arg_parser.add_argument('--rtts', type=str, default='0,5,20',
+                            help='Round trip times (ms) added between the client and the proxy, comma separated.')
+    arg_parser.add_argument('--bandwidth', type=float, default=0, help='Bandwidth (Mbit/s) of the link, 0 = unlimited.')
+    arg_parser.add_argument('--pipeline_depth', type=int, default=client.PIPELINE_DEPTH,
+                            help='Requests in flight in the pipelined mode.')
+    arg_parser.add_argument('--depth', type=int, default=4, help='Depth of the expression trees.')
+    arg_parser.add_argument('--steps', action='store_true', help='Ask for the steps (larger responses).')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Seed of the expressions.')
+    arg_parser.add_argument('-o', '--output', type=str, default=None,
+                            help='Write the measured and theoretical times to this CSV file, to plot them.')
+    arg_parser.add_argument('-p', '--port', type=int, default=19_700, help='First of the ports of the local server and proxy.')
+    arg_parser.add_argument('--log_level', type=str, default='warning', help='Log level of the local server and proxy.')
+    arg_parser.add_argument('--proxy_args', type=str, nargs=argparse.REMAINDER, default=[],
+                            help='Further arguments of the local proxy.')
+    arg_parser.add_argument('--proxy', type=upstream.parse_address, default=None,
+                            help='Use this running proxy (host:port) instead of starting a server and proxy.')
+    args = arg_parser.parse_args()
+    main(args)
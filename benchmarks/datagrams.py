@@ -0,0 +1,66 @@
+'''
+Compares the latency of short sessions over TCP and UDP (see datagram.py): every session opens a client, sends a few
+requests one at a time and closes it, like client.client does. Both transports are measured between the client and the
+proxy and between the proxy and the server, so every request asks for a new response (max-age 0) by default.
+'''
+import argparse
+import time
+
+import api
+import client
+from benchmarks import load, processes, workloads
+
+
+def sessions(address: tuple[str, int], udp: bool, expressions: list[api.Expression], session_length: int,
+             cache_control: int) -> load.Results:
+    '''
+    Function which runs the sessions one after the other and returns their latencies
+    '''
+    results = load.Results()
+    for start in range(0, len(expressions), session_length):
+        started = time.perf_counter()
+        status = api.CalculatorHeader.STATUS_OK
+        with (client.DatagramClient if udp else client.Client)(address, connections=1, retries=0) as session:
+            for expression in expressions[start:start + session_length]:
+                try:
+                    session.calculate(expression, cache_result=cache_control > 0, cache_control=cache_control)
+                except api.CalculatorClientError:
+                    pass  # e.g. a division by zero, still a response
+                except Exception:
+                    status = 0
+        results.record(time.perf_counter() - started, status)
+    return results
+
+
+def main(args: argparse.Namespace) -> None:
+    expressions = workloads.distinct_expressions(args.sessions * args.session_length, args.depth, args.seed)
+    server_port, tcp_proxy_port, udp_proxy_port = args.port, args.port + 1, args.port + 2
+    logging = ['--log_level', args.log_level]
+    print(f"{args.sessions} sessions of {args.session_length} requests, max-age {args.cache_control}")
+    print(f"{'client':<8}{'upstream':<10}" + ''.join(f"{f'p{q * 100:g}':>12}" for q in load.QUANTILES) + f"{'failed':>8}")
+    with processes.running(processes.server_command(server_port, None, '--udp', *logging),
+                           processes.proxy_command(tcp_proxy_port, [server_port], None, '--udp', *logging),
+                           processes.proxy_command(udp_proxy_port, [server_port], None, '--udp', '--upstream_udp', *logging)):
+        for upstream_udp, proxy_port in ((False, tcp_proxy_port), (True, udp_proxy_port)):
+            for udp in (False, True):
+                address = ('127.0.0.1', proxy_port)
+                sessions(address, udp, expressions[:args.session_length * 10], args.session_length, args.cache_control)  # warm up
+                results = sessions(address, udp, expressions, args.session_length, args.cache_control)
+                failed = results.statuses.collect().get(('0',), 0)
+                print(f"{'udp' if udp else 'tcp':<8}{'udp' if upstream_udp else 'tcp':<10}"
+                      + ''.join(f"{results.latency.quantile(q) * 1000:>9.3f} ms" for q in load.QUANTILES) + f"{int(failed):>8}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Latency of short sessions over TCP and UDP.')
+    arg_parser.add_argument('-n', '--sessions', type=int, default=500, help='Sessions per combination of transports.')
+    arg_parser.add_argument('-k', '--session_length', type=int, default=1, help='Requests per session.')
+    arg_parser.add_argument('--cache_control', type=int, default=0,
+                            help='Max-age of the requests (0 = every request goes to the server).')
+    arg_parser.add_argument('--depth', type=int, default=3, help='Depth of the expression trees.')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Seed of the expressions.')
+    arg_parser.add_argument('-p', '--port', type=int, default=19_750,
+                            help='First of the ports of the local server and the two proxies.')
+    arg_parser.add_argument('--log_level', type=str, default='warning', help='Log level of the local server and proxies.')
+    args = arg_parser.parse_args()
+    main(args)
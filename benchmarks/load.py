@@ -0,0 +1,223 @@
+'''
+Load generator for the client -> proxy -> server path.
+Closed loop: N clients send their next request as soon as they got the previous response.
+Open loop: requests arrive at a fixed rate whether or not the previous ones were answered, and their latency is
+measured from when they were due, so a slow proxy can't hide its queueing delay by slowing the load down.
+A server and a proxy are started locally (unless --proxy is given), so runs are reproducible on one machine.
+'''
+import argparse
+import queue
+import random
+import socket
+import threading
+import time
+import typing
+
+import api
+import metrics
+import upstream
+from benchmarks import processes, workloads
+
+QUANTILES = (0.5, 0.99, 0.999)
+
+
+def parse_mix(mix: str) -> list[tuple[int, float]]:
+    '''
+    Function which parses an expression mix, 'depth:weight,...' (e.g. '2:0.6,4:0.3,8:0.1')
+    '''
+    classes = []
+    for part in mix.split(','):
+        depth, _, weight = part.partition(':')
+        classes.append((int(depth), float(weight or 1)))
+    return classes
+
+
+class Workload:
+    '''
+    The requests of a run: `keys` distinct expressions per depth of the mix, picked by Zipf popularity,
+    asking for steps with probability `steps` and with a max-age drawn from `cache_controls`
+    '''
+
+    def __init__(self, mix: list[tuple[int, float]], keys: int, skew: float, steps: float, cache_controls: list[int],
+                 seed: int = 0) -> None:
+        self.rng = random.Random(seed)
+        self.expressions = [workloads.distinct_expressions(keys, depth, seed + depth) for depth, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.zipf = workloads.Zipf(keys, skew, self.rng)
+        self.steps = steps
+        self.cache_controls = cache_controls
+        self.lock = threading.Lock()
+
+    def next(self) -> bytes:
+        with self.lock:
+            expressions = self.rng.choices(self.expressions, self.weights)[0]
+            expression = expressions[self.zipf.sample()]
+            show_steps = self.rng.random() < self.steps
+            cache_control = self.rng.choice(self.cache_controls)
+        return api.CalculatorHeader.from_expression(expression, show_steps, cache_control > 0, cache_control, True).pack()
+
+
+class Results:
+    '''
+    Latencies (in an HDR-style histogram) and outcomes of the requests of a run
+    '''
+
+    def __init__(self) -> None:
+        self.latency = metrics.Histogram('load_latency_seconds', 'Request latency.')
+        self.statuses = metrics.Counter('load_responses_total', 'Responses by status.', ('status',))
+
+    def record(self, latency: float, status: int) -> None:
+        self.latency.observe(latency)
+        self.statuses.inc(labels=(str(status),))
+
+
+def exchange(connection: socket.socket, request: bytes) -> int:
+    '''
+    Function which sends a request and returns the status code of its response (0 if the connection failed)
+    '''
+    connection.sendall(request)
+    response = connection.recv(api.BUFFER_SIZE)
+    if not response:
+        return 0
+    return api.CalculatorHeader.unpack(response).status_code
+
+
+def client_loop(address: tuple[str, int], workload: Workload, results: Results, next_due: typing.Callable[[], typing.Optional[float]]) -> None:
+    '''
+    Function which sends requests over one connection while next_due returns when the next request is due (None = stop),
+    reconnecting after failures (e.g. a 503 closes the connection)
+    '''
+    connection = None
+    try:
+        while True:
+            due = next_due()
+            if due is None:
+                return
+            if connection is None:
+                try:
+                    connection = socket.create_connection(address)
+                except OSError:
+                    results.record(time.perf_counter() - due, 0)
+                    continue
+            try:
+                status = exchange(connection, workload.next())
+            except OSError:
+                status = 0
+            results.record(time.perf_counter() - due, status)
+            if status in (0, api.CalculatorHeader.STATUS_OVERLOADED):
+                connection.close()
+                connection = None
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def closed_loop(address: tuple[str, int], workload: Workload, results: Results, clients: int, duration: float) -> None:
+    deadline = time.perf_counter() + duration
+
+    def next_due() -> typing.Optional[float]:
+        now = time.perf_counter()
+        return now if now < deadline else None
+
+    threads = [threading.Thread(target=client_loop, args=(address, workload, results, next_due)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def open_loop(address: tuple[str, int], workload: Workload, results: Results, clients: int, duration: float, rate: float) -> None:
+    '''
+    Function which schedules `rate` requests a second for `duration` seconds, sent by the first free of `clients` connections
+    '''
+    arrivals: queue.Queue[typing.Optional[float]] = queue.Queue()
+
+    def next_due() -> typing.Optional[float]:
+        return arrivals.get()
+
+    threads = [threading.Thread(target=client_loop, args=(address, workload, results, next_due)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    for i in range(int(duration * rate)):
+        due = start + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        arrivals.put(due)
+    for _ in threads:
+        arrivals.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def report(results: Results, duration: float, before: dict[str, float], after: dict[str, float]) -> None:
+    statuses = results.statuses.collect()
+    count = sum(statuses.values())
+    print(f"{count} requests in {duration:.2f} s: {count / duration:.0f} requests/s")
+    print("responses: " + ', '.join(f"{status or 'failed'}={int(n)}" for (status,), n in sorted(statuses.items())))
+    print("latency: " + ', '.join(f"p{q * 100:g}={results.latency.quantile(q) * 1000:.3f} ms" for q in QUANTILES))
+    if after:
+        hits = processes.total(after, 'proxy_cache_hits_total') - processes.total(before, 'proxy_cache_hits_total')
+        misses = processes.total(after, 'proxy_cache_misses_total') - processes.total(before, 'proxy_cache_misses_total')
+        if hits + misses:
+            print(f"proxy hit ratio: {hits / (hits + misses):.2%} ({int(hits)} hits, {int(misses)} misses)")
+
+
+def main(args: argparse.Namespace) -> None:
+    workload = Workload(parse_mix(args.mix), args.keys, args.skew, args.steps,
+                        [int(value) for value in args.cache_control.split(',')], args.seed)
+    results = Results()
+    mode = f"open loop, {args.rate:g} requests/s" if args.rate else f"closed loop, {args.clients} clients"
+    print(f"{mode}, {args.duration:g} s, mix {args.mix}, {args.keys} keys per depth, Zipf skew {args.skew}, "
+          f"steps {args.steps:.0%}, cache control {args.cache_control}")
+
+    def run(address: tuple[str, int], metrics_address: typing.Optional[tuple[str, int]]) -> None:
+        before = processes.scrape(metrics_address) if metrics_address else {}
+        start = time.perf_counter()
+        if args.rate:
+            open_loop(address, workload, results, args.clients, args.duration, args.rate)
+        else:
+            closed_loop(address, workload, results, args.clients, args.duration)
+        duration = time.perf_counter() - start
+        after = processes.scrape(metrics_address) if metrics_address else {}
+        report(results, duration, before, after)
+
+    if args.proxy is not None:
+        run(args.proxy, args.proxy_metrics)
+        return
+    server_port, proxy_port, metrics_port = args.port, args.port + 1, args.port + 2
+    logging = ['--log_level', args.log_level]
+    with processes.running(processes.server_command(server_port, None, *logging),
+                           processes.proxy_command(proxy_port, [server_port], None, '-mp', str(metrics_port), *logging,
+                                                   *args.proxy_args)):
+        run(('127.0.0.1', proxy_port), ('127.0.0.1', metrics_port))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Put load on a proxy and report the throughput, latency percentiles and hit ratio.')
+    arg_parser.add_argument('-c', '--clients', type=int, default=8,
+                            help='Concurrent connections (closed loop: clients sending back to back).')
+    arg_parser.add_argument('--rate', type=float, default=0,
+                            help='Requests per second for an open loop (default: closed loop).')
+    arg_parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds to put load for.')
+    arg_parser.add_argument('-m', '--mix', type=str, default='2:0.6,4:0.3,8:0.1',
+                            help='Expression depths and their weights (depth:weight,...).')
+    arg_parser.add_argument('-k', '--keys', type=int, default=1_000, help='Distinct expressions per depth.')
+    arg_parser.add_argument('-s', '--skew', type=float, default=0.9, help='Zipf skew of the expressions.')
+    arg_parser.add_argument('--steps', type=float, default=0.5, help='Fraction of the requests asking for steps.')
+    arg_parser.add_argument('--cache_control', type=str, default='65535',
+                            help='Max-ages the requests accept, picked at random (comma separated, 0 = don\'t use the cache).')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Seed of the generated workload.')
+    arg_parser.add_argument('-p', '--port', type=int, default=19_800,
+                            help='First of the ports of the local server, proxy and proxy metrics.')
+    arg_parser.add_argument('--log_level', type=str, default='warning', help='Log level of the local server and proxy.')
+    arg_parser.add_argument('--proxy_args', type=str, nargs=argparse.REMAINDER, default=[],
+                            help='Further arguments of the local proxy (e.g. --proxy_args -cs 256).')
+    arg_parser.add_argument('--proxy', type=upstream.parse_address, default=None,
+                            help='Put load on this running proxy (host:port) instead of starting a server and proxy.')
+    arg_parser.add_argument('--proxy_metrics', type=upstream.parse_address, default=None,
+                            help='The metrics address (host:port) of the running proxy, for the hit ratio.')
+    args = arg_parser.parse_args()
+    main(args)
@@ -0,0 +1,285 @@
+'''
+Microbenchmarks of the hot paths: packing and unpacking headers, deserializing expressions, evaluating and stringifying them,
+the server's request processing, and the proxy's cache hit, miss and stale paths against a local stub server.
+The workloads are generated the same way on every run, so the results of two runs (e.g. before and after a change)
+can be compared: write them with --output and compare a later run against them with --baseline.
+'''
+import argparse
+import json
+import pickle
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+import typing
+
+import api
+import proxy
+import server
+
+# Every timed sample runs the benchmark for at least this many seconds
+MIN_SAMPLE_TIME = 0.05
+# A benchmark is a regression if its median is this much slower than the baseline's
+REGRESSION_THRESHOLD = 0.10
+# Shapes of the expression trees, the deep tree is a chain of nested operations and the wide tree a function call
+# with many arguments, they stay well below the recursion limit and their responses with steps fit in a response
+DEEP_DEPTH = 100
+WIDE_ARGUMENTS = 32
+# Data size of the large payloads, just below the buffer size of a single receive
+LARGE_PAYLOAD = api.BUFFER_SIZE - 1024
+
+# ========================================================================
+# =============================== Workloads ==============================
+# ========================================================================
+
+# region Workloads
+
+
+def shallow() -> api.Expression:
+    return api.BINARY_OPERATORS.MUL(api.BINARY_OPERATORS.ADD(1, 2), api.BINARY_OPERATORS.SUB(7, 3))
+
+
+def deep(depth: int = DEEP_DEPTH) -> api.Expression:
+    expression = api.Constant(1)
+    for i in range(depth):
+        operator = api.BINARY_OPERATORS.ADD if i % 2 else api.BINARY_OPERATORS.MUL
+        expression = operator(expression, i % 7 + 1)
+    return expression
+
+
+def wide(arguments: int = WIDE_ARGUMENTS) -> api.Expression:
+    return api.FUNCTIONS.MAX(*(api.BINARY_OPERATORS.ADD(i, 1) for i in range(arguments)))
+
+
+def sized(size: int = LARGE_PAYLOAD) -> api.Expression:
+    '''
+    Function which returns the widest function call whose request data is at most `size` bytes
+    '''
+    def data_length(arguments: int) -> int:
+        return len(pickle.dumps(wide(arguments)))  # what from_expression sends
+
+    low, high = 1, 1
+    while data_length(high) <= size:
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        low, high = (middle, high) if data_length(middle) <= size else (low, middle)
+    return wide(low)
+
+
+SHAPES: typing.Final[dict[str, typing.Callable[[], api.Expression]]] = {'shallow': shallow, 'deep': deep, 'wide': wide}
+
+# endregion
+
+# ========================================================================
+# ============================== Stub Server =============================
+# ========================================================================
+
+# region Stub Server
+
+
+class StubServer:
+    '''
+    A local server answering every request with a canned response (and conditional requests with 304),
+    so the proxy paths are timed without the server's evaluation
+    '''
+
+    def __init__(self, responses: dict[tuple[bytes, bool], api.CalculatorHeader]) -> None:
+        self.responses = {key: response.pack() for key, response in responses.items()}
+        self.socket = socket.create_server(('127.0.0.1', 0))
+        self.address: tuple[str, int] = self.socket.getsockname()[:2]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            connection, _ = self.socket.accept()
+            with connection:
+                request, validator = api.CalculatorHeader.unpack(connection.recv(api.BUFFER_SIZE)).split_conditional()
+                if validator is not None:
+                    connection.sendall(api.CalculatorHeader.from_not_modified(request.show_steps, True, proxy.INDEFINITE).pack())
+                else:
+                    connection.sendall(self.responses[(request.data, request.show_steps)])
+
+# endregion
+
+# ========================================================================
+# ============================== Benchmarks ==============================
+# ========================================================================
+
+# region Benchmarks
+
+
+class Benchmark:
+    '''
+    A named function to time, `prepare` runs once before it's timed and `setup` before every call (untimed)
+    '''
+
+    def __init__(self, name: str, function: typing.Callable[[], typing.Any], setup: typing.Optional[typing.Callable[[], None]] = None,
+                 prepare: typing.Optional[typing.Callable[[], None]] = None) -> None:
+        self.name = name
+        self.function = function
+        self.setup = setup
+        self.prepare = prepare
+
+    def run(self, number: int) -> float:
+        '''
+        Runs the function `number` times and returns the seconds it took
+        '''
+        function = self.function
+        if self.setup is None:
+            started = time.perf_counter()
+            for _ in range(number):
+                function()
+            return time.perf_counter() - started
+        elapsed = 0.0
+        for _ in range(number):
+            self.setup()
+            started = time.perf_counter()
+            function()
+            elapsed += time.perf_counter() - started
+        return elapsed
+
+    def measure(self, repeat: int, min_time: float = MIN_SAMPLE_TIME) -> dict[str, typing.Any]:
+        '''
+        Times `repeat` samples of the function, each sample long enough to take min_time seconds,
+        and returns the statistics of the time per call in microseconds
+        '''
+        if self.prepare is not None:
+            self.prepare()
+        number = 1
+        while self.run(number) < min_time:  # calibration, also warms up the caches
+            number *= 2
+        times = [self.run(number) / number * 1_000_000 for _ in range(repeat)]
+        return {'median_us': statistics.median(times), 'min_us': min(times), 'max_us': max(times),
+                'number': number, 'repeat': repeat}
+
+
+def codec_benchmarks() -> list[Benchmark]:
+    benchmarks = []
+    for size, expression in (('small', shallow()), ('large', sized())):
+        request = api.CalculatorHeader.from_expression(expression, False, True, proxy.INDEFINITE)
+        packed = request.pack()
+        benchmarks += [Benchmark(f"pack/{size}", request.pack),
+                       Benchmark(f"unpack/{size}", lambda packed=packed: api.CalculatorHeader.unpack(packed)),
+                       Benchmark(f"data_to_expression/{size}", lambda request=request: api.data_to_expression(request))]
+    return benchmarks
+
+
+def evaluator_benchmarks() -> list[Benchmark]:
+    benchmarks = []
+    for shape, build in SHAPES.items():
+        expression = build()
+        benchmarks += [Benchmark(f"data_to_expression/{shape}", lambda request=api.CalculatorHeader.from_expression(
+                           expression, False, True, 0): api.data_to_expression(request)),
+                       Benchmark(f"calculate/{shape}", lambda expression=expression: server.calculate(expression, [])),
+                       Benchmark(f"stringify/{shape}", lambda expression=expression: api.stringify(expression, add_brackets=True))]
+        for show_steps in (False, True):
+            request = api.CalculatorHeader.from_expression(expression, show_steps, True, proxy.INDEFINITE, True)
+            benchmarks.append(Benchmark(f"server.process_request/{shape}/{'steps' if show_steps else 'no_steps'}",
+                                        lambda request=request: server.process_request(request)))
+    return benchmarks
+
+
+def proxy_benchmarks() -> list[Benchmark]:
+    '''
+    Function which returns the benchmarks of the proxy paths, they share a stub server for the responses.
+    - hit: the response is cached and fresh
+    - miss: the request doesn't accept cached responses (cache-control 0), so it goes to the server and isn't cached
+    - stale: the cached response went stale, it's revalidated with the server (304) and cached again
+    '''
+    benchmarks = []
+    requests = {show_steps: api.CalculatorHeader.from_expression(shallow(), show_steps, True, proxy.INDEFINITE, True)
+                for show_steps in (False, True)}
+    responses = {show_steps: server.process_request(request) for show_steps, request in requests.items()}
+    stub = StubServer({(request.data, show_steps): responses[show_steps] for show_steps, request in requests.items()})
+    for show_steps, request in requests.items():
+        steps = 'steps' if show_steps else 'no_steps'
+        key = (request.data, show_steps)
+        fresh = responses[show_steps]
+        stale = fresh.copy(unix_time_stamp=int(time.time()) - 60, cache_control=1)
+        benchmarks += [
+            Benchmark(f"proxy.process_request/hit/{steps}", lambda request=request: proxy.process_request(request, stub.address),
+                      prepare=lambda key=key, fresh=fresh: proxy.cache.put(key, fresh)),
+            Benchmark(f"proxy.process_request/miss/{steps}",
+                      lambda request=request.copy(cache_control=0): proxy.process_request(request, stub.address)),
+            Benchmark(f"proxy.process_request/stale/{steps}", lambda request=request: proxy.process_request(request, stub.address),
+                      setup=lambda key=key, stale=stale: proxy.cache.put(key, stale)),
+        ]
+    return benchmarks
+
+
+def benchmarks() -> list[Benchmark]:
+    return codec_benchmarks() + evaluator_benchmarks() + proxy_benchmarks()
+
+# endregion
+
+# ========================================================================
+# ================================ Results ===============================
+# ========================================================================
+
+# region Results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+    '''
+    Function which prints the change of every benchmark against the baseline and returns the names of the regressions
+    '''
+    regressions = []
+    print(f"{'benchmark':<44} {'baseline':>11} {'now':>11} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<44} {'-':>11} {result['median_us']:>8.2f} us {'new':>8}")
+            continue
+        before, now = baseline[name]['median_us'], result['median_us']
+        change = now / before - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  improvement'
+        print(f"{name:<44} {before:>8.2f} us {now:>8.2f} us {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main(args: argparse.Namespace) -> None:
+    results = {}
+    print(f"{'benchmark':<44} {'median':>11} {'min':>11} {'calls':>8}")
+    for benchmark in benchmarks():
+        if args.filter and not any(part in benchmark.name for part in args.filter):
+            continue
+        result = results[benchmark.name] = benchmark.measure(args.repeat, args.min_time)
+        print(f"{benchmark.name:<44} {result['median_us']:>8.2f} us {result['min_us']:>8.2f} us {result['number']:>8}")
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'benchmarks': results}, output, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['benchmarks']
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions (more than {args.threshold:.0%} slower than {args.baseline})")
+            sys.exit(1)
+
+# endregion
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Microbenchmarks of the protocol, evaluator and cache hot paths.')
+    arg_parser.add_argument('-o', '--output', type=str, default=None, help='Write the results to this JSON file.')
+    arg_parser.add_argument('-b', '--baseline', type=str, default=None,
+                            help='Compare the results with a JSON file written by --output, exits with 1 on regressions.')
+    arg_parser.add_argument('-t', '--threshold', type=float, default=REGRESSION_THRESHOLD,
+                            help='Slowdown of the median that counts as a regression (0.1 = 10%%).')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=7, help='Timed samples per benchmark.')
+    arg_parser.add_argument('--min_time', type=float, default=MIN_SAMPLE_TIME, help='Minimal seconds of a timed sample.')
+    arg_parser.add_argument('-f', '--filter', type=str, action='append', default=[],
+                            help='Only run the benchmarks whose name contains this (can be repeated).')
+    args = arg_parser.parse_args()
+    main(args)
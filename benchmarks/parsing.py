@@ -0,0 +1,57 @@
+'''
+Compares decoding the expressions of requests in the two formats (see api.data_to_expression): unpickling the trees
+client.py sends, parsing the equivalent infix texts (calculator.Parser), and parsing them through the parse cache
+(calculator.parse) once every text was parsed, as for repeated text requests.
+'''
+import argparse
+import pickle
+import time
+import typing
+
+import calculator
+from benchmarks import workloads
+
+
+def throughput(decode: typing.Callable[[typing.Any], typing.Any], inputs: list, duration: float) -> float:
+    '''
+    Function which decodes the inputs over and over for about `duration` seconds and returns the decodes per second
+    '''
+    decoded = 0
+    started = time.perf_counter()
+    while True:
+        for value in inputs:
+            decode(value)
+        decoded += len(inputs)
+        elapsed = time.perf_counter() - started
+        if elapsed >= duration:
+            return decoded / elapsed
+
+
+def main(args: argparse.Namespace) -> None:
+    print(f"{args.count} expressions per depth, {args.duration:g} s per format")
+    print(f"{'depth':>6}{'pickle B':>10}{'text B':>8}{'unpickle/s':>13}{'parse/s':>11}{'cached/s':>12}{'parse/unpickle':>16}")
+    for depth in (int(depth) for depth in args.depths.split(',')):
+        expressions = workloads.distinct_expressions(args.count, depth, args.seed)
+        pickles = [pickle.dumps(expression) for expression in expressions]
+        # Fully bracketed, so the texts spell out the trees whatever the precedence of their operators
+        texts = [expression.__str_brackets__(True) for expression in expressions]
+        for text in texts:  # the texts must parse back to the same trees
+            if calculator.Parser(text).parse().__str_brackets__(True) != text:
+                raise ValueError(f"'{text}' did not parse back to the same expression")
+        unpickled = throughput(pickle.loads, pickles, args.duration)
+        parsed = throughput(lambda text: calculator.Parser(text).parse(), texts, args.duration)
+        calculator.parse.cache_clear()
+        cached = throughput(calculator.parse, texts, args.duration) if len(texts) <= calculator.PARSE_CACHE_SIZE else float('nan')
+        print(f"{depth:>6}{sum(map(len, pickles)) / len(pickles):>10.0f}{sum(map(len, texts)) / len(texts):>8.0f}"
+              f"{unpickled:>13.0f}{parsed:>11.0f}{cached:>12.0f}{parsed / unpickled:>15.2f}x")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Throughput of parsing text expressions against unpickling the same trees.')
+    arg_parser.add_argument('-n', '--count', type=int, default=500,
+                            help=f'Distinct expressions per depth (at most {calculator.PARSE_CACHE_SIZE} for the cached run).')
+    arg_parser.add_argument('--depths', type=str, default='2,4,6', help='Depths of the expression trees, comma separated.')
+    arg_parser.add_argument('-d', '--duration', type=float, default=1, help='Seconds of every measurement.')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Seed of the expressions.')
+    args = arg_parser.parse_args()
+    main(args)
@@ -0,0 +1,83 @@
+'''
+Starting local servers and proxies as subprocesses for the end-to-end benchmarks.
+'''
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import time
+import typing
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for_port(address: tuple[str, int], timeout: float = 10.0) -> None:
+    '''
+    Function which waits until something listens on the address
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(address, timeout=0.5):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Nothing is listening on {address[0]}:{address[1]}")
+            time.sleep(0.05)
+
+
+def start(script: str, args: list[str], log: typing.Optional[typing.IO] = None) -> subprocess.Popen:
+    '''
+    Function which starts one of the repository's scripts, unbuffered so its log is complete even if it's killed
+    '''
+    return subprocess.Popen([sys.executable, '-u', os.path.join(ROOT, script), *args], cwd=ROOT,
+                            stdout=log if log is not None else subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+@contextlib.contextmanager
+def running(*commands: tuple[str, list[str], tuple[str, int], typing.Optional[typing.IO]]) -> typing.Iterator[list[subprocess.Popen]]:
+    '''
+    Starts every (script, args, address, log) command in order, waiting for each one to listen, and kills them all on exit
+    '''
+    processes = []
+    try:
+        for script, args, address, log in commands:
+            processes.append(start(script, args, log))
+            wait_for_port(address)
+        yield processes
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+
+def server_command(port: int, log: typing.Optional[typing.IO] = None, *args: str) -> tuple[str, list[str], tuple[str, int], typing.Optional[typing.IO]]:
+    return 'server.py', ['-p', str(port), *args], ('127.0.0.1', port), log
+
+
+def proxy_command(port: int, server_ports: list[int], log: typing.Optional[typing.IO] = None, *args: str) -> tuple[str, list[str], tuple[str, int], typing.Optional[typing.IO]]:
+    upstreams = [arg for server_port in server_ports for arg in ('-u', f'127.0.0.1:{server_port}')]
+    return 'proxy.py', ['-pp', str(port), *upstreams, *args], ('127.0.0.1', port), log
+
+
+def scrape(address: tuple[str, int]) -> dict[str, float]:
+    '''
+    Function which reads the metrics of a process started with --metrics_port, by sample (e.g. 'proxy_cache_hits_total')
+    '''
+    with urllib.request.urlopen(f"http://{address[0]}:{address[1]}/metrics", timeout=5) as response:
+        text = response.read().decode('utf-8')
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+
+def total(samples: dict[str, float], name: str) -> float:
+    '''
+    Function which sums a metric over all its labels
+    '''
+    return sum(value for sample, value in samples.items() if sample == name or sample.startswith(name + '{'))
@@ -0,0 +1,151 @@
+'''
+Replays a trace recorded by a proxy (see --capture of proxy.py) against a local server and proxy (or a running proxy),
+at the original timing, N times faster, or as fast as the connections allow, and compares the latency and hit ratio
+with the recorded run and with a previous replay (--output, then --baseline).
+Requests are sent when they are due whether or not the previous ones were answered (an open loop, see load.py),
+and their latency is measured from when they were due.
+The recorded latency is the time the proxy took to handle a request, so it leaves out the network and the client.
+'''
+import argparse
+import concurrent.futures
+import json
+import math
+import time
+import typing
+
+import api
+import capture
+import client
+import upstream
+from benchmarks import load, processes
+
+
+def status_of(future: concurrent.futures.Future) -> int:
+    '''
+    Function which returns the status code the response of a replayed request had (0 if there was none)
+    '''
+    error = future.exception()
+    if error is None:
+        return api.CalculatorHeader.STATUS_OK
+    if isinstance(error, api.CalculatorClientError):
+        return api.CalculatorHeader.STATUS_CLIENT_ERROR
+    if isinstance(error, api.CalculatorServerError):
+        return api.CalculatorHeader.STATUS_SERVER_ERROR
+    return 0
+
+
+def summary(results: load.Results, seconds: float, hits: float, misses: float) -> dict[str, float]:
+    statuses = results.statuses.collect()
+    requests = sum(statuses.values())
+    return {
+        'requests': requests, 'seconds': seconds, 'throughput': requests / seconds if seconds else math.nan,
+        **{f"p{q * 100:g}_ms": results.latency.quantile(q) * 1000 for q in load.QUANTILES},
+        'hit_ratio': hits / (hits + misses) if hits + misses else math.nan,
+        'failed': statuses.get(('0',), 0),
+    }
+
+
+def replay(address: tuple[str, int], path: str, speed: float, connections: int, pipeline_depth: int,
+           limit: typing.Optional[int]) -> tuple[dict[str, float], load.Results, float]:
+    '''
+    Function which replays the trace and returns the summary of the recorded run, the results of the replay and its duration
+    '''
+    recorded, replayed = load.Results(), load.Results()
+    recorded_hits = recorded_misses = 0
+    first = last = None
+    futures = []
+    with client.Client(address, connections=connections, pipeline_depth=pipeline_depth, retries=0) as replay_client:
+        start = time.perf_counter()
+        for entry in capture.load(path):
+            # Requests of sibling proxies depend on their caches, only client requests are replayed
+            if entry['method'] != api.CalculatorHeader.METHOD_EVALUATE:
+                continue
+            if limit is not None and len(futures) >= limit:
+                break
+            first = entry['t'] if first is None else first
+            last = entry['t']
+            recorded.record(entry['ms'] / 1000, entry['status'])
+            if entry['outcome'] in ('hit', 'stale_hit'):
+                recorded_hits += 1
+            else:
+                recorded_misses += 1
+            due = time.perf_counter()
+            if speed > 0:
+                due = start + (entry['t'] - first) / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            future = replay_client.submit_request(capture.to_request(entry))
+            future.add_done_callback(lambda future, due=due: replayed.record(time.perf_counter() - due, status_of(future)))
+            futures.append(future)
+        concurrent.futures.wait(futures)
+        duration = time.perf_counter() - start
+    return summary(recorded, (last - first) if futures else 0, recorded_hits, recorded_misses), replayed, duration
+
+
+def report(columns: dict[str, dict[str, float]]) -> None:
+    names = list(columns)
+    print(f"{'':<12}" + ''.join(f"{name:>14}" for name in names))
+    for key in ('requests', 'seconds', 'throughput', *(f"p{q * 100:g}_ms" for q in load.QUANTILES), 'hit_ratio', 'failed'):
+        cells = []
+        for name in names:
+            value = columns[name].get(key, math.nan)
+            cells.append(f"{value:>14.2%}" if key == 'hit_ratio' else f"{value:>14.3f}" if isinstance(value, float) else f"{value:>14}")
+        print(f"{key:<12}" + ''.join(cells))
+
+
+def main(args: argparse.Namespace) -> None:
+    speed = f"{args.speed:g}x speed" if args.speed > 0 else "as fast as possible"
+    print(f"Replaying {args.trace} {speed} over {args.connections} connections")
+
+    def run(address: tuple[str, int], metrics_address: typing.Optional[tuple[str, int]]) -> dict[str, dict[str, float]]:
+        before = processes.scrape(metrics_address) if metrics_address else {}
+        recorded, replayed, duration = replay(address, args.trace, args.speed, args.connections, args.pipeline_depth, args.limit)
+        after = processes.scrape(metrics_address) if metrics_address else {}
+        hits = processes.total(after, 'proxy_cache_hits_total') - processes.total(before, 'proxy_cache_hits_total')
+        misses = processes.total(after, 'proxy_cache_misses_total') - processes.total(before, 'proxy_cache_misses_total')
+        return {'recorded': recorded, 'replay': summary(replayed, duration, hits, misses)}
+
+    if args.proxy is not None:
+        columns = run(args.proxy, args.proxy_metrics)
+    else:
+        server_port, proxy_port, metrics_port = args.port, args.port + 1, args.port + 2
+        logging = ['--log_level', args.log_level]
+        with processes.running(processes.server_command(server_port, None, *logging),
+                               processes.proxy_command(proxy_port, [server_port], None, '-mp', str(metrics_port), *logging,
+                                                       *args.proxy_args)):
+            columns = run(('127.0.0.1', proxy_port), ('127.0.0.1', metrics_port))
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            columns = {'baseline': json.load(baseline_file), **columns}
+    report(columns)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(columns['replay'], output, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Replay a trace recorded with --capture of proxy.py and compare the latency and hit ratio.')
+    arg_parser.add_argument('trace', type=str, help='The trace file recorded by the proxy.')
+    arg_parser.add_argument('-x', '--speed', type=float, default=1,
+                            help='Replay N times faster than recorded (1 = original timing, 0 = as fast as possible).')
+    arg_parser.add_argument('-n', '--limit', type=int, default=None, help='Only replay the first N requests.')
+    arg_parser.add_argument('-c', '--connections', type=int, default=8, help='Connections to the proxy.')
+    arg_parser.add_argument('--pipeline_depth', type=int, default=client.PIPELINE_DEPTH,
+                            help='Requests waiting for their response on each connection.')
+    arg_parser.add_argument('-o', '--output', type=str, default=None, help='Write the results of the replay to this JSON file.')
+    arg_parser.add_argument('-b', '--baseline', type=str, default=None, help='Compare with the results of a previous replay (see --output).')
+    arg_parser.add_argument('-p', '--port', type=int, default=19_850,
+                            help='First of the ports of the local server, proxy and proxy metrics.')
+    arg_parser.add_argument('--log_level', type=str, default='warning', help='Log level of the local server and proxy.')
+    arg_parser.add_argument('--proxy_args', type=str, nargs=argparse.REMAINDER, default=[],
+                            help='Further arguments of the local proxy (e.g. --proxy_args -cs 256).')
+    arg_parser.add_argument('--proxy', type=upstream.parse_address, default=None,
+                            help='Replay against this running proxy (host:port) instead of starting a server and proxy.')
+    arg_parser.add_argument('--proxy_metrics', type=upstream.parse_address, default=None,
+                            help='The metrics address (host:port) of the running proxy, for the hit ratio.')
+    args = arg_parser.parse_args()
+    main(args)
@@ -0,0 +1,406 @@
+'''
+Trace-driven simulation of the proxy cache: replays a trace recorded with proxy.py --capture through cache policies
+(LRU, LFU, ARC, TinyLFU and GDSF) of every size of a sweep in one pass over the trace, and prints the hit ratio and
+byte hit ratio curves, to pick the policy and size of the proxy cache.
+A request is a hit only if the proxy would have answered it from the cache: the freshness rules of process_request
+apply (the request's max-age, the response's max-age, INDEFINITE, 0 = don't use the cache, stale-while-revalidate),
+and only responses that store would cache are cached (see cacheable).
+Not modelled: answering requests without steps from responses with steps, and the negative cache (client errors are misses).
+LRU is simulated for every size at once with stack distances (Mattson et al.): an entry is cached in an LRU cache of
+C entries iff fewer than C other keys were used since it was last used. That's exact when every response can be cached,
+otherwise responses that aren't cached still take a slot, which slightly underestimates LRU.
+'''
+import argparse
+import collections
+import csv
+import heapq
+import math
+import typing
+
+import api
+import caching
+import capture
+import proxy
+
+POLICIES: typing.Final[tuple[str, ...]] = ('lru', 'lfu', 'arc', 'tinylfu', 'gdsf')
+
+Stored = tuple[float, float]  # when the response was cached, and its max-age in seconds (inf for INDEFINITE)
+
+
+def max_age(cache_control: int) -> float:
+    return math.inf if cache_control == proxy.INDEFINITE else cache_control
+
+
+def cacheable(entry: dict[str, typing.Any]) -> bool:
+    '''
+    Function which checks whether the proxy would cache the response of a trace record after a miss (see proxy.store)
+    '''
+    return (entry['status'] == api.CalculatorHeader.STATUS_OK and bool(entry['cache']) and bool(entry['cacheable'])
+            and entry['max_age'] > 0 and entry['cc'] > 0)
+
+
+def freshness(stored: typing.Optional[Stored], now: float, cache_control: float, stale_while_revalidate: float) -> str:
+    '''
+    Function which returns how the proxy would treat the cached response of a request (see proxy.process_request):
+    'fresh' (a hit), 'revalidate' (a stale hit refreshed in the background), 'stale' or 'missing' (misses)
+    '''
+    if stored is None:
+        return 'missing'
+    stored_at, response_max_age = stored
+    age = now - stored_at
+    server_time_remaining, client_time_remaining = response_max_age - age, cache_control - age
+    if server_time_remaining > 0 and client_time_remaining > 0:
+        return 'fresh'
+    if -server_time_remaining < stale_while_revalidate and client_time_remaining > 0:
+        return 'revalidate'
+    return 'stale'
+
+# ========================================================================
+# ================================ Policies ==============================
+# ========================================================================
+
+# region Policies
+
+
+class LFU:
+    '''
+    Evicts the least frequently used entry (the least recently used of those), counting the uses while it's cached
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.entries: dict[str, list] = {}  # key -> [value, frequency, tick]
+        self.heap: list[tuple[float, int, str]] = []  # (frequency, tick, key), outdated items are skipped
+        self.tick = 0
+
+    def priority(self, entry: list, size: int) -> float:
+        return entry[1]
+
+    def get(self, key: str) -> typing.Optional[Stored]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        entry[1] += 1
+        self.push(key, entry)
+        return entry[0]
+
+    def put(self, key: str, value: Stored, size: int) -> None:
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[0] = value
+            return
+        if len(self.entries) >= self.capacity:
+            self.evict()
+        entry = self.entries[key] = [value, 1, 0, size]
+        self.push(key, entry)
+
+    def push(self, key: str, entry: list) -> None:
+        self.tick += 1
+        entry[2] = self.tick
+        heapq.heappush(self.heap, (self.priority(entry, entry[3]), self.tick, key))
+        if len(self.heap) > 4 * len(self.entries) + 64:  # drop the outdated items
+            self.heap = [(self.priority(entry, entry[3]), entry[2], key) for key, entry in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def evict(self) -> float:
+        while True:
+            priority, tick, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] == tick:
+                del self.entries[key]
+                return priority
+
+
+class GDSF(LFU):
+    '''
+    Greedy-Dual-Size-Frequency (Cherkasova): evicts the entry with the lowest L + frequency / size, where L is the priority
+    of the last evicted entry, so small popular responses stay and entries that aren't used anymore age out
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__(capacity)
+        self.inflation = 0.0
+
+    def priority(self, entry: list, size: int) -> float:
+        return self.inflation + entry[1] / max(size, 1)
+
+    def evict(self) -> float:
+        self.inflation = super().evict()
+        return self.inflation
+
+
+class ARC:
+    '''
+    Adaptive Replacement Cache (Megiddo and Modha): recently used entries (t1) and entries used at least twice (t2),
+    with ghost lists of their evicted keys (b1, b2) to adapt the target size of t1 (p) to the workload
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.p = 0.0
+        self.t1: collections.OrderedDict[str, Stored] = collections.OrderedDict()
+        self.t2: collections.OrderedDict[str, Stored] = collections.OrderedDict()
+        self.b1: collections.OrderedDict[str, None] = collections.OrderedDict()
+        self.b2: collections.OrderedDict[str, None] = collections.OrderedDict()
+
+    def get(self, key: str) -> typing.Optional[Stored]:
+        if key in self.t1:
+            value = self.t2[key] = self.t1.pop(key)
+            return value
+        if key in self.t2:
+            self.t2.move_to_end(key)
+            return self.t2[key]
+        return None
+
+    def put(self, key: str, value: Stored, size: int) -> None:
+        if key in self.t1:
+            self.t1[key] = value
+            return
+        if key in self.t2:
+            self.t2[key] = value
+            return
+        if key in self.b1:
+            self.p = min(self.capacity, self.p + max(len(self.b2) / len(self.b1), 1))
+            self.replace(key)
+            del self.b1[key]
+            self.t2[key] = value
+            return
+        if key in self.b2:
+            self.p = max(0.0, self.p - max(len(self.b1) / len(self.b2), 1))
+            self.replace(key)
+            del self.b2[key]
+            self.t2[key] = value
+            return
+        total = len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2)
+        if len(self.t1) + len(self.b1) >= self.capacity:
+            if len(self.t1) < self.capacity:
+                self.b1.popitem(last=False)
+                self.replace(key)
+            else:
+                self.t1.popitem(last=False)
+        elif total >= self.capacity:
+            if total >= 2 * self.capacity:
+                self.b2.popitem(last=False)
+            self.replace(key)
+        self.t1[key] = value
+
+    def replace(self, key: str) -> None:
+        if self.t1 and (len(self.t1) > self.p or (key in self.b2 and len(self.t1) == self.p) or not self.t2):
+            evicted, _ = self.t1.popitem(last=False)
+            self.b1[evicted] = None
+        elif self.t2:
+            evicted, _ = self.t2.popitem(last=False)
+            self.b2[evicted] = None
+
+
+class TinyLFU:
+    '''
+    The proxy's own cache: LRU with TinyLFU admission (see caching.LRUCache)
+    '''
+
+    def __init__(self, capacity: int) -> None:
+        self.cache: caching.LRUCache[str, Stored] = caching.LRUCache(capacity, caching.TinyLFU(capacity))
+
+    def get(self, key: str) -> typing.Optional[Stored]:
+        return self.cache.get(key)
+
+    def put(self, key: str, value: Stored, size: int) -> None:
+        self.cache.put(key, value)
+
+
+SIMULATED: typing.Final[dict[str, typing.Callable[[int], typing.Any]]] = {'lfu': LFU, 'arc': ARC, 'tinylfu': TinyLFU, 'gdsf': GDSF}
+
+# endregion
+
+# ========================================================================
+# =============================== Simulation =============================
+# ========================================================================
+
+# region Simulation
+
+
+class Curve:
+    '''
+    The hits and hit bytes of a policy for every size of the sweep
+    '''
+
+    def __init__(self, sizes: list[int]) -> None:
+        self.sizes = sizes
+        self.hits = [0] * len(sizes)
+        self.hit_bytes = [0] * len(sizes)
+
+    def hit(self, index: int, size: int) -> None:
+        self.hits[index] += 1
+        self.hit_bytes[index] += size
+
+
+class Simulation(Curve):
+    '''
+    One cache of the policy per size, every request goes through all of them
+    '''
+
+    def __init__(self, policy: typing.Callable[[int], typing.Any], sizes: list[int], stale_while_revalidate: float) -> None:
+        super().__init__(sizes)
+        self.caches = [policy(size) for size in sizes]
+        self.stale_while_revalidate = stale_while_revalidate
+
+    def access(self, key: str, now: float, cache_control: float, value: typing.Optional[Stored], size: int) -> None:
+        for index, cache in enumerate(self.caches):
+            state = freshness(cache.get(key), now, cache_control, self.stale_while_revalidate)
+            if state in ('fresh', 'revalidate'):
+                self.hit(index, size)
+                if state == 'fresh':
+                    continue
+            # A miss (or a background refresh) caches the new response, if it can be cached
+            if value is not None:
+                cache.put(key, value, size)
+
+
+class FenwickTree:
+    '''
+    Prefix sums of marks over positions, in O(log n) per update and query
+    '''
+
+    def __init__(self, size: int) -> None:
+        self.tree = [0] * (size + 1)
+
+    def add(self, position: int, delta: int) -> None:
+        position += 1
+        while position < len(self.tree):
+            self.tree[position] += delta
+            position += position & -position
+
+    def prefix(self, end: int) -> int:
+        '''
+        Returns the sum of the marks at positions before end
+        '''
+        total = 0
+        while end > 0:
+            total += self.tree[end]
+            end -= end & -end
+        return total
+
+
+class StackLRU(Curve):
+    '''
+    LRU caches of every size at once: the stack distance of a request (the number of other keys used since its key
+    was last used) is computed with a Fenwick tree marking the last use of every key,
+    and the key is cached in the caches bigger than its stack distance.
+    The cached responses are still kept per size, since a response refetched in a small cache is fresher than in a big one.
+    '''
+
+    def __init__(self, sizes: list[int], stale_while_revalidate: float) -> None:
+        super().__init__(sizes)
+        self.stale_while_revalidate = stale_while_revalidate
+        self.last_use: dict[str, int] = {}
+        self.stored: dict[str, list[typing.Optional[Stored]]] = {}
+        self.marks = FenwickTree(1024)
+        self.next = 0
+
+    def distance(self, key: str) -> float:
+        if self.next >= len(self.marks.tree) - 1:
+            self.compact()
+        previous = self.last_use.get(key)
+        distance = math.inf
+        if previous is not None:
+            distance = self.marks.prefix(self.next) - self.marks.prefix(previous + 1)
+            self.marks.add(previous, -1)
+        self.marks.add(self.next, 1)
+        self.last_use[key] = self.next
+        self.next += 1
+        return distance
+
+    def compact(self) -> None:
+        '''
+        Renumbers the last uses from 0, in a tree twice as big as the number of keys
+        '''
+        keys = sorted(self.last_use, key=self.last_use.get)
+        self.marks = FenwickTree(max(1024, 2 * len(keys)))
+        for position, key in enumerate(keys):
+            self.last_use[key] = position
+            self.marks.add(position, 1)
+        self.next = len(keys)
+
+    def access(self, key: str, now: float, cache_control: float, value: typing.Optional[Stored], size: int) -> None:
+        distance = self.distance(key)
+        stored = self.stored.setdefault(key, [None] * len(self.sizes))
+        for index, capacity in enumerate(self.sizes):
+            cached = stored[index] if distance < capacity else None
+            state = freshness(cached, now, cache_control, self.stale_while_revalidate)
+            if state in ('fresh', 'revalidate'):
+                self.hit(index, size)
+                if state == 'fresh':
+                    continue
+            stored[index] = value if value is not None else cached
+
+
+def simulate(path: str, policies: list[str], sizes: list[int], stale_while_revalidate: float) -> tuple[dict[str, Curve], dict[str, int]]:
+    '''
+    Function which replays the trace through the policies in one pass, returns their curves and the totals of the trace
+    '''
+    curves: dict[str, Curve] = {policy: StackLRU(sizes, stale_while_revalidate) if policy == 'lru'
+                                else Simulation(SIMULATED[policy], sizes, stale_while_revalidate) for policy in policies}
+    totals = {'requests': 0, 'bytes': 0, 'bypassed': 0, 'uncacheable': 0}
+    keys = set()
+    for entry in capture.load(path):
+        # Requests of sibling proxies and admin requests aren't client requests
+        if entry['method'] != api.CalculatorHeader.METHOD_EVALUATE:
+            continue
+        totals['requests'] += 1
+        totals['bytes'] += entry['bytes']
+        keys.add(entry['key'])
+        # A max-age of 0 asks the proxy to get a new response, it doesn't look in the cache (nor caches the response)
+        if entry['cc'] == 0:
+            totals['bypassed'] += 1
+            continue
+        value = (entry['t'], max_age(entry['max_age'])) if cacheable(entry) else None
+        if value is None:
+            totals['uncacheable'] += 1
+        for curve in curves.values():
+            curve.access(entry['key'], entry['t'], max_age(entry['cc']), value, entry['bytes'])
+    totals['keys'] = len(keys)
+    return curves, totals
+
+# endregion
+
+
+def main(args: argparse.Namespace) -> None:
+    policies = args.policies.split(',')
+    for policy in policies:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy '{policy}' (must be one of {POLICIES})")
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    curves, totals = simulate(args.trace, policies, sizes, args.stale_while_revalidate)
+    print(f"{totals['requests']} requests for {totals['keys']} keys, {totals['bytes']} bytes, "
+          f"{totals['bypassed']} bypassing the cache (max-age 0), {totals['uncacheable']} with responses that can't be cached")
+    requests, total_bytes = max(totals['requests'], 1), max(totals['bytes'], 1)
+    for title, values, total in (('hit ratio', 'hits', requests), ('byte hit ratio', 'hit_bytes', total_bytes)):
+        print(f"\n{title}")
+        print(f"{'size':>8}" + ''.join(f"{policy:>9}" for policy in policies))
+        for index, size in enumerate(sizes):
+            print(f"{size:>8}" + ''.join(f"{getattr(curves[policy], values)[index] / total:>9.2%}" for policy in policies))
+    if args.output is not None:
+        with open(args.output, 'w', newline='', encoding='utf-8') as output:
+            writer = csv.writer(output)
+            writer.writerow(['policy', 'size', 'hit_ratio', 'byte_hit_ratio'])
+            for policy in policies:
+                for index, size in enumerate(sizes):
+                    writer.writerow([policy, size, curves[policy].hits[index] / requests,
+                                     curves[policy].hit_bytes[index] / total_bytes])
+        print(f"\nCurves written to {args.output}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Hit ratio and byte hit ratio of cache policies and sizes on a trace recorded with proxy.py --capture.')
+    arg_parser.add_argument('trace', type=str, help='The trace file recorded by the proxy.')
+    arg_parser.add_argument('-p', '--policies', type=str, default=','.join(POLICIES),
+                            help=f"Policies to simulate, comma separated (of {', '.join(POLICIES)}).")
+    arg_parser.add_argument('-s', '--sizes', type=str, default='64,128,256,512,1024,2048,4096,8192',
+                            help='Cache sizes (entries) to simulate, comma separated.')
+    arg_parser.add_argument('-swr', '--stale_while_revalidate', type=float, default=proxy.STALE_WHILE_REVALIDATE,
+                            help='Serve responses stale by at most this many seconds (see proxy.py).')
+    arg_parser.add_argument('-o', '--output', type=str, default=None,
+                            help='Write the curves to this CSV file (policy, size, hit_ratio, byte_hit_ratio).')
+    args = arg_parser.parse_args()
+    main(args)
@@ -0,0 +1,57 @@
+'''
+Compares the proxy's upstream calls over loopback TCP and over a Unix domain socket, for a proxy and server on the
+same host: one server listens on both, one proxy reaches it over TCP and another over the socket (--server_uds).
+Every request asks for a new response (max-age 0) so it goes to the server, and each transport is measured with
+one client (latency) and with many (throughput).
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks import load, processes
+
+
+def measure(address: tuple[str, int], workload: load.Workload, clients: int, duration: float) -> tuple[load.Results, float]:
+    results = load.Results()
+    started = time.perf_counter()
+    load.closed_loop(address, workload, results, clients, duration)
+    return results, time.perf_counter() - started
+
+
+def main(args: argparse.Namespace) -> None:
+    server_port, tcp_proxy_port, unix_proxy_port = args.port, args.port + 1, args.port + 2
+    logging = ['--log_level', args.log_level]
+    print(f"{args.duration:g} s per run, mix {args.mix}, steps {args.steps:.0%}, every request to the server")
+    print(f"{'upstream':<10}{'clients':>8}{'requests/s':>12}" + ''.join(f"{f'p{q * 100:g}':>12}" for q in load.QUANTILES)
+          + f"{'failed':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'calc.sock')
+        with processes.running(processes.server_command(server_port, None, '--uds', path, *logging),
+                               processes.proxy_command(tcp_proxy_port, [server_port], None, *logging),
+                               processes.proxy_command(unix_proxy_port, [], None, '--server_uds', path, *logging)):
+            for clients in (1, args.clients):
+                for transport, proxy_port in (('tcp', tcp_proxy_port), ('unix', unix_proxy_port)):
+                    workload = load.Workload(load.parse_mix(args.mix), args.keys, 0, args.steps, [0], args.seed)
+                    results, duration = measure(('127.0.0.1', proxy_port), workload, clients, args.duration)
+                    statuses = results.statuses.collect()
+                    print(f"{transport:<10}{clients:>8}{sum(statuses.values()) / duration:>12.0f}"
+                          + ''.join(f"{results.latency.quantile(q) * 1000:>9.3f} ms" for q in load.QUANTILES)
+                          + f"{int(statuses.get(('0',), 0)):>8}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Throughput and latency of the proxy reaching the server over loopback TCP and a Unix domain socket.')
+    arg_parser.add_argument('-c', '--clients', type=int, default=8, help='Concurrent clients of the throughput runs.')
+    arg_parser.add_argument('-d', '--duration', type=float, default=5, help='Seconds of every run.')
+    arg_parser.add_argument('-m', '--mix', type=str, default='2:0.7,4:0.3',
+                            help='Expression depths and their weights (depth:weight,...), small so the evaluation doesn\'t hide the transport.')
+    arg_parser.add_argument('-k', '--keys', type=int, default=1_000, help='Distinct expressions per depth.')
+    arg_parser.add_argument('--steps', type=float, default=0, help='Fraction of the requests asking for steps.')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Seed of the generated workload.')
+    arg_parser.add_argument('-p', '--port', type=int, default=19_650,
+                            help='First of the ports of the local server and the two proxies.')
+    arg_parser.add_argument('--log_level', type=str, default='warning', help='Log level of the local server and proxies.')
+    args = arg_parser.parse_args()
+    main(args)
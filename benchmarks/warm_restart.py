@@ -0,0 +1,111 @@
+'''
+Time for a restarted proxy to get back to its steady-state hit ratio, with and without the disk cache tier.
+A server runs in a background thread; the proxy's process_request is called directly, so a "restart"
+is a fresh memory tier (and a disk tier reopened from its file).
+'''
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+import typing
+
+import api
+import caching
+import disk_cache
+import logs
+import proxy
+import server
+from benchmarks import workloads
+
+
+def restart_proxy(capacity: int, disk_path: typing.Optional[str]) -> float:
+    '''
+    Function which replaces the proxy's cache tiers, as a restart would, and returns the time it took to load the disk index
+    '''
+    if proxy.l2_cache is not None:
+        proxy.persist_cache()
+        proxy.l2_cache = None
+    proxy.cache = caching.LRUCache(capacity, caching.TinyLFU(capacity))
+    proxy.cache.on_evict = proxy.evicted
+    proxy.hits.clear()
+    start = time.perf_counter()
+    if disk_path is not None:
+        proxy.l2_cache = disk_cache.DiskCache(disk_path)
+    return time.perf_counter() - start
+
+
+def run(requests: list[api.CalculatorHeader], zipf: workloads.Zipf, count: int, server_address: tuple[str, int],
+        window: int, target: typing.Optional[float] = None) -> tuple[float, typing.Optional[int], typing.Optional[float]]:
+    '''
+    Function which sends `count` requests through the proxy and returns the hit ratio of the last window,
+    and the number of requests and seconds after which the rolling hit ratio stayed at or above the target
+    until the end (None if it ended below). The first windows are partial, the ratio counts the requests so far.
+    '''
+    outcomes = []
+    elapsed = []
+    start = time.perf_counter()
+    for _ in range(count):
+        _, _, _, cache_hit, _, _ = proxy.process_request(requests[zipf.sample()], server_address)
+        outcomes.append(cache_hit)
+        elapsed.append(time.perf_counter() - start)
+    steady = sum(outcomes[-window:]) / min(window, count)
+    if target is None:
+        return steady, None, None
+    # Walk back from the end to the last request after which the rolling hit ratio was below the target
+    hits = sum(outcomes[-window:])
+    for i in range(count - 1, -1, -1):
+        if hits / min(i + 1, window) < target:
+            return (steady, i + 2, elapsed[i + 1]) if i + 1 < count else (steady, None, None)
+        hits -= outcomes[i]
+        if i >= window:
+            hits += outcomes[i - window]
+    return steady, 1, elapsed[0]
+
+
+def main(keys: int, capacity: int, warmup: int, after: int, window: int, skew: float, port: int) -> None:
+    server_address = (api.DEFAULT_SERVER_HOST, port)
+    rng = random.Random(0)
+    requests = [api.CalculatorHeader.from_expression(expression, False, True, api.CalculatorHeader.MAX_CACHE_CONTROL, True)
+                for expression in workloads.distinct_expressions(keys, depth=4)]
+    # The server and the proxy print (and log) every request, keep the output to the results
+    logs.configure('warning')
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        threading.Thread(target=server.server, args=server_address, daemon=True).start()
+        time.sleep(0.5)
+        disk_path = os.path.join(directory, 'cache.sqlite')
+        results = []
+        for label, path in (('cold', None), ('disk tier', disk_path)):
+            restart_proxy(capacity, path)
+            steady, _, _ = run(requests, workloads.Zipf(keys, skew, rng), warmup, server_address, window)
+            load_time = restart_proxy(capacity, path)
+            _, needed, seconds = run(requests, workloads.Zipf(keys, skew, rng), after, server_address, window,
+                                     target=0.95 * steady)
+            results.append((label, steady, load_time, needed, seconds))
+        if proxy.l2_cache is not None:
+            proxy.l2_cache.close()
+
+    print(f"{keys} keys, memory tier of {capacity} responses, Zipf skew {skew}, rolling window of {window} requests")
+    print("Requests until the rolling hit ratio stays at 95% of the steady hit ratio or above:")
+    print(f"{'restart':>9} {'steady':>7} {'index load':>10} {'requests to 95%':>15} {'seconds':>8}")
+    for label, steady, load_time, needed, seconds in results:
+        print(f"{label:>9} {steady:>7.2%} {load_time * 1000:>8.2f}ms {needed if needed else 'never':>15} "
+              f"{seconds if seconds else float('nan'):>8.2f}")
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Restart-to-steady-state hit ratio of the proxy with and without the disk cache tier.')
+    arg_parser.add_argument('-k', '--keys', type=int, default=2_000, help='Number of distinct expressions.')
+    arg_parser.add_argument('-c', '--capacity', type=int, default=500, help='Size of the memory tier.')
+    arg_parser.add_argument('-w', '--warmup', type=int, default=10_000, help='Requests before the restart.')
+    arg_parser.add_argument('-a', '--after', type=int, default=10_000, help='Maximum requests after the restart.')
+    arg_parser.add_argument('--window', type=int, default=2_000,
+                            help='Requests in the rolling hit ratio window (short windows dip below the target by chance).')
+    arg_parser.add_argument('-s', '--skew', type=float, default=0.9, help='Zipf skew of the requests.')
+    arg_parser.add_argument('-p', '--port', type=int, default=19_999, help='Port of the benchmark server.')
+    args = arg_parser.parse_args()
+    main(args.keys, args.capacity, args.warmup, args.after, args.window, args.skew, args.port)
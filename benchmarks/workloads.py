@@ -0,0 +1,46 @@
+'''
+Generated workloads shared by the benchmarks.
+'''
+import bisect
+import itertools
+import random
+
+import api
+
+BINARY = [api.BINARY_OPERATORS.ADD, api.BINARY_OPERATORS.SUB, api.BINARY_OPERATORS.MUL, api.BINARY_OPERATORS.DIV]
+FUNCTIONS = [api.FUNCTIONS.MAX, api.FUNCTIONS.MIN]
+
+
+def random_expression(rng: random.Random, depth: int) -> api.Expression:
+    '''
+    Function which builds a random expression tree of the given depth, leaves are small integers
+    '''
+    if depth <= 0:
+        return api.Constant(rng.randint(1, 9))
+    kind = rng.random()
+    if kind < 0.7:
+        return rng.choice(BINARY)(random_expression(rng, depth - 1), random_expression(rng, depth - 1))
+    if kind < 0.8:
+        return api.UNARY_OPERATORS.NEG(random_expression(rng, depth - 1))
+    return rng.choice(FUNCTIONS)(*(random_expression(rng, depth - 1) for _ in range(rng.randint(2, 3))))
+
+
+def distinct_expressions(count: int, depth: int, seed: int = 0) -> list[api.Expression]:
+    '''
+    Function which builds `count` random expressions, deterministic for a given seed
+    '''
+    rng = random.Random(seed)
+    return [random_expression(rng, depth) for _ in range(count)]
+
+
+class Zipf:
+    '''
+    Sampler of ranks 0..n-1 where rank r is drawn with probability proportional to 1 / (r + 1) ** skew
+    '''
+
+    def __init__(self, n: int, skew: float, rng: random.Random) -> None:
+        self.rng = rng
+        self.cumulative = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+
+    def sample(self) -> int:
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
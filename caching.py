@@ -0,0 +1,182 @@
+import collections
+import hashlib
+import threading
+import typing
+
+# ========================================================================
+# ============================ Cache Policies ============================
+# ========================================================================
+
+# region Cache Policies
+
+K = typing.TypeVar('K', bound=typing.Hashable)
+V = typing.TypeVar('V')
+
+
+def key_digest(key: tuple[bytes, bool]) -> bytes:
+    '''
+    Function which returns a digest of a proxy cache key (request data and whether it asks for steps)
+    Unlike hash() it's the same in every process, so it can be stored or sent to other processes.
+    '''
+    data, show_steps = key
+    return hashlib.blake2b(bytes([show_steps]) + data, digest_size=16).digest()
+
+
+class LRUCache(collections.OrderedDict, typing.Generic[K, V]):
+    '''
+    A dict which holds at most `capacity` entries (0 = unbounded), ordered from the least to the most recently used.
+    When it's full, a new entry replaces the least recently used entry (the eviction victim),
+    unless an admission policy decides that the victim is worth more than the new entry.
+    '''
+
+    def __init__(self, capacity: int = 0, admission: typing.Optional['TinyLFU'] = None) -> None:
+        super().__init__()
+        self.capacity = capacity
+        self.admission = admission
+        # Called with the key and value of every evicted entry
+        self.on_evict: typing.Optional[typing.Callable[[K, V], None]] = None
+        self.lock = threading.Lock()
+
+    def get(self, key: K, default: typing.Optional[V] = None) -> typing.Optional[V]:
+        '''
+        Returns the entry and marks it as the most recently used, or the default if there is no such entry.
+        '''
+        if self.admission is not None:
+            self.admission.record(key)
+        try:
+            self.move_to_end(key)
+            return self[key]
+        except KeyError:  # not cached, or evicted by another thread in the meantime
+            return default
+
+    def peek(self, key: K, default: typing.Optional[V] = None) -> typing.Optional[V]:
+        '''
+        Returns the entry without marking it as used or recording a request for it.
+        '''
+        return super().get(key, default)
+
+    def victim(self) -> typing.Optional[K]:
+        '''
+        Returns the key of the entry that would be evicted to make room for a new entry, or None if there is room.
+        '''
+        if self.capacity <= 0 or len(self) < self.capacity:
+            return None
+        return next(iter(self), None)
+
+    def put(self, key: K, value: V) -> bool:
+        '''
+        Caches the entry, evicting the least recently used entry if the cache is full.
+        Returns whether the entry was cached (it isn't if the admission policy rejects it).
+        '''
+        evicted = None
+        with self.lock:
+            if key not in self:
+                victim = self.victim()
+                if victim is not None:
+                    if self.admission is not None and not self.admission.admit(key, victim):
+                        return False
+                    evicted = victim, self.pop(victim)
+            self[key] = value
+            self.move_to_end(key)
+        if evicted is not None and self.on_evict is not None:
+            self.on_evict(*evicted)
+        return True
+
+
+class CountMinSketch:
+    '''
+    Approximate frequency counter with `depth` rows of `width` 4-bit counters (stored one per byte).
+    The estimate of a key is the minimum of its counters, so it can only over-estimate.
+    '''
+    MAX_COUNT: typing.Final[int] = 15
+
+    def __init__(self, width: int, depth: int = 4) -> None:
+        self.width = width
+        self.depth = depth
+        self.rows = [bytearray(width) for _ in range(depth)]
+
+    def _indexes(self, key: typing.Hashable) -> typing.Iterator[tuple[bytearray, int]]:
+        for seed, row in enumerate(self.rows):
+            yield row, hash((seed, key)) % self.width
+
+    def increment(self, key: typing.Hashable) -> None:
+        for row, i in self._indexes(key):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+
+    def estimate(self, key: typing.Hashable) -> int:
+        return min(row[i] for row, i in self._indexes(key))
+
+    def halve(self) -> None:
+        '''
+        Ages the sketch so old popularity fades, by halving every counter
+        '''
+        for row in self.rows:
+            row[:] = bytes(count >> 1 for count in row)
+
+
+class BloomFilter:
+    '''
+    Set membership with false positives but no false negatives, `size` bits and `hashes` hash functions.
+    '''
+
+    def __init__(self, size: int, hashes: int = 3) -> None:
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray((size + 7) // 8)
+
+    def _indexes(self, key: typing.Hashable) -> typing.Iterator[int]:
+        for seed in range(self.hashes):
+            yield hash((~seed, key)) % self.size
+
+    def add(self, key: typing.Hashable) -> None:
+        for i in self._indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+    def clear(self) -> None:
+        self.bits = bytearray(len(self.bits))
+
+
+class TinyLFU:
+    '''
+    TinyLFU admission policy (Einziger et al.): a new entry is only cached in place of the eviction victim
+    if it was requested more often recently.
+    Frequencies are kept in a count-min sketch, which is halved every `sample_size` requests so that the
+    policy adapts to changes in popularity. A doorkeeper Bloom filter absorbs keys that are requested once,
+    so one-off requests (e.g. a scan) never reach the sketch.
+    '''
+
+    def __init__(self, capacity: int, sample_factor: int = 10) -> None:
+        capacity = max(capacity, 16)
+        self.sample_size = sample_factor * capacity
+        self.sketch = CountMinSketch(width=capacity)
+        self.doorkeeper = BloomFilter(size=4 * capacity)
+        self.requests = 0
+
+    def record(self, key: typing.Hashable) -> None:
+        '''
+        Records a request for the key
+        '''
+        if key in self.doorkeeper:
+            self.sketch.increment(key)
+        else:
+            self.doorkeeper.add(key)
+        self.requests += 1
+        if self.requests >= self.sample_size:
+            self.sketch.halve()
+            self.doorkeeper.clear()
+            self.requests = 0
+
+    def estimate(self, key: typing.Hashable) -> int:
+        return self.sketch.estimate(key) + (key in self.doorkeeper)
+
+    def admit(self, candidate: typing.Hashable, victim: typing.Hashable) -> bool:
+        '''
+        Whether the candidate deserves the victim's slot
+        '''
+        return self.estimate(candidate) > self.estimate(victim)
+
+# endregion
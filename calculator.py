@@ -1,6 +1,8 @@
 import math
 import random
 import operator
+import functools
+import re
 from abc import ABC, abstractmethod
 from collections import UserDict
 import enum
@@ -306,6 +308,26 @@ def stringify(expression: Expr, add_brackets: bool = False) -> str:
         expr_s = expr_s[1:-1]
     return expr_s
 
+
+def is_deterministic(expression: Expr) -> bool:
+    '''
+    Function which checks whether an expression always evaluates to the same result.
+    An expression is deterministic if it doesn't call any of the NON_DETERMINISTIC_FUNCTIONS.
+    '''
+    stack = [type_fallback(expression)]
+    while stack:
+        expr = stack.pop()
+        if isinstance(expr, BinaryExpr):
+            stack.extend((expr.left_operand, expr.right_operand))
+        elif isinstance(expr, UnaryExpr):
+            stack.append(expr.operand)
+        elif isinstance(expr, FunctionCallExpr):
+            # Compare by name, unpickled functions are new objects
+            if expr.function.name in NON_DETERMINISTIC_FUNCTIONS:
+                return False
+            stack.extend(expr.args)
+    return True
+
 # endregion
 
 
@@ -366,4 +388,140 @@ FUNCTIONS.MIN = Function('min', min)
 FUNCTIONS.POW = Function('pow', pow)
 FUNCTIONS.RAND = Function('rand', random.uniform)
 
+# Names of the functions whose result may differ between calls with the same arguments
+NON_DETERMINISTIC_FUNCTIONS = {FUNCTIONS.RAND.name}
+
+# endregion
+
+
+# ========================================================================
+# ================================ Parser ================================
+# ========================================================================
+
+# region Parser
+
+# Binding power of the binary operators (higher binds tighter), and of the unary operators, which bind looser than
+# '**' like in Python: -2 ** 2 = -(2 ** 2), 2 ** -1 = 2 ** (-1)
+PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2, '%': 2, '**': 4}
+UNARY_PRECEDENCE = 3
+# Parsed texts kept by parse, repeated texts are not parsed again
+PARSE_CACHE_SIZE = 1024
+
+_TOKEN = re.compile(r'\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|(?P<name>[A-Za-z_]\w*)|(?P<symbol>\*\*|[-+*/%(),])|(?P<invalid>\S))')
+_BINARY_BY_SYMBOL = {op.symbol: op for op in BINARY_OPERATORS.values()}
+_UNARY_BY_SYMBOL = {op.symbol: op for op in UNARY_OPERATORS.values()}
+_FUNCTIONS_BY_NAME = {function.name.lower(): function for function in FUNCTIONS.values()}
+_CONSTANTS_BY_NAME = {name.lower(): constant for name, constant in NAMED_CONSTANTS.items()}
+
+
+def tokenize(text: str) -> list[tuple[str, str, int]]:
+    '''
+    Function which splits an infix expression into (kind, text, position) tokens, kind is number, name or symbol,
+    and the last token is ('end', '', len(text))
+    '''
+    tokens = []
+    for match in _TOKEN.finditer(text):
+        kind = match.lastgroup
+        if kind == 'invalid':
+            raise ValueError(f"Unexpected character '{match[kind]}' at position {match.start(kind)}")
+        tokens.append((kind, match[kind], match.start(kind)))
+    tokens.append(('end', '', len(text)))
+    return tokens
+
+
+class Parser:
+    '''
+    Precedence climbing parser of infix expressions, e.g. '3 + (4 * 2) / (1 - 5) ** 2 ** 3' or 'max(2, sin(pi))'.
+    The operators are the BINARY_OPERATORS and UNARY_OPERATORS, binding as in PRECEDENCE and associating like the
+    operators say ('**' is right-associative), the functions are the FUNCTIONS and the names the NAMED_CONSTANTS
+    (both case-insensitive).
+    '''
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def parse(self) -> Expression:
+        try:
+            expression = self.expression(0)
+        except RecursionError:
+            raise ValueError(f"The expression is nested too deeply ({len(self.text)} characters)") from None
+        if self.tokens[self.position][0] != 'end':
+            self.unexpected()
+        return expression
+
+    def expect(self, symbol: str) -> None:
+        if self.tokens[self.position][1] != symbol:
+            self.unexpected(f"expected '{symbol}'")
+        self.position += 1
+
+    def unexpected(self, expected: str = '') -> typing.NoReturn:
+        kind, text, position = self.tokens[self.position]
+        if kind == 'end':
+            raise ValueError(f"Unexpected end of the expression '{self.text}'")
+        raise ValueError(f"Unexpected '{text}' at position {position}" + (f", {expected}" if expected else ''))
+
+    def expression(self, min_precedence: int) -> Expression:
+        '''
+        Parses operands joined by binary operators binding at least as tight as min_precedence
+        '''
+        tokens = self.tokens
+        symbol = tokens[self.position][1]
+        if symbol in _UNARY_BY_SYMBOL:
+            self.position += 1
+            left = UnaryExpr(_UNARY_BY_SYMBOL[symbol], self.expression(UNARY_PRECEDENCE))
+        else:
+            left = self.primary()
+        while True:
+            symbol = tokens[self.position][1]
+            precedence = PRECEDENCE.get(symbol)
+            if precedence is None or precedence < min_precedence:
+                return left
+            self.position += 1
+            operator = _BINARY_BY_SYMBOL[symbol]
+            # A left-associative operator takes only tighter operators on its right, 1 - 2 - 3 = (1 - 2) - 3
+            right = self.expression(precedence if operator.associativity == Associativity.RIGHT else precedence + 1)
+            left = BinaryExpr(left, operator, right)
+
+    def primary(self) -> Expression:
+        kind, text, _ = self.tokens[self.position]
+        if kind == 'number':
+            self.position += 1
+            return Constant(float(text) if any(char in text for char in '.eE') else int(text))
+        if kind == 'name':
+            name = text.lower()
+            if self.tokens[self.position + 1][1] == '(':
+                if name not in _FUNCTIONS_BY_NAME:
+                    self.unexpected('unknown function')
+                self.position += 2
+                args = []
+                if self.tokens[self.position][1] != ')':
+                    args.append(self.expression(0))
+                    while self.tokens[self.position][1] == ',':
+                        self.position += 1
+                        args.append(self.expression(0))
+                self.expect(')')
+                return FunctionCallExpr(_FUNCTIONS_BY_NAME[name], *args)
+            if name not in _CONSTANTS_BY_NAME:
+                self.unexpected('unknown constant')
+            self.position += 1
+            return _CONSTANTS_BY_NAME[name]
+        if text == '(':
+            self.position += 1
+            expression = self.expression(0)
+            self.expect(')')
+            return expression
+        self.unexpected()
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse(text: str) -> Expression:
+    '''
+    Function which parses an infix expression (see Parser), raises a ValueError if it isn't one.
+    The last PARSE_CACHE_SIZE texts are cached, so repeated texts are parsed once (see parse.cache_info()).
+    The parsed expressions are shared, they must not be modified.
+    '''
+    return Parser(text).parse()
+
 # endregion
@@ -0,0 +1,106 @@
+import atexit
+import base64
+import hashlib
+import json
+import typing
+
+import api
+import logs
+
+# ========================================================================
+# ============================ Traffic Capture ===========================
+# ========================================================================
+
+# region Traffic Capture
+
+# What happened to a request in the proxy's cache
+OUTCOMES: typing.Final[tuple[str, ...]] = ('hit', 'stale_hit', 'miss', 'stale_miss')
+
+
+def key_digest(data: bytes, show_steps: bool) -> str:
+    '''
+    Function which returns a short digest of a cache key, so traces can be analysed without decoding the expressions
+    '''
+    return hashlib.blake2b(data + bytes([show_steps]), digest_size=8).hexdigest()
+
+
+def outcome(cache_hit: bool, was_stale: bool) -> str:
+    if cache_hit:
+        return 'stale_hit' if was_stale else 'hit'
+    return 'stale_miss' if was_stale else 'miss'
+
+
+class Recorder(logs.Writer):
+    '''
+    Appends the requests handled by the proxy to a trace file, one compact JSON object per line:
+    - t: when the request was received (unix time), key: digest of its cache key (see key_digest)
+    - data: the request data (the encoded expression) in base64, steps, cache, compress, method and cc: its flags and max-age
+    - outcome: one of OUTCOMES, cached: whether the response was cached, ms: the time the proxy took
+    - status, bytes, max_age and cacheable: the status code, packed length, max-age and cache flag of the response
+    Like the logs, the records are buffered and encoded in a background thread (see logs.Writer),
+    so recording only costs the proxy an append and the trace drops records rather than slowing it down.
+    '''
+
+    def __init__(self, path: str, capacity: int = logs.BUFFER_CAPACITY) -> None:
+        super().__init__(open(path, 'a', encoding='utf-8'), 'json', capacity)
+        self.path = path
+
+    def render(self, record: logs.Record) -> str:
+        timestamp, _, _, _, fields = record
+        request: api.CalculatorHeader = fields['request']
+        response: api.CalculatorHeader = fields['response']
+        return json.dumps({
+            't': round(timestamp, 6), 'key': key_digest(request.data, request.show_steps),
+            'data': base64.b64encode(request.data).decode('ascii'), 'steps': int(request.show_steps),
+            'cache': int(request.cache_result), 'compress': int(request.compressed), 'method': request.method,
+            'cc': request.cache_control, 'outcome': fields['outcome'], 'cached': int(fields['cached']),
+            'ms': round(fields['seconds'] * 1000, 3), 'status': response.status_code, 'bytes': response.total_length,
+            'max_age': response.cache_control, 'cacheable': int(response.cache_result)}, separators=(',', ':'))
+
+
+# The trace being recorded, if any
+recorder: typing.Optional[Recorder] = None
+
+
+def configure(path: typing.Optional[str]) -> None:
+    '''
+    Function which starts recording the handled requests to the path (None = not recorded)
+    '''
+    global recorder
+    recorder = Recorder(path) if path is not None else None
+    if recorder is not None:
+        atexit.register(recorder.flush)
+
+
+def record(request: api.CalculatorHeader, response: api.CalculatorHeader, cache_hit: bool, was_stale: bool,
+           cached: bool, received_at: float, seconds: float) -> None:
+    '''
+    Function which records a handled request, if a trace is being recorded
+    '''
+    if recorder is None or request.method == api.CalculatorHeader.METHOD_ADMIN:
+        return
+    recorder.append((received_at, 'info', 'capture', 'request', {
+        'request': request, 'response': response, 'outcome': outcome(cache_hit, was_stale), 'cached': cached,
+        'seconds': seconds}))
+
+
+def load(path: str) -> typing.Iterator[dict[str, typing.Any]]:
+    '''
+    Function which reads the records of a trace file in order, without loading the whole file
+    '''
+    with open(path, encoding='utf-8') as trace_file:
+        for line in trace_file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:  # a line cut short when the proxy was killed
+                continue
+
+
+def to_request(entry: dict[str, typing.Any]) -> api.CalculatorHeader:
+    '''
+    Function which rebuilds the request of a trace record
+    '''
+    return api.CalculatorHeader.from_request(base64.b64decode(entry['data']), bool(entry['steps']), bool(entry['cache']),
+                                             entry['cc'], bool(entry['compress']), entry['method'])
+
+# endregion
@@ -1,7 +1,18 @@
-import socket
-import api
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import numbers
+import select
+import socket
+import threading
+import time
+import typing
+
 import api
+import caching
+import datagram
+import tracing
 
 # region Predefined
 
@@ -32,58 +43,606 @@ rand_f = api.FUNCTIONS.RAND
 
 flag_quit = False
 
+# The example expressions that the interactive client lets you choose from (see the examples in the main block)
+EXAMPLE_EXPRESSIONS = [
+    # mul_b(div_b(sin_f(max_f(2, mul_b(3, 4), 5, mul_b(div_b(mul_b(7, 8), 9)), div_b(10, 11))), 12), 13),
+    add_b(max_f(2, 3), 3),
+    add_b(3, div_b(mul_b(4, 2), pow_b(sub_b(1, 5), pow_b(2, 3)))),
+    div_b(pow_b(add_b(1, 2), mul_b(3, 4)), mul_b(5, 6)),
+    neg_u(neg_u(pow_b(add_b(1, add_b(2, 3)), neg_u(add_b(4, 5))))),
+    max_f(2, mul_b(3, 4), log_f(e_c), mul_b(6, 7), div_b(9, 8))
+]
+
 
 # endregion
 
 
-def process_response(response: api.CalculatorHeader) -> None:
+# ========================================================================
+# ============================ Client Library ============================
+# ========================================================================
+
+# region Client Library
+
+# Persistent connections to the proxy, and requests waiting for their response on each connection
+CONNECTIONS = 4
+PIPELINE_DEPTH = 16
+# Seconds a request may wait for its response, and how many times it's resent after its connection broke
+TIMEOUT = 10.0
+RETRIES = 1
+# Longest a connection's reader waits for responses before it checks the deadlines of its requests
+DEADLINE_CHECK_INTERVAL = 0.1
+# Responses kept by a private cache (see PrivateCache)
+PRIVATE_CACHE_SIZE = 256
+
+Result = tuple[numbers.Real, list[str]]
+# An expression tree, or an infix text parsed by the server (e.g. '3 + (4*2)/(1-5)**2**3', see calculator.Parser)
+ExpressionOrText = typing.Union[api.Expression, str]
+
+
+def result_of(response: api.CalculatorHeader) -> Result:
+    '''
+    Function which returns the result and steps of a response, or raises the error it carries
+    '''
     if response.is_request:
         raise api.CalculatorClientError("Got a request instead of a response")
     if response.status_code == api.CalculatorHeader.STATUS_OK:
-        result, steps = api.data_to_result(response)
-        print("Result:", result)
-        if steps:
-            print("Steps:")
-            expr, first, *rest = steps
-            print(f"{expr} = {first}", end="\n" * (not bool(rest)))
-            if rest:
-                print(
-                    "".join(map(lambda v: f"\n{' ' * len(expr)} = {v}", rest)))
+        return api.data_to_result(response)
     elif response.status_code == api.CalculatorHeader.STATUS_CLIENT_ERROR:
         err = api.data_to_error(response)
         raise api.CalculatorClientError(err)
     elif response.status_code == api.CalculatorHeader.STATUS_SERVER_ERROR:
         err = api.data_to_error(response)
         raise api.CalculatorServerError(err)
+    elif response.status_code == api.CalculatorHeader.STATUS_OVERLOADED:
+        raise api.CalculatorServerError("Server is overloaded, try again later")
     else:
         raise api.CalculatorClientError(
             f"Unknown status code: {response.status_code}")
 
 
-def client(server_address: tuple[str, int], expressions_list: list[api.Expression], show_steps: bool = False,
-           cache_result: bool = False, cache_control: int = api.CalculatorHeader.MAX_CACHE_CONTROL) -> None:
-    server_prefix = f"{{{server_address[0]}:{server_address[1]}}}"
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-        client_socket.connect(server_address)
-        print(f"{server_prefix} Connection established")
-        for expression in expressions_list:
+def print_result(result: numbers.Real, steps: list[str]) -> None:
+    print("Result:", result)
+    if steps:
+        print("Steps:")
+        expr, first, *rest = steps
+        print(f"{expr} = {first}", end="\n" * (not bool(rest)))
+        if rest:
+            print(
+                "".join(map(lambda v: f"\n{' ' * len(expr)} = {v}", rest)))
+
+
+def process_response(response: api.CalculatorHeader) -> None:
+    print_result(*result_of(response))
+
+
+class PrivateCache:
+    '''
+    A client's own cache of results, by expression and whether they have steps, so repeated expressions are answered
+    without a round trip. The freshness rules are the proxy's (see api.time_remaining): a response is used while it's
+    fresh both for the server (its max-age) and for the request (the max-age it accepts), MAX_CACHE_CONTROL never expires,
+    and a max-age of 0 on either side (or a cache flag not set) means the response isn't stored. Errors are never stored.
+    It may be shared by several clients, e.g. by the sessions of a program, hits and misses count the requests
+    it answered and the requests it didn't.
+    '''
+
+    def __init__(self, capacity: int = PRIVATE_CACHE_SIZE) -> None:
+        self.responses: caching.LRUCache[tuple[bytes, bool], api.CalculatorHeader] = caching.LRUCache(capacity)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, request: api.CalculatorHeader) -> typing.Optional[Result]:
+        '''
+        Returns the result of a fresh cached response to the request, or None
+        '''
+        request, _ = request.split_traced()
+        response = self.responses.get((request.data, request.show_steps)) if request.cache_control != 0 else None
+        fresh = response is not None and min(api.time_remaining(request, response)) > 0
+        with self.lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return api.data_to_result(response) if fresh else None
+
+    def store(self, request: api.CalculatorHeader, response: api.CalculatorHeader) -> None:
+        request, _ = request.split_traced()
+        if response.status_code != api.CalculatorHeader.STATUS_OK or not (request.cache_result and response.cache_result):
+            return
+        if min(api.time_remaining(request, response)) > 0:
+            self.responses.put((request.data, request.show_steps), response)
+
+
+class Pending:
+    '''
+    A request of a client and the future of its result, until its response arrives, its deadline passes,
+    or it can't be sent anymore
+    '''
+
+    def __init__(self, future: typing.Union[concurrent.futures.Future, asyncio.Future], request: api.CalculatorHeader,
+                 timeout: float, retries: int, span: typing.Union[tracing.Span, tracing.NoSpan]) -> None:
+        self.future = future
+        self.request = request
+        self.packed = request.pack()
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout
+        self.retries = retries
+        self.span = span
+
+    def settle(self, result: typing.Optional[Result] = None, error: typing.Optional[BaseException] = None) -> None:
+        if self.future.done():
+            return
+        try:
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+        except (concurrent.futures.InvalidStateError, asyncio.InvalidStateError):  # settled by another thread meanwhile
+            pass
+        self.span.finish()
+
+    def expire(self) -> None:
+        self.settle(error=TimeoutError(f"No response within {self.timeout} seconds"))
+
+
+class BaseClient:
+    '''
+    What the sync and asyncio clients share: the default options of the requests, and turning responses into results
+    '''
+
+    def __init__(self, address: tuple[str, int], connections: int = CONNECTIONS, pipeline_depth: int = PIPELINE_DEPTH,
+                 timeout: float = TIMEOUT, retries: int = RETRIES, show_steps: bool = False, cache_result: bool = True,
+                 cache_control: int = api.CalculatorHeader.MAX_CACHE_CONTROL, accept_compression: bool = True,
+                 trace: bool = False, cache: typing.Optional[PrivateCache] = None) -> None:
+        if connections < 1 or pipeline_depth < 1:
+            raise ValueError("A client needs at least one connection and one request per connection")
+        self.address = address
+        self.max_connections = connections
+        self.pipeline_depth = pipeline_depth
+        self.timeout = timeout
+        self.retries = retries
+        self.show_steps = show_steps
+        self.cache_result = cache_result
+        self.cache_control = cache_control
+        self.accept_compression = accept_compression
+        self.trace = trace
+        self.cache = cache
+        self.closed = False
+
+    def request(self, expression: ExpressionOrText, show_steps: typing.Optional[bool], cache_result: typing.Optional[bool],
+                cache_control: typing.Optional[int]) -> tuple[api.CalculatorHeader, typing.Union[tracing.Span, tracing.NoSpan]]:
+        '''
+        Builds the request for an expression, options left to None take the client's default.
+        Texts are sent as they are, in the text format (see api.CalculatorHeader.from_text).
+        If the client traces its requests, every request starts a new trace, which the proxy and server continue (see tracing).
+        '''
+        text = isinstance(expression, str)
+        request = (api.CalculatorHeader.from_text if text else api.CalculatorHeader.from_expression)(
+            expression, self.show_steps if show_steps is None else show_steps,
+            self.cache_result if cache_result is None else cache_result,
+            self.cache_control if cache_control is None else cache_control, self.accept_compression)
+        span = tracing.request((tracing.new_id(), 0), expression=expression if text else api.stringify(expression)) \
+            if self.trace else tracing.NO_SPAN
+        # The proxy's spans are children of our request span
+        return tracing.traced(request, self.address, span.context), span
+
+    def answer_from_cache(self, pending: Pending) -> bool:
+        '''
+        Settles the future of a request with a fresh response of the private cache, returns whether there was one
+        '''
+        result = self.cache.lookup(pending.request) if self.cache is not None else None
+        if result is None:
+            return False
+        pending.settle(result)
+        return True
+
+    def resolve(self, pending: Pending, message: bytes) -> None:
+        '''
+        Settles the future of a request with its response
+        '''
+        try:
+            response = api.CalculatorHeader.unpack(message)
+            tracing.negotiate(self.address, pending.request, response)
+            result = result_of(response)
+            if self.cache is not None:
+                self.cache.store(pending.request, response)
+        except Exception as e:
+            pending.settle(error=e)
+        else:
+            pending.settle(result)
+
+    def failed(self, pending: Pending, error: BaseException) -> bool:
+        '''
+        Settles the future of a request that lost its connection if it can't be sent again, returns whether it was
+        '''
+        if pending.future.done():
+            return True
+        if time.monotonic() >= pending.deadline:
+            pending.expire()
+            return True
+        if self.closed or pending.retries <= 0:
+            pending.settle(error=error)
+            return True
+        pending.retries -= 1
+        return False
+
+
+class Connection:
+    '''
+    A persistent connection of a Client. Its requests are sent back to back without waiting for the previous responses
+    (pipelining) and the proxy answers them in order, so a reader thread matches the responses to the oldest requests.
+    If the oldest request times out the connection is dropped, since the responses behind it can't arrive before it,
+    and the other requests are sent again on another connection.
+    '''
+
+    def __init__(self, client: 'Client') -> None:
+        self.client = client
+        self.socket = socket.create_connection(client.address, timeout=client.timeout)
+        self.socket.settimeout(None)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pending: collections.deque[Pending] = collections.deque()
+        self.closed = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def send(self, pending: Pending) -> bool:
+        '''
+        Sends the request, returns False if the connection is closed
+        '''
+        with self.lock:
+            if self.closed:
+                return False
+            # The order of the pending requests is the order on the wire
+            self.pending.append(pending)
             try:
-                request = api.CalculatorHeader.from_expression(
-                    expression, show_steps, cache_result, cache_control)
+                self.socket.sendall(pending.packed)
+                return True
+            except OSError as e:
+                error = e
+        self.abort(error)
+        return True
+
+    def read(self) -> None:
+        buffer = bytearray()
+        try:
+            while True:
+                readable, _, _ = select.select([self.socket], [], [], DEADLINE_CHECK_INTERVAL)
+                if readable:
+                    data = self.socket.recv(api.BUFFER_SIZE)
+                    if not data:
+                        raise ConnectionResetError("The proxy closed the connection")
+                    buffer += data
+                    for message in api.split_messages(buffer):
+                        with self.lock:
+                            if not self.pending:
+                                raise ConnectionError("Got a response without a request")
+                            pending = self.pending.popleft()
+                        self.client.resolve(pending, message)
+                self.check_deadlines()
+        except (OSError, ValueError) as e:  # ValueError: the socket was closed while waiting
+            self.abort(e)
+
+    def check_deadlines(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            expired = [pending for pending in self.pending if pending.deadline <= now]
+            head_expired = bool(self.pending) and self.pending[0].deadline <= now
+        for pending in expired:
+            pending.expire()
+        if head_expired:
+            self.abort(TimeoutError("The oldest request on the connection timed out"))
+
+    def abort(self, error: BaseException) -> None:
+        '''
+        Closes the connection, its requests are sent again on another connection (or fail with the error)
+        '''
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = list(self.pending), collections.deque()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        for request in pending:
+            if not self.client.failed(request, error):
+                self.client.dispatch(request)
+
+
+class Client(BaseClient):
+    '''
+    A thread-safe client of a proxy (or server) over up to `connections` persistent connections.
+    submit sends the request right away and returns a future of its result (or error), so many requests can be
+    in flight at once: each connection carries up to `pipeline_depth` requests, submit blocks while all are full.
+    Requests are spread over the connections, new connections are opened while the existing ones are busy,
+    and broken connections are replaced, their requests are sent again up to `retries` times
+    (evaluating an expression has no side effects, so that's always safe).
+    '''
+
+    def __init__(self, address: tuple[str, int], **options: typing.Any) -> None:
+        super().__init__(address, **options)
+        self.connections: list[Connection] = []
+        self.slots = threading.BoundedSemaphore(self.max_connections * self.pipeline_depth)
+        self.lock = threading.Lock()
+
+    def submit(self, expression: ExpressionOrText, show_steps: typing.Optional[bool] = None,
+               cache_result: typing.Optional[bool] = None, cache_control: typing.Optional[int] = None,
+               timeout: typing.Optional[float] = None) -> concurrent.futures.Future:
+        '''
+        Sends the expression and returns the future of its result and steps, options left to None take the client's default
+        '''
+        request, span = self.request(expression, show_steps, cache_result, cache_control)
+        return self.submit_request(request, timeout, span)
+
+    def submit_request(self, request: api.CalculatorHeader, timeout: typing.Optional[float] = None,
+                       span: typing.Union[tracing.Span, tracing.NoSpan] = tracing.NO_SPAN) -> concurrent.futures.Future:
+        '''
+        Sends a request built by the caller (e.g. a recorded request, see capture) and returns the future of its result and steps
+        '''
+        if self.closed:
+            raise RuntimeError("The client is closed")
+        timeout = self.timeout if timeout is None else timeout
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if self.answer_from_cache(Pending(future, request, timeout, 0, span)):
+            return future
+        if not self.slots.acquire(timeout=timeout):
+            future.set_exception(TimeoutError(f"No connection was free within {timeout} seconds"))
+            return future
+        future.add_done_callback(lambda _: self.slots.release())
+        self.dispatch(Pending(future, request, timeout, self.retries, span))
+        return future
+
+    def submit_many(self, expressions: typing.Iterable[ExpressionOrText], **options: typing.Any) -> list[concurrent.futures.Future]:
+        '''
+        Sends the expressions one after the other without waiting for the responses, and returns the futures of their results
+        '''
+        return [self.submit(expression, **options) for expression in expressions]
+
+    def calculate(self, expression: ExpressionOrText, **options: typing.Any) -> Result:
+        return self.submit(expression, **options).result()
+
+    def dispatch(self, pending: Pending) -> None:
+        '''
+        Sends the request on the least busy connection, opening a new one if they are all busy and we may
+        '''
+        while not pending.future.done():
+            with self.lock:
+                self.connections = [connection for connection in self.connections if not connection.closed]
+                connection = min(self.connections, key=lambda connection: len(connection.pending), default=None)
+                if connection is None or (connection.pending and len(self.connections) < self.max_connections):
+                    try:
+                        connection = Connection(self)
+                    except OSError as e:
+                        pending.settle(error=e)
+                        return
+                    self.connections.append(connection)
+            if connection.send(pending):
+                return
+
+    def close(self) -> None:
+        '''
+        Closes the connections, the requests still waiting for a response fail
+        '''
+        self.closed = True
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.abort(ConnectionAbortedError("The client was closed"))
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.close()
+
+
+class DatagramClient(Client):
+    '''
+    A client of a proxy (or server) started with --udp, sending every request that fits as a UDP datagram,
+    so a short session doesn't pay for a TCP handshake. Lost requests and answers are sent again (see datagram.Channel).
+    Requests and responses too large for a datagram go over the persistent connections of a Client instead.
+    '''
+
+    def __init__(self, address: tuple[str, int], **options: typing.Any) -> None:
+        super().__init__(address, **options)
+        self.channel = datagram.Channel(address)
+
+    def submit_request(self, request: api.CalculatorHeader, timeout: typing.Optional[float] = None,
+                       span: typing.Union[tracing.Span, tracing.NoSpan] = tracing.NO_SPAN) -> concurrent.futures.Future:
+        if self.closed:
+            raise RuntimeError("The client is closed")
+        timeout = self.timeout if timeout is None else timeout
+        pending = Pending(concurrent.futures.Future(), request, timeout, self.retries, span)
+        if not datagram.fits(pending.packed):
+            return super().submit_request(request, timeout, span)
+        if self.answer_from_cache(pending):
+            return pending.future
+        self.channel.submit(pending.packed, timeout).add_done_callback(lambda answer: self.answered(pending, answer))
+        return pending.future
+
+    def answered(self, pending: Pending, answer: concurrent.futures.Future) -> None:
+        error = answer.exception()
+        if error is not None:
+            pending.settle(error=error)
+        elif answer.result():
+            self.resolve(pending, answer.result())
+        else:
+            # The response doesn't fit in a datagram, ask for it over TCP without holding up the channel's reader
+            threading.Thread(target=self.dispatch, args=(pending,), daemon=True).start()
+
+    def close(self) -> None:
+        super().close()
+        self.channel.close()
+
+    def __enter__(self) -> 'DatagramClient':
+        return self
+
+
+class AsyncConnection:
+    '''
+    A persistent connection of an AsyncClient, pipelined like a Connection, a reader task matches the responses to the requests
+    '''
+
+    def __init__(self, client: 'AsyncClient', reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.client = client
+        self.reader = reader
+        self.writer = writer
+        self.pending: collections.deque[Pending] = collections.deque()
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self.read())
+
+    def send(self, pending: Pending) -> bool:
+        if self.closed:
+            return False
+        self.pending.append(pending)
+        self.writer.write(pending.packed)
+        asyncio.get_running_loop().call_later(pending.timeout, self.expire, pending)
+        return True
+
+    async def read(self) -> None:
+        try:
+            while True:
+                header = await self.reader.readexactly(api.CalculatorHeader.HEADER_MIN_LENGTH)
+                rest = await self.reader.readexactly(api.message_length(header) - len(header))
+                if not self.pending:
+                    raise ConnectionError("Got a response without a request")
+                self.client.resolve(self.pending.popleft(), header + rest)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.abort(e)
+
+    def expire(self, pending: Pending) -> None:
+        pending.expire()
+        # The responses behind the oldest request can't arrive before it
+        if self.pending and self.pending[0] is pending:
+            self.abort(TimeoutError("The oldest request on the connection timed out"))
+
+    def abort(self, error: BaseException) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        pending, self.pending = list(self.pending), collections.deque()
+        self.writer.close()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        for request in pending:
+            if not self.client.failed(request, error):
+                self.client.retry(request)
+
+
+class AsyncClient(BaseClient):
+    '''
+    The asyncio flavour of Client, with the same options and behaviour, to be used from a running event loop
+    '''
+
+    def __init__(self, address: tuple[str, int], **options: typing.Any) -> None:
+        super().__init__(address, **options)
+        self.connections: list[AsyncConnection] = []
+        self.slots: typing.Optional[asyncio.Semaphore] = None
+        self.lock: typing.Optional[asyncio.Lock] = None
+        self.retrying: set[asyncio.Task] = set()
+
+    async def submit(self, expression: ExpressionOrText, show_steps: typing.Optional[bool] = None,
+                     cache_result: typing.Optional[bool] = None, cache_control: typing.Optional[int] = None,
+                     timeout: typing.Optional[float] = None) -> asyncio.Future:
+        '''
+        Sends the expression and returns the future of its result and steps, it only waits while all the connections are full
+        '''
+        request, span = self.request(expression, show_steps, cache_result, cache_control)
+        return await self.submit_request(request, timeout, span)
+
+    async def submit_request(self, request: api.CalculatorHeader, timeout: typing.Optional[float] = None,
+                             span: typing.Union[tracing.Span, tracing.NoSpan] = tracing.NO_SPAN) -> asyncio.Future:
+        if self.closed:
+            raise RuntimeError("The client is closed")
+        if self.slots is None:  # created here, so they belong to the running loop
+            self.slots = asyncio.Semaphore(self.max_connections * self.pipeline_depth)
+            self.lock = asyncio.Lock()
+        timeout = self.timeout if timeout is None else timeout
+        future = asyncio.get_running_loop().create_future()
+        if self.answer_from_cache(Pending(future, request, timeout, 0, span)):
+            return future
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            future.set_exception(TimeoutError(f"No connection was free within {timeout} seconds"))
+            return future
+        future.add_done_callback(lambda _: self.slots.release())
+        await self.dispatch(Pending(future, request, timeout, self.retries, span))
+        return future
+
+    async def submit_many(self, expressions: typing.Iterable[ExpressionOrText], **options: typing.Any) -> list[asyncio.Future]:
+        return [await self.submit(expression, **options) for expression in expressions]
+
+    async def calculate(self, expression: ExpressionOrText, **options: typing.Any) -> Result:
+        return await (await self.submit(expression, **options))
+
+    async def dispatch(self, pending: Pending) -> None:
+        while not pending.future.done():
+            async with self.lock:
+                self.connections = [connection for connection in self.connections if not connection.closed]
+                connection = min(self.connections, key=lambda connection: len(connection.pending), default=None)
+                if connection is None or (connection.pending and len(self.connections) < self.max_connections):
+                    try:
+                        reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), pending.timeout)
+                    except (OSError, asyncio.TimeoutError) as e:
+                        pending.settle(error=e)
+                        return
+                    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    connection = AsyncConnection(self, reader, writer)
+                    self.connections.append(connection)
+            if connection.send(pending):
+                try:
+                    await connection.writer.drain()
+                except OSError as e:
+                    connection.abort(e)
+                return
+
+    def retry(self, pending: Pending) -> None:
+        task = asyncio.get_running_loop().create_task(self.dispatch(pending))
+        self.retrying.add(task)
+        task.add_done_callback(self.retrying.discard)
+
+    async def close(self) -> None:
+        self.closed = True
+        connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.abort(ConnectionAbortedError("The client was closed"))
+
+    async def __aenter__(self) -> 'AsyncClient':
+        return self
+
+    async def __aexit__(self, *exc_info: typing.Any) -> None:
+        await self.close()
 
-                request = request.pack()
-                print(f"{server_prefix} Sending request of length {len(request)} bytes")
-                client_socket.sendall(request)
+# endregion
 
-                response = client_socket.recv(api.BUFFER_SIZE)
-                print(f"{server_prefix} Got response of length {len(response)} bytes")
-                response = api.CalculatorHeader.unpack(response)
-                process_response(response)
 
+def client(server_address: tuple[str, int], expressions_list: list[ExpressionOrText], show_steps: bool = False,
+           cache_result: bool = False, cache_control: int = api.CalculatorHeader.MAX_CACHE_CONTROL,
+           accept_compression: bool = True, trace: bool = False, udp: bool = False,
+           cache: typing.Optional[PrivateCache] = None) -> None:
+    '''
+    Function which sends the expressions over one pipelined connection and prints the responses (see Client)
+    If trace is set, every request starts a new trace, which the proxy and server continue (see tracing).
+    If udp is set, the requests are sent as datagrams when they fit (see DatagramClient).
+    If a cache is given, fresh results it holds (e.g. from earlier calls) are printed without sending the requests.
+    '''
+    server_prefix = f"{{{server_address[0]}:{server_address[1]}}}"
+    with (DatagramClient if udp else Client)(server_address, connections=1, show_steps=show_steps, cache_result=cache_result,
+                cache_control=cache_control, accept_compression=accept_compression, trace=trace,
+                cache=cache) as calculator_client:
+        print(f"{server_prefix} Sending {len(expressions_list)} requests")
+        for future in calculator_client.submit_many(expressions_list):
+            try:
+                print_result(*future.result())
             except api.CalculatorError as e:
                 print(f"{server_prefix} Got error: {str(e)}")
             except Exception as e:
                 print(f"{server_prefix} Unexpected error: {str(e)}")
+    if cache is not None:
+        print(f"{server_prefix} Private cache: {cache.hits} hits, {cache.misses} misses")
     print(f"{server_prefix} Connection closed")
 
 
@@ -108,12 +667,21 @@ if __name__ == "__main__":
     arg_parser.add_argument("-p", "--port", type=int,
                             default=api.DEFAULT_PROXY_PORT, help="The port to connect to.")
     arg_parser.add_argument("-H", "--host", type=str,
-                            default=api.DEFAULT_PROXY_PORT, help="The host to connect to.")
+                            default=api.DEFAULT_PROXY_HOST, help="The host to connect to.")
+
+    arg_parser.add_argument("--trace_file", type=str, default=None,
+                            help="Trace the requests and append their spans to this file (see tracing.py, default: not traced).")
+    arg_parser.add_argument("--udp", action="store_true",
+                            help="Send the requests as UDP datagrams when they fit, the proxy must be started with --udp.")
+    arg_parser.add_argument("--private_cache", type=int, default=0,
+                            help="Keep up to this many results in a private cache shared by the sessions (default: 0, no cache).")
 
     args = arg_parser.parse_args()
+    tracing.configure('client', args.trace_file)
 
     host = args.host
     port = args.port
+    private_cache = PrivateCache(args.private_cache) if args.private_cache > 0 else None
 
     # * Change in start (1)
     # Example expressions: (uncomment one of them for your needs)
@@ -149,14 +717,7 @@ if __name__ == "__main__":
     """
         List of expressions to choose from. 
     """
-    exprList = [
-        # mul_b(div_b(sin_f(max_f(2, mul_b(3, 4), 5, mul_b(div_b(mul_b(7, 8), 9)), div_b(10, 11))), 12), 13),
-        add_b(max_f(2, 3), 3),
-        add_b(3, div_b(mul_b(4, 2), pow_b(sub_b(1, 5), pow_b(2, 3)))),
-        div_b(pow_b(add_b(1, 2), mul_b(3, 4)), mul_b(5, 6)),
-        neg_u(neg_u(pow_b(add_b(1, add_b(2, 3)), neg_u(add_b(4, 5))))),
-        max_f(2, mul_b(3, 4), log_f(e_c), mul_b(6, 7), div_b(9, 8))
-    ]
+    exprList = EXAMPLE_EXPRESSIONS
 
     """
         making an expressions list to send to the server.
@@ -179,8 +740,8 @@ if __name__ == "__main__":
             expr = input("EXP: ")
 
         try:
-            client((api.DEFAULT_PROXY_HOST, api.DEFAULT_PROXY_PORT), expToSend, show_steps, cache_result,
-                    cache_control)
+            client((host, port), expToSend, show_steps, cache_result,
+                    cache_control, trace=args.trace_file is not None, udp=args.udp, cache=private_cache)
         except Exception as e:
             print("illegal value")
             print(e)
@@ -191,5 +752,5 @@ if __name__ == "__main__":
 
     terminate = input("Type -1 to terminate proxy.py, server.py, client.py: ")
     if terminate == "-1":
-        closing_message((api.DEFAULT_PROXY_HOST, api.DEFAULT_PROXY_PORT))
+        closing_message((host, port))
     # * Change in end (2)
@@ -0,0 +1,300 @@
+import collections
+import concurrent.futures
+import itertools
+import random
+import select
+import socket
+import struct
+import threading
+import time
+import typing
+
+import api
+import logs
+import workers
+
+# ========================================================================
+# =========================== Datagram Transport =========================
+# ========================================================================
+
+# region Datagram Transport
+
+'''
+Requests and responses can also be sent as UDP datagrams, which saves the TCP handshake of short sessions.
+A datagram is a request ID followed by one message of the protocol (a packed CalculatorHeader), and the answer
+to a request is a datagram with the same ID followed by the response:
+ 0                   1                   2                   3
+ 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
++-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+|                           Request ID                          |
++-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+|                   Message (header and data)                   |
++-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+An answer of the request ID alone means the response doesn't fit in a datagram, the request should be sent over TCP
+(like DNS's truncated answers). Requests that don't fit are sent over TCP right away.
+'''
+
+ID_FORMAT: typing.Final[str] = '!L'
+ID_LENGTH: typing.Final[int] = struct.calcsize(ID_FORMAT)
+MAX_ID: typing.Final[int] = 2**32 - 1
+# The largest datagram we send, an Ethernet frame (1500 bytes) without the IP and UDP headers, so it's never fragmented
+DATAGRAM_SIZE = 1472
+# Seconds before an unanswered request is sent again (doubled every time), and how many times it's sent again
+RETRANSMIT_AFTER = 0.2
+RETRANSMISSIONS = 3
+# Seconds a request may wait for its answer, evaluations taking longer should go over TCP
+TIMEOUT = 5.0
+# Answers kept by a server for the retransmissions of their requests
+RECENT_ANSWERS = 4096
+# Longest a channel's reader waits for answers before it checks the retransmissions
+CHECK_INTERVAL = 0.05
+
+log = logs.get_logger('datagram')
+
+
+def fits(message: bytes) -> bool:
+    '''
+    Function which checks whether the message fits in a datagram
+    '''
+    return len(message) + ID_LENGTH <= DATAGRAM_SIZE
+
+
+def pack(request_id: int, message: bytes) -> bytes:
+    return struct.pack(ID_FORMAT, request_id) + message
+
+
+def unpack(datagram: bytes) -> tuple[int, bytes]:
+    if len(datagram) < ID_LENGTH:
+        raise ValueError(f'The datagram is too short ({len(datagram)} bytes) to hold a request ID')
+    return struct.unpack_from(ID_FORMAT, datagram)[0], datagram[ID_LENGTH:]
+
+
+class Outstanding:
+    '''
+    A request sent on a channel, until it's answered or it times out
+    '''
+
+    def __init__(self, datagram: bytes, timeout: float, retransmit_after: float, retransmissions: int) -> None:
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.datagram = datagram
+        self.deadline = time.monotonic() + timeout
+        self.interval = retransmit_after
+        self.next_at = time.monotonic() + retransmit_after
+        self.retransmissions = retransmissions
+
+    def settle(self, answer: typing.Optional[bytes] = None, error: typing.Optional[BaseException] = None) -> None:
+        try:
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(answer)
+        except concurrent.futures.InvalidStateError:
+            pass
+
+
+class Channel:
+    '''
+    A UDP socket to a server or proxy, shared by the threads sending it requests.
+    A reader thread matches the answers to their requests by ID, so answers arriving late, twice (to a retransmitted
+    request) or out of order are handled, and sends again the requests not answered after RETRANSMIT_AFTER seconds
+    (doubling the wait every time) at most RETRANSMISSIONS more times. A request fails once its timeout passed.
+    '''
+
+    def __init__(self, address: tuple[str, int], retransmit_after: float = RETRANSMIT_AFTER,
+                 retransmissions: int = RETRANSMISSIONS) -> None:
+        self.address = address
+        self.retransmit_after = retransmit_after
+        self.retransmissions = retransmissions
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(address)
+        self.outstanding: dict[int, Outstanding] = {}
+        self.ids = itertools.count(random.getrandbits(32))  # IDs of an earlier channel on the same port are unlikely
+        self.closed = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def submit(self, message: bytes, timeout: float = TIMEOUT) -> concurrent.futures.Future:
+        '''
+        Sends the message and returns the future of the answer, empty if the response doesn't fit in a datagram
+        '''
+        if not fits(message):
+            raise ValueError(f'The message is too long ({len(message)} bytes) for a datagram')
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The channel is closed")
+            request_id = next(self.ids) & MAX_ID
+            outstanding = self.outstanding[request_id] = Outstanding(
+                pack(request_id, message), timeout, self.retransmit_after, self.retransmissions)
+        self.send(request_id, outstanding)
+        return outstanding.future
+
+    def exchange(self, message: bytes, timeout: float = TIMEOUT) -> bytes:
+        '''
+        Sends the message and waits for the answer (see submit)
+        '''
+        return self.submit(message, timeout).result()
+
+    def send(self, request_id: int, outstanding: Outstanding) -> None:
+        try:
+            self.socket.send(outstanding.datagram)
+        except OSError as e:
+            self.fail(request_id, e)
+
+    def fail(self, request_id: int, error: BaseException) -> None:
+        with self.lock:
+            outstanding = self.outstanding.pop(request_id, None)
+        if outstanding is not None:
+            outstanding.settle(error=error)
+
+    def read(self) -> None:
+        while not self.closed:
+            try:
+                readable, _, _ = select.select([self.socket], [], [], CHECK_INTERVAL)
+                if readable:
+                    request_id, answer = unpack(self.socket.recv(api.BUFFER_SIZE))
+                    with self.lock:
+                        outstanding = self.outstanding.pop(request_id, None)
+                    if outstanding is not None:  # None: a late answer to a request answered or failed already
+                        outstanding.settle(answer)
+            except ConnectionRefusedError as e:  # nothing listens on the port, the requests sent so far are lost
+                with self.lock:
+                    refused, self.outstanding = list(self.outstanding.values()), {}
+                for outstanding in refused:
+                    outstanding.settle(error=e)
+            except ValueError:  # a datagram too short to be an answer, or the socket was closed while waiting
+                continue
+            except OSError:
+                if self.closed:
+                    return
+            self.retransmit()
+
+    def retransmit(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            due = [(request_id, outstanding) for request_id, outstanding in self.outstanding.items()
+                   if outstanding.next_at <= now or outstanding.deadline <= now]
+        for request_id, outstanding in due:
+            if outstanding.deadline <= now:
+                self.fail(request_id, TimeoutError(f"No answer from {self.address[0]}:{self.address[1]}"))
+                continue
+            if outstanding.retransmissions <= 0:  # sent for the last time, the answer may still come until the deadline
+                outstanding.next_at = outstanding.deadline
+                continue
+            outstanding.retransmissions -= 1
+            outstanding.interval *= 2
+            outstanding.next_at = now + outstanding.interval
+            self.send(request_id, outstanding)
+
+    def close(self) -> None:
+        '''
+        Closes the socket, the requests still waiting for an answer fail
+        '''
+        with self.lock:
+            self.closed = True
+            closed, self.outstanding = list(self.outstanding.values()), {}
+        for outstanding in closed:
+            outstanding.settle(error=ConnectionAbortedError("The channel was closed"))
+        self.socket.close()
+
+
+# Channels of the servers a process sends datagrams to
+_channels: dict[tuple[str, int], Channel] = {}
+_channels_lock = threading.Lock()
+
+
+def channel_for(address: tuple[str, int]) -> Channel:
+    '''
+    Function which returns the channel to the address, opening it on first use
+    '''
+    with _channels_lock:
+        if address not in _channels:
+            _channels[address] = Channel(address)
+        return _channels[address]
+
+
+class DatagramWorkers(workers.WorkerPool):
+    '''
+    The worker pool of a DatagramServer, its items are received requests, and shed requests are answered with 503
+    '''
+
+    def __init__(self, server: 'DatagramServer', max_workers: int, queue_depth: int, shed_after: float) -> None:
+        super().__init__(server.handle, (), max_workers, queue_depth, shed_after)
+        self.server = server
+
+    def reject(self, item: tuple[tuple[tuple[str, int], int], bytes]) -> None:
+        with self.lock:
+            self.shed += 1
+        key, _ = item
+        self.server.answer(key, workers.overloaded_response())
+
+
+class DatagramServer:
+    '''
+    Serves the protocol over UDP on the address of a TCP listener. The requests are handled by a worker pool like the
+    connections are: handler(message, client, send, *args) handles a request and sends its response with send.
+    The answers of recent requests are kept, so a retransmitted request is answered again without being handled twice
+    (and is ignored while it's being handled).
+    '''
+
+    def __init__(self, address: tuple[str, int], handler: typing.Callable[..., None], args: tuple = (),
+                 max_workers: int = 64, queue_depth: int = 128, shed_after: float = 1.0) -> None:
+        self.handler = handler
+        self.args = args
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.pool = DatagramWorkers(self, max_workers, queue_depth, shed_after)
+        # (client address, request ID) -> the answer, None while the request is being handled
+        self.answers: collections.OrderedDict[tuple[tuple[str, int], int], typing.Optional[bytes]] = collections.OrderedDict()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                datagram, address = self.socket.recvfrom(api.BUFFER_SIZE)
+                request_id, message = unpack(datagram)
+            except ValueError:
+                continue
+            except OSError:  # closed
+                return
+            key = (address, request_id)
+            with self.lock:
+                retransmitted = key in self.answers
+                answer = self.answers.get(key)
+                if not retransmitted:
+                    self.answers[key] = None
+                    if len(self.answers) > RECENT_ANSWERS:
+                        self.answers.popitem(last=False)
+            if retransmitted:
+                if answer is not None:
+                    self.sendto(answer, address)
+                continue
+            if not self.pool.submit((key, message), address):
+                log.warning("Overloaded, rejected datagram", client=f"{address[0]}:{address[1]}")
+
+    def handle(self, item: tuple[tuple[tuple[str, int], int], bytes], client_address: tuple[str, int]) -> None:
+        key, message = item
+        self.handler(message, f"{client_address[0]}:{client_address[1]}", lambda response: self.answer(key, response), *self.args)
+
+    def answer(self, key: tuple[tuple[str, int], int], response: bytes) -> None:
+        '''
+        Sends the response to the request, or the request ID alone if it doesn't fit in a datagram
+        '''
+        address, request_id = key
+        answer = pack(request_id, response if fits(response) else b'')
+        with self.lock:
+            if key in self.answers:
+                self.answers[key] = answer
+        self.sendto(answer, address)
+
+    def sendto(self, answer: bytes, address: tuple[str, int]) -> None:
+        try:
+            self.socket.sendto(answer, address)
+        except OSError as e:
+            log.error("Failed to send an answer", client=f"{address[0]}:{address[1]}", error=e)
+
+    def close(self) -> None:
+        self.socket.close()
+        self.pool.shutdown()
+
+# endregion
@@ -0,0 +1,89 @@
+import sqlite3
+import threading
+import time
+import typing
+
+import api
+import caching
+
+# ========================================================================
+# ============================ Disk Cache Tier ===========================
+# ========================================================================
+
+# region Disk Cache Tier
+
+
+class DiskCache:
+    '''
+    Second (L2) cache tier of the proxy, kept in a sqlite file so it survives restarts.
+    Entries are packed responses keyed by a digest of the cache key, next to their time stamp and max-age,
+    so their freshness is computed exactly as for the in-memory tier after a restart.
+    On startup only the keys are read into an in-memory index, the responses are read when they are requested.
+    The file holds at most `capacity` entries (0 = unbounded), the least recently used are deleted first.
+    '''
+
+    def __init__(self, path: str, capacity: int = 0) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS entries (
+            key BLOB PRIMARY KEY,
+            response BLOB NOT NULL,
+            unix_time_stamp INTEGER NOT NULL,
+            cache_control INTEGER NOT NULL,
+            last_used REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self.connection.commit()
+        self.index: set[bytes] = {key for key, in self.connection.execute('SELECT key FROM entries')}
+
+    digest = staticmethod(caching.key_digest)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: tuple[bytes, bool]) -> bool:
+        return self.digest(key) in self.index
+
+    def get(self, key: tuple[bytes, bool]) -> typing.Optional[api.CalculatorHeader]:
+        '''
+        Returns the cached response for the key, or None if there is none
+        '''
+        digest = self.digest(key)
+        if digest not in self.index:  # most misses never touch the file
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT response FROM entries WHERE key = ?', (digest,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), digest))
+            self.connection.commit()
+        return api.CalculatorHeader.unpack(row[0])
+
+    def put(self, key: tuple[bytes, bool], response: api.CalculatorHeader) -> None:
+        self.put_many([(key, response)])
+
+    def put_many(self, entries: typing.Iterable[tuple[tuple[bytes, bool], api.CalculatorHeader]]) -> None:
+        '''
+        Caches the responses in one transaction, then deletes the least recently used entries above the capacity
+        '''
+        now = time.time()
+        rows = [(self.digest(key), response.pack(), response.unix_time_stamp, response.cache_control, now)
+                for key, response in entries]
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+            self.index.update(row[0] for row in rows)
+            if self.capacity > 0 and len(self.index) > self.capacity:
+                evicted = self.connection.execute('SELECT key FROM entries ORDER BY last_used LIMIT ?',
+                                                  (len(self.index) - self.capacity,)).fetchall()
+                self.connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+                self.index.difference_update(key for key, in evicted)
+            self.connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+# endregion
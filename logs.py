@@ -0,0 +1,174 @@
+import atexit
+import collections
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+import typing
+
+import metrics
+
+# ========================================================================
+# ============================ Structured Logs ===========================
+# ========================================================================
+
+# region Structured Logs
+
+LEVELS: typing.Final[dict[str, int]] = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+FORMATS: typing.Final[tuple[str, ...]] = ('text', 'json')
+# The maximum number of records waiting to be written, further records are dropped (and counted) instead of blocking
+BUFFER_CAPACITY = 65536
+# Seconds between two writes of the buffered records
+FLUSH_INTERVAL = 0.05
+
+Record = tuple[float, str, str, str, dict[str, typing.Any]]
+
+
+class Writer:
+    '''
+    Writes log records in a background thread, so logging never waits for the output.
+    Records are appended to a bounded ring buffer and written in batches every FLUSH_INTERVAL seconds,
+    when the buffer is full new records are dropped and counted instead of blocking the caller.
+    '''
+
+    def __init__(self, stream: typing.Optional[typing.TextIO] = None, format: str = 'text', capacity: int = BUFFER_CAPACITY) -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Unknown log format '{format}' (must be one of {FORMATS})")
+        self.stream = stream
+        self.format = format
+        self.capacity = capacity
+        self.buffer: collections.deque[Record] = collections.deque()
+        self.dropped = 0
+        self.reported = 0  # dropped records already reported in the log
+        self.lock = threading.Lock()  # only taken by the writing side
+        self.thread: typing.Optional[threading.Thread] = None
+
+    def append(self, record: Record) -> None:
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        self.buffer.append(record)
+        if self.thread is None:
+            self.start()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self) -> None:
+        '''
+        Writes the buffered records
+        '''
+        with self.lock:
+            lines = []
+            while self.buffer:
+                lines.append(self.render(self.buffer.popleft()))
+            if self.dropped != self.reported:
+                lines.append(self.render((time.time(), 'warning', 'logs', 'Dropped log records, the buffer was full',
+                                          {'dropped': self.dropped - self.reported})))
+                self.reported = self.dropped
+            if lines:
+                try:
+                    stream = self.stream or sys.stdout  # looked up on every write, so redirecting stdout works
+                    stream.write('\n'.join(lines) + '\n')
+                    stream.flush()
+                except (OSError, ValueError):  # the output was closed, nothing else to do with the records
+                    pass
+
+    def render(self, record: Record) -> str:
+        timestamp, level, name, event, fields = record
+        when = datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds')
+        if self.format == 'json':
+            return json.dumps({'time': when, 'level': level, 'logger': name, 'event': event, **fields}, default=str)
+        return ' '.join([when, f"{level.upper():<7}", f"{name}: {event}"] + [f"{key}={value}" for key, value in fields.items()])
+
+
+writer = Writer()
+level = LEVELS['info']
+# Fraction of the records of a level that are logged (e.g. {'debug': 0.01} keeps one debug record in a hundred)
+sampling: dict[str, float] = {}
+
+metrics.callback('log_dropped_total', 'Log records dropped because the buffer was full.', lambda: writer.dropped, 'counter')
+
+
+def configure(log_level: str = 'info', format: str = 'text', sample: typing.Optional[dict[str, float]] = None,
+              stream: typing.Optional[typing.TextIO] = None, capacity: int = BUFFER_CAPACITY) -> None:
+    '''
+    Function which sets the minimal level, the output format, the sampling rates and the output of the logs
+    '''
+    global level, sampling
+    if log_level not in LEVELS:
+        raise ValueError(f"Unknown log level '{log_level}' (must be one of {tuple(LEVELS)})")
+    if format not in FORMATS:
+        raise ValueError(f"Unknown log format '{format}' (must be one of {FORMATS})")
+    writer.flush()
+    with writer.lock:
+        writer.stream = stream
+        writer.format = format
+        writer.capacity = capacity
+    level = LEVELS[log_level]
+    sampling = dict(sample or {})
+
+
+def parse_sample(value: str) -> tuple[str, float]:
+    '''
+    Function which parses a 'level=rate' sampling argument
+    '''
+    name, _, rate = value.partition('=')
+    if name not in LEVELS or not rate:
+        raise ValueError(f"Invalid sampling '{value}' (expected level=rate, e.g. info=0.1)")
+    rate = float(rate)
+    if not 0 <= rate <= 1:
+        raise ValueError(f"Sampling rate must be between 0 and 1, got {rate}")
+    return name, rate
+
+
+def flush() -> None:
+    writer.flush()
+
+
+atexit.register(flush)  # the writer thread is a daemon, write what's left when the process exits
+
+
+class Logger:
+    '''
+    A named source of structured log records, each record is an event and its fields (e.g. client, bytes)
+    '''
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def log(self, log_level: str, event: str, **fields: typing.Any) -> None:
+        if LEVELS[log_level] < level:
+            return
+        rate = sampling.get(log_level)
+        if rate is not None and random.random() >= rate:
+            return
+        writer.append((time.time(), log_level, self.name, event, fields))
+
+    def debug(self, event: str, **fields: typing.Any) -> None:
+        self.log('debug', event, **fields)
+
+    def info(self, event: str, **fields: typing.Any) -> None:
+        self.log('info', event, **fields)
+
+    def warning(self, event: str, **fields: typing.Any) -> None:
+        self.log('warning', event, **fields)
+
+    def error(self, event: str, **fields: typing.Any) -> None:
+        self.log('error', event, **fields)
+
+
+def get_logger(name: str) -> Logger:
+    return Logger(name)
+
+# endregion
@@ -0,0 +1,308 @@
+import http.server
+import math
+import threading
+import typing
+from abc import ABC, abstractmethod
+
+# ========================================================================
+# ================================ Metrics ===============================
+# ========================================================================
+
+# region Metrics
+
+Labels = tuple[str, ...]
+
+# Latencies are recorded in microseconds, in log-linear buckets (like HDR histograms):
+# every power of two is split into SUB_BUCKETS buckets, so a bucket is at most 1/SUB_BUCKETS wider than its lower bound
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_MICROSECONDS = 2 ** 32 - 1  # about 71 minutes, longer values are recorded as this
+
+
+def bucket_index(microseconds: int) -> int:
+    '''
+    Function which returns the histogram bucket of a value in microseconds
+    '''
+    microseconds = min(max(microseconds, 0), MAX_MICROSECONDS)
+    if microseconds < 2 * SUB_BUCKETS:
+        return microseconds
+    shift = microseconds.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (microseconds >> shift) - SUB_BUCKETS
+
+
+def bucket_lower_bound(index: int) -> int:
+    '''
+    Function which returns the smallest value in microseconds recorded in a histogram bucket
+    '''
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (SUB_BUCKETS + index % SUB_BUCKETS) << shift
+
+
+BUCKETS = bucket_index(MAX_MICROSECONDS) + 1
+
+
+class Metric(ABC):
+    '''
+    A named metric, which is recorded in per-thread shards so recording never takes a lock.
+    Each thread only writes to its own shard, and collecting sums the shards,
+    the shards of threads that exited are folded into a single retired shard whenever a thread adds its shard.
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, label_names: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.local = threading.local()
+        self.shards: list[tuple[threading.Thread, dict]] = []
+        self.retired: dict = {}
+        self.lock = threading.Lock()
+
+    def shard(self) -> dict:
+        '''
+        Returns the calling thread's shard, creating it on the thread's first record
+        '''
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                # Short-lived threads (e.g. background refreshes) would pile up if only collecting folded their shards
+                self.reap()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def reap(self) -> None:
+        '''
+        Folds the shards of the threads that exited into the retired shard, must be called holding the lock
+        '''
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = alive
+
+    def collect(self) -> dict:
+        '''
+        Returns the values of all the threads summed up, per label values
+        '''
+        with self.lock:
+            self.reap()
+            total = {}
+            self.merge(total, self.retired)
+            for _, shard in self.shards:
+                self.merge(total, shard)
+        return total
+
+    @abstractmethod
+    def merge(self, into: dict, shard: dict) -> None:
+        '''
+        Abstract method for adding the values of a shard to the values collected so far, per label values
+        '''
+        pass
+
+    def samples(self) -> list[tuple[str, Labels, Labels, float]]:
+        '''
+        Returns the samples to expose: the sample name suffix, the label names, the label values and the value
+        '''
+        return [('', self.label_names, labels, value) for labels, value in sorted(self.collect().items())]
+
+
+class Counter(Metric):
+    '''
+    A number that only goes up (e.g. requests or bytes sent)
+    '''
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, labels: Labels = ()) -> None:
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def merge(self, into: dict, shard: dict) -> None:
+        for labels, value in list(shard.items()):
+            into[labels] = into.get(labels, 0) + value
+
+    def value(self, labels: Labels = ()) -> float:
+        return self.collect().get(labels, 0)
+
+
+class Histogram(Metric):
+    '''
+    The distribution of durations in seconds, recorded in log-linear buckets with a relative error of at most 1/SUB_BUCKETS.
+    It's exposed with a bucket per power of two microseconds, the full resolution is used by quantile.
+    '''
+    kind = 'histogram'
+
+    def observe(self, seconds: float, labels: Labels = ()) -> None:
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (BUCKETS + 1)  # the last slot holds the sum
+        counts[bucket_index(int(seconds * 1_000_000))] += 1
+        counts[BUCKETS] += seconds
+
+    def merge(self, into: dict, shard: dict) -> None:
+        for labels, counts in list(shard.items()):
+            total = into.setdefault(labels, [0] * (BUCKETS + 1))
+            for index, count in enumerate(list(counts)):
+                total[index] += count
+
+    def quantile(self, q: float, labels: Labels = ()) -> float:
+        '''
+        Returns the upper bound in seconds of the bucket holding the q-quantile (e.g. 0.99 for the p99), or NaN if there are no values
+        '''
+        counts = self.collect().get(labels)
+        if counts is None or sum(counts[:BUCKETS]) == 0:
+            return math.nan
+        rank = q * sum(counts[:BUCKETS])
+        seen = 0
+        for index in range(BUCKETS):
+            seen += counts[index]
+            if seen >= rank and counts[index]:
+                return bucket_lower_bound(index + 1) / 1_000_000
+        return MAX_MICROSECONDS / 1_000_000
+
+    def samples(self) -> list[tuple[str, Labels, Labels, float]]:
+        samples = []
+        names = self.label_names + ('le',)
+        for labels, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for index in range(BUCKETS):
+                cumulative += counts[index]
+                # Expose the buckets ending on a power of two, so the exposed buckets never change
+                if (index + 1) % SUB_BUCKETS == 0 and index + 1 >= 2 * SUB_BUCKETS:
+                    samples.append(('_bucket', names, labels + (repr(bucket_lower_bound(index + 1) / 1_000_000),), cumulative))
+            samples.append(('_bucket', names, labels + ('+Inf',), cumulative))
+            samples.append(('_sum', self.label_names, labels, counts[BUCKETS]))
+            samples.append(('_count', self.label_names, labels, cumulative))
+        return samples
+
+
+class Callback(Metric):
+    '''
+    A metric read from the process state when it's collected (e.g. the number of cached responses),
+    the function returns the value, or a dict of values per label values
+    '''
+
+    def __init__(self, name: str, help: str, function: typing.Callable[[], typing.Union[float, dict]],
+                 kind: str = 'gauge', label_names: Labels = ()) -> None:
+        super().__init__(name, help, label_names)
+        self.function = function
+        self.kind = kind
+
+    def collect(self) -> dict:
+        values = self.function()
+        return values if isinstance(values, dict) else {(): values}
+
+    def merge(self, into: dict, shard: dict) -> None:
+        # The values are read, not recorded in shards, so a later reading replaces an earlier one
+        into.update(shard)
+
+
+class Registry:
+    '''
+    The metrics of a process, rendered in the Prometheus text exposition format
+    '''
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                samples = metric.samples()
+            except Exception as e:  # a failing callback must not hide the other metrics
+                lines.append(f"# Error while collecting {metric.name}: {e}")
+                continue
+            for suffix, names, values, value in samples:
+                label_pairs = ','.join(f'{name}="{escape(str(label))}"' for name, label in zip(names, values))
+                labels = f"{{{label_pairs}}}" if label_pairs else ''
+                lines.append(f"{metric.name}{suffix}{labels} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape(label: str) -> str:
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if value.is_integer():
+            return str(int(value))
+    return repr(value)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, label_names: Labels = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help, label_names))
+
+
+def histogram(name: str, help: str, label_names: Labels = ()) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, label_names))
+
+
+def callback(name: str, help: str, function: typing.Callable[[], typing.Union[float, dict]],
+             kind: str = 'gauge', label_names: Labels = ()) -> Callback:
+    return REGISTRY.register(Callback(name, help, function, kind, label_names))
+
+# endregion
+
+# ========================================================================
+# ============================ Metrics Endpoint ==========================
+# ========================================================================
+
+# region Metrics Endpoint
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass  # scrapes are not worth a line each
+
+
+def serve(address: tuple[str, int], registry: Registry = REGISTRY) -> http.server.ThreadingHTTPServer:
+    '''
+    Function which serves the metrics over HTTP (GET /metrics) in a background thread, apart from the calculator port
+    '''
+    handler = type('MetricsHandler', (MetricsHandler,), {'registry': registry})
+    metrics_server = http.server.ThreadingHTTPServer(address, handler)
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    return metrics_server
+
+# endregion
@@ -0,0 +1,154 @@
+import struct
+import threading
+import time
+import typing
+
+import api
+import caching
+import tracing
+import logs
+import upstream
+
+# ========================================================================
+# ============================= Proxy Peers ==============================
+# ========================================================================
+
+# region Proxy Peers
+
+# Seconds between two fetches of the siblings' cache digests
+DIGEST_INTERVAL = 10
+# Seconds to wait for a sibling before going to the server
+PEER_TIMEOUT = 1.0
+
+log = logs.get_logger('peers')
+
+
+class CacheDigest(caching.BloomFilter):
+    '''
+    Bloom filter of the keys cached by a proxy, sent to its siblings so they know what it holds.
+    The bit positions are derived from caching.key_digest, so every process computes the same ones.
+    '''
+    HEADER_FORMAT: typing.Final[str] = '!LB'
+    HEADER_LENGTH: typing.Final[int] = struct.calcsize(HEADER_FORMAT)
+    # The most bits that fit in the data of one response (whose total length is a 16-bit field),
+    # digests of more keys have more false positives instead
+    MAX_SIZE: typing.Final[int] = (2**16 - 1 - api.CalculatorHeader.HEADER_MIN_LENGTH - HEADER_LENGTH) * 8
+
+    def _indexes(self, key: tuple[bytes, bool]) -> typing.Iterator[int]:
+        digest = caching.key_digest(key)
+        # Double hashing, the i-th position is h1 + i * h2
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    @classmethod
+    def of(cls, keys: typing.Collection[tuple[bytes, bool]], bits_per_key: int = 8, hashes: int = 4) -> 'CacheDigest':
+        digest = cls(min(max(bits_per_key * len(keys), 1024), cls.MAX_SIZE), hashes)
+        for key in keys:
+            digest.add(key)
+        return digest
+
+    def to_bytes(self) -> bytes:
+        return struct.pack(self.HEADER_FORMAT, self.size, self.hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'CacheDigest':
+        size, hashes = struct.unpack(cls.HEADER_FORMAT, data[:cls.HEADER_LENGTH])
+        digest = cls(size, hashes)
+        if len(data) - cls.HEADER_LENGTH != len(digest.bits):
+            raise ValueError('The cache digest length does not match its size')
+        digest.bits = bytearray(data[cls.HEADER_LENGTH:])
+        return digest
+
+
+def exchange(address: tuple[str, int], request: api.CalculatorHeader) -> api.CalculatorHeader:
+    '''
+    Function which sends a request to a sibling proxy and returns its response
+    '''
+    with tracing.span('peer', peer=f"{address[0]}:{address[1]}"):
+        request = tracing.traced(request, address)
+        with upstream.create_connection(address, PEER_TIMEOUT) as peer_socket:
+            peer_socket.sendall(request.pack())
+            response = api.receive_message(peer_socket, bytearray())
+        if not response:
+            raise ConnectionResetError("Sibling proxy closed the connection without a response")
+        response = api.CalculatorHeader.unpack(response)
+        tracing.negotiate(address, request, response)
+    return response
+
+
+class PeerGroup:
+    '''
+    The sibling proxies of this proxy, consulted on a local miss before going to the server.
+    - 'ring': every key has an owner picked by consistent hashing over all the proxies. A miss for a key owned
+      by a sibling is forwarded to it (as a peer request), so each response is fetched and cached by one proxy only.
+    - 'digest': siblings exchange Bloom filter digests of their caches every DIGEST_INTERVAL seconds. A miss for a
+      key in a sibling's digest asks that sibling for its cached response (only if cached).
+    Siblings that fail are skipped for a while (see upstream.UpstreamPool).
+    '''
+    MODES: typing.Final[tuple[str, ...]] = ('ring', 'digest')
+
+    def __init__(self, self_address: tuple[str, int], peer_addresses: list[tuple[str, int]], mode: str = 'ring',
+                 digest_interval: float = DIGEST_INTERVAL) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown peer mode '{mode}' (must be one of {self.MODES})")
+        self.self_address = self_address
+        self.mode = mode
+        self.digest_interval = digest_interval
+        self.pool = upstream.UpstreamPool(peer_addresses)
+        # Every proxy builds the same ring, as long as they are all given the same addresses
+        self.ring = upstream.HashRing([upstream.Upstream(self_address)] + self.pool.upstreams)
+        self.digests: dict[tuple[str, int], CacheDigest] = {}
+
+    def candidates(self, key: tuple[bytes, bool]) -> list[tuple[upstream.Upstream, int]]:
+        '''
+        Returns the siblings to ask for the key, with the request method to ask them with
+        '''
+        if self.mode == 'ring':
+            owner = self.ring.preference(key[0])[0]
+            if owner.address == self.self_address:
+                return []
+            return [(peer, api.CalculatorHeader.METHOD_PEER) for peer in self.pool.upstreams if peer.address == owner.address]
+        return [(peer, api.CalculatorHeader.METHOD_ONLY_IF_CACHED) for peer in self.pool.upstreams
+                if peer.address in self.digests and key in self.digests[peer.address]]
+
+    def lookup(self, request: api.CalculatorHeader, key: tuple[bytes, bool]) -> typing.Optional[api.CalculatorHeader]:
+        '''
+        Returns a sibling's response to the request, or None if no sibling could answer it
+        '''
+        for peer, method in self.candidates(key):
+            if not peer.healthy:
+                continue
+            try:
+                response = exchange(peer.address, request.copy(
+                    status_code=method, reserved=request.reserved | api.CalculatorHeader.RESERVED_COMPRESSED))
+            except (OSError, ValueError) as e:
+                log.warning("Sibling failed", peer=upstream.address_label(peer.address), error=e)
+                self.pool.report_failure(peer)
+                continue
+            self.pool.report_success(peer)
+            if response.is_request or response.status_code in (api.CalculatorHeader.STATUS_NOT_CACHED, api.CalculatorHeader.STATUS_SERVER_ERROR):
+                continue
+            return response
+        return None
+
+    def poll_digests(self) -> None:
+        '''
+        Function which fetches the siblings' cache digests forever, run in a background thread
+        '''
+        request = api.CalculatorHeader.from_request(b'', False, False, 0, method=api.CalculatorHeader.METHOD_DIGEST)
+        while True:
+            for peer in self.pool.upstreams:
+                try:
+                    response = exchange(peer.address, request)
+                    self.digests[peer.address] = CacheDigest.from_bytes(response.data)
+                except (OSError, ValueError, struct.error):
+                    # An unreachable sibling's digest is dropped, so we stop asking it
+                    self.digests.pop(peer.address, None)
+            time.sleep(self.digest_interval)
+
+    def start(self) -> None:
+        if self.mode == 'digest':
+            threading.Thread(target=self.poll_digests, daemon=True).start()
+
+# endregion
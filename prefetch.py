@@ -0,0 +1,124 @@
+import collections
+import threading
+import time
+import typing
+
+import api
+import caching
+import capture
+import logs
+
+# ========================================================================
+# ======================= Cache Warming and Prefetch =====================
+# ========================================================================
+
+# region Cache Warming and Prefetch
+
+# Popular responses fetched when the proxy starts, and how many are fetched per second (0 = unlimited)
+WARM_TOP = 100
+WARM_RATE = 50
+# A request is prefetched once the request before it was seen MIN_OBSERVATIONS times and was followed by it
+# at least CONFIDENCE of the time
+PREFETCH_MIN_OBSERVATIONS = 3
+PREFETCH_CONFIDENCE = 0.5
+# Keys (and clients) whose successors are counted, and successors counted per key
+PREFETCH_KEYS = 4096
+PREFETCH_SUCCESSORS = 8
+
+Key = tuple[bytes, bool]
+
+log = logs.get_logger('prefetch')
+
+
+def popular(path: str, top: int = WARM_TOP) -> list[api.CalculatorHeader]:
+    '''
+    Function which returns the requests of the `top` most requested keys of a trace (see capture.Recorder),
+    most requested first. Only evaluations whose responses could be cached are counted.
+    '''
+    counts: collections.Counter[Key] = collections.Counter()
+    latest: dict[Key, dict[str, typing.Any]] = {}
+    for entry in capture.load(path):
+        if entry['method'] != api.CalculatorHeader.METHOD_EVALUATE or not entry['cacheable'] or entry['max_age'] == 0:
+            continue
+        key = (entry['data'].encode('ascii'), bool(entry['steps']))
+        counts[key] += 1
+        latest[key] = entry
+    return [capture.to_request(latest[key]) for key, _ in counts.most_common(top)]
+
+
+def warm(requests: typing.Iterable[api.CalculatorHeader], load: typing.Callable[[api.CalculatorHeader], bool],
+         rate: float = WARM_RATE) -> int:
+    '''
+    Function which loads the requests one after the other, at most `rate` per second (0 = unlimited),
+    so warming doesn't send the servers the burst of misses it's meant to spare them.
+    load(request) fetches and caches a response and returns whether it was cached, failures are logged and skipped.
+    Returns how many responses were cached.
+    '''
+    started = time.monotonic()
+    cached = 0
+    for i, request in enumerate(requests):
+        if rate > 0:
+            delay = started + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            cached += load(request)
+        except Exception as e:
+            log.warning("Failed to warm a response", error=e)
+    return cached
+
+
+class Predictor:
+    '''
+    Learns which requests usually follow which: the requests a client sends right after a request are counted as its
+    successors, and once a request was followed PREFETCH_MIN_OBSERVATIONS times, the successors that followed it
+    at least PREFETCH_CONFIDENCE of the time are predicted whenever it's requested again.
+    A client is what the proxy labels it with, its address and port, so sequences are learned within a connection
+    (or a UDP socket): requests a client sends over separate connections aren't seen as following each other.
+    Only the keys for which prefetchable(key) is true are counted as successors (e.g. deterministic expressions), it's
+    checked once per key, when the key first follows another.
+    The successors of at most `capacity` keys (and the last keys of as many clients) are kept, least recently seen
+    first out, and only the PREFETCH_SUCCESSORS most frequent successors of a key.
+    '''
+
+    def __init__(self, capacity: int = PREFETCH_KEYS, min_observations: int = PREFETCH_MIN_OBSERVATIONS,
+                 confidence: float = PREFETCH_CONFIDENCE,
+                 prefetchable: typing.Callable[[Key], bool] = lambda key: True) -> None:
+        self.successors: caching.LRUCache[Key, collections.Counter[Key]] = caching.LRUCache(capacity)
+        self.last: caching.LRUCache[str, Key] = caching.LRUCache(capacity)
+        self.prefetchable = prefetchable
+        self.verdicts: caching.LRUCache[Key, bool] = caching.LRUCache(capacity)  # prefetchable(key) of the keys seen
+        self.min_observations = min_observations
+        self.confidence = confidence
+        self.lock = threading.Lock()
+
+    def observe(self, client: str, key: Key) -> list[Key]:
+        '''
+        Records that the client requested the key, and returns the keys likely to be requested next
+        '''
+        previous = self.last.peek(client)
+        if previous is not None and previous != key and self.verdicts.peek(key) is None:
+            self.verdicts.put(key, self.prefetchable(key))  # outside the lock, at worst two threads check the key
+        with self.lock:
+            previous = self.last.peek(client)
+            self.last.put(client, key)
+            if previous is not None and previous != key and self.verdicts.peek(key):
+                counts = self.successors.get(previous)
+                if counts is None:
+                    counts = collections.Counter()
+                    self.successors.put(previous, counts)
+                counts[key] += 1
+                if len(counts) > PREFETCH_SUCCESSORS:
+                    del counts[min(counts, key=counts.__getitem__)]
+            return self.predict(key)
+
+    def predict(self, key: Key) -> list[Key]:
+        counts = self.successors.peek(key)
+        if not counts:
+            return []
+        observations = sum(counts.values())
+        if observations < self.min_observations:
+            return []
+        return [successor for successor, count in counts.items() if count >= self.confidence * observations]
+
+# endregion
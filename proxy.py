@@ -5,15 +5,93 @@ import argparse
 import threading
 import socket
 import time
-import math
-
-cache: dict[tuple[bytes, bool], api.CalculatorHeader] = {}
+import typing
+
+import admin
+import caching
+import capture
+import datagram
+import disk_cache
+import logs
+import metrics
+import prefetch
+import tracing
+import upstream
+import peers
+import workers
+
+# The maximum number of responses held by the cache (0 = unbounded)
+CACHE_SIZE = 1024
+# Whether new responses must be more popular than the eviction victim to be cached (TinyLFU admission)
+ADMISSION = True
+cache: caching.LRUCache[tuple[bytes, bool], api.CalculatorHeader] = caching.LRUCache(
+    CACHE_SIZE, caching.TinyLFU(CACHE_SIZE) if ADMISSION else None)
+# Client errors (e.g. division by zero) of deterministic expressions are cached apart from the results,
+# in at most NEGATIVE_CACHE_SIZE entries for at most NEGATIVE_CACHE_TTL seconds (0 = don't cache client errors)
+NEGATIVE_CACHE_SIZE = 256
+NEGATIVE_CACHE_TTL = 60
+negative_cache: caching.LRUCache[tuple[bytes, bool], api.CalculatorHeader] = caching.LRUCache(NEGATIVE_CACHE_SIZE)
+# Optional second cache tier on disk, holds the responses evicted from memory and survives restarts
+l2_cache: typing.Optional[disk_cache.DiskCache] = None
 INDEFINITE = api.CalculatorHeader.MAX_CACHE_CONTROL
+# Optional sibling proxies, consulted on a miss before going to the server
+peer_group: typing.Optional[peers.PeerGroup] = None
+# A single server address, or a pool of servers to balance between
+ServerAddress = typing.Union[upstream.Address, upstream.UpstreamPool]
+# Serve responses that are stale by at most this many seconds while refreshing them in the background (0 = disabled)
+STALE_WHILE_REVALIDATE = 0
+# Refresh popular entries in the background when they are this many seconds away from going stale
+REFRESH_AHEAD = 2
+# An entry is popular once it was hit this many times since it was last fetched
+POPULAR_HITS = 3
+hits: dict[tuple[bytes, bool], int] = {}  # cache hits per entry since it was last fetched
+refreshing: set[tuple[bytes, bool]] = set()  # entries that are being refreshed in the background
+refreshing_lock = threading.Lock()
+# Optional prefetcher, fetches the responses likely to be requested next (see prefetch.Predictor)
+predictor: typing.Optional[prefetch.Predictor] = None
+# Connections handled at once, connections waiting for a worker, and seconds a connection may wait before it's shed
+MAX_WORKERS = 64
+QUEUE_DEPTH = 128
+SHED_AFTER = 1.0
+# The connections of a running proxy, and the servers behind it
+pool: typing.Optional[workers.WorkerPool] = None
+upstreams: typing.Optional[upstream.UpstreamPool] = None
+# Whether to also serve requests sent as UDP datagrams on the proxy port, and to send requests to the servers
+# as datagrams (the servers must be started with --udp), see datagram.py
+UDP = False
+UPSTREAM_UDP = False
+# Local port serving the metrics in the Prometheus text format (None = disabled)
+METRICS_PORT: typing.Optional[int] = None
+# What the proxy records for the metrics port, the pool, cache and server state is read when the metrics are scraped
+cache_hits = metrics.counter('proxy_cache_hits_total', 'Requests answered from the cache (including stale responses served while revalidating and sibling proxies).')
+cache_misses = metrics.counter('proxy_cache_misses_total', 'Requests forwarded to a server.')
+stale_responses = metrics.counter('proxy_stale_total', 'Requests that found a stale cached response.')
+cached_responses = metrics.counter('proxy_cached_total', 'Responses cached after a miss.')
+evictions = metrics.counter('proxy_evictions_total', 'Responses evicted from the memory tiers.', ('cache',))
+received_bytes = metrics.counter('proxy_received_bytes_total', 'Bytes of requests received from clients.')
+sent_bytes = metrics.counter('proxy_sent_bytes_total', 'Bytes of responses sent to clients.')
+request_seconds = metrics.histogram('proxy_request_seconds', 'Time from receiving a request to sending its response.')
+upstream_seconds = metrics.histogram('proxy_upstream_seconds', 'Time from connecting to a server to receiving its response.', ('upstream',))
+upstream_failures = metrics.counter('proxy_upstream_failures_total', 'Failed connections to a server.', ('upstream',))
+metrics.callback('proxy_connections', 'Client connections being handled.', lambda: pool.busy if pool else 0)
+metrics.callback('proxy_queued_connections', 'Client connections waiting for a worker.', lambda: pool.queued if pool else 0)
+metrics.callback('proxy_shed_total', 'Client connections answered with 503 (overloaded).', lambda: pool.shed if pool else 0, 'counter')
+metrics.callback('proxy_cache_entries', 'Cached responses per cache tier.', lambda: {
+    ('memory',): len(cache), ('negative',): len(negative_cache), ('disk',): len(l2_cache) if l2_cache else 0}, label_names=('cache',))
+metrics.callback('proxy_upstream_outstanding', 'Requests sent to a server and not answered yet.', lambda: {
+    (address_label(u.address),): u.outstanding for u in (upstreams.upstreams if upstreams else [])}, label_names=('upstream',))
+metrics.callback('proxy_upstream_healthy', 'Whether a server is used (1) or ejected after failures (0).', lambda: {
+    (address_label(u.address),): int(u.healthy) for u in (upstreams.upstreams if upstreams else [])}, label_names=('upstream',))
+log = logs.get_logger('proxy')
 flag_quit = False  # Made to make the termination of the program easier. Not required for this exercise.
 BUFFSIZE = api.BUFFER_SIZE  # using the API buffer size to ensure consistency in data handling across all socket operations
 
 
-def process_request(request: api.CalculatorHeader, server_address: tuple[str, int]) -> tuple[
+def address_label(address: upstream.Address) -> str:
+    return upstream.address_label(address)
+
+
+def process_request(request: api.CalculatorHeader, server_address: ServerAddress) -> tuple[
     api.CalculatorHeader, int, int, bool, bool, bool]:
     '''
     Function which processes the client request if specified we cache the result
@@ -21,69 +99,362 @@ def process_request(request: api.CalculatorHeader, server_address: tuple[str, in
     If the request.cache_control is 0, we don't use the cache and send a new request to the server. (like a reload)
     If the request.cache_control < time() - cache[request].unix_time_stamp, the client doesn't allow us to use the cache and we send a new request to the server.
     If the cache[request].cache_control is 0, the response must not be cached.
+    If the response is stale for the server by at most STALE_WHILE_REVALIDATE seconds and the client still accepts its age,
+    the stale response is returned right away and refreshed in the background.
+    A request without steps can be answered from a cached response with steps (see lookup).
+    On a miss, sibling proxies are consulted before the server (see peers.PeerGroup).
+    Sibling proxies may also ask for a response only if it's cached, or for a digest of the cached keys.
+    Admin requests are answered by the proxy itself (see admin).
     '''
     if not request.is_request:
         raise TypeError("Received a response instead of a request")
 
-    data = request.data
-    server_time_remaining = None
-    client_time_remaining = None
+    # Admin requests are for this proxy, they are never forwarded
+    if request.method == api.CalculatorHeader.METHOD_ADMIN:
+        return admin.handle(request), 0, 0, False, False, False
+
+    if request.method == api.CalculatorHeader.METHOD_DIGEST:
+        digest = peers.CacheDigest.of(list(cache.keys()))
+        return api.CalculatorHeader.from_response(digest.to_bytes(), api.CalculatorHeader.STATUS_OK, False, False, 0), 0, 0, False, False, False
+
+    key = (request.data, request.show_steps)
     was_stale = False
-    cached = False
+    stale_response = None
     # Check if the data is in the cache, if the requests cache-control is 0 we must not use the cache and request a new response
-    if ((data, request.show_steps) in cache) and (request.cache_control != 0):
-        response = cache[(data, request.show_steps)]
-        current_time = int(time.time())
-        age = current_time - response.unix_time_stamp
-        res_cc = response.cache_control if response.cache_control != INDEFINITE else math.inf
-        req_cc = request.cache_control if request.cache_control != INDEFINITE else math.inf
-        server_time_remaining = res_cc - age
-        client_time_remaining = req_cc - age
+    with tracing.span('lookup'):
+        entry_key, response = lookup(key) if request.cache_control != 0 else (key, None)
+    # A request without steps may be answered from the cached response with steps, which is then the entry
+    # that's counted, refreshed and revalidated, so the expression keeps one slot
+    entry_request = request if entry_key == key else request.copy(show_steps=True)
+    if response is not None:
+        server_time_remaining, client_time_remaining = api.time_remaining(request, response)
         # response is still 'fresh' both for the client and the server
         if server_time_remaining > 0 and client_time_remaining > 0:
-            return response, server_time_remaining, client_time_remaining, True, False, False
-        else:  # response is 'stale'
-            was_stale = True
+            hits[entry_key] = hits.get(entry_key, 0) + 1
+            # Popular entries are refreshed shortly before they expire, so they never go stale
+            if server_time_remaining <= REFRESH_AHEAD and hits[entry_key] >= POPULAR_HITS:
+                refresh_in_background(entry_key, entry_request, server_address)
+            return for_client(response, request), server_time_remaining, client_time_remaining, True, False, False
+        # response is 'stale' for the server, but within the grace window and still acceptable for the client
+        if -server_time_remaining < STALE_WHILE_REVALIDATE and client_time_remaining > 0 and \
+                request.method != api.CalculatorHeader.METHOD_ONLY_IF_CACHED:
+            refresh_in_background(entry_key, entry_request, server_address)
+            return for_client(response, request), server_time_remaining, client_time_remaining, True, True, False
+        # response is 'stale'
+        was_stale = True
+        stale_response = response
+
+    # A sibling proxy only wants a fresh cached response, it goes to the server itself otherwise
+    if request.method == api.CalculatorHeader.METHOD_ONLY_IF_CACHED:
+        return api.CalculatorHeader.from_response(b'', api.CalculatorHeader.STATUS_NOT_CACHED, request.show_steps, False, 0), 0, 0, False, was_stale, False
+
+    # Ask the sibling proxies, unless a sibling forwarded this request to us
+    if peer_group is not None and request.method == api.CalculatorHeader.METHOD_EVALUATE:
+        response = peer_group.lookup(request, key)
+        if response is not None:
+            server_time_remaining, client_time_remaining = api.time_remaining(request, response)
+            return for_client(response, request), server_time_remaining, client_time_remaining, True, was_stale, False
 
     # Request is not in the cache or the response is 'stale' so we need to send a new request to the server and cache the response
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        try:
-            server_socket.connect(server_address)
-        except ConnectionRefusedError:
-            raise api.CalculatorServerError(
-                "Connection refused by server and the request was not in the cache/it was stale")
-        server_socket.sendall(request.pack())
+    response = fetch(entry_request, server_address, stale_response)
+    server_time_remaining, client_time_remaining, cached = store(entry_key, entry_request, response)
+    return for_client(response, request), server_time_remaining, client_time_remaining, False, was_stale, cached
+
+
+def lookup(key: tuple[bytes, bool]) -> tuple[tuple[bytes, bool], typing.Optional[api.CalculatorHeader]]:
+    '''
+    Function which returns the key of the cached response for the key and the response, or the key and None if there is none
+    Responses found on the disk tier are promoted back to memory.
+    A response with steps also holds the result, so if a request without steps misses, the cached response with steps
+    is returned under its own key (for_client derives a result-only response from it). It's looked up like any hit,
+    so it's marked as used and counted as requested (see caching.TinyLFU), but only if it's cached.
+    '''
+    response = cache.get(key)
+    if response is None:
+        response = negative_cache.get(key)
+    if response is None and l2_cache is not None:
+        response = l2_cache.get(key)
+        if response is not None:
+            put(key, response)
+    data, show_steps = key
+    if response is None and not show_steps and is_cached((data, True)):
+        with_steps_key, with_steps = lookup((data, True))
+        if with_steps is not None:  # unless it was evicted in the meantime
+            return with_steps_key, with_steps
+    return key, response
+
+
+def is_cached(key: tuple[bytes, bool]) -> bool:
+    '''
+    Function which checks whether a response for the key is cached in any tier, fresh or not, without counting it as requested
+    A request without steps is also answered by a cached response with steps (see lookup).
+    '''
+    data, show_steps = key
+    keys = [key] if show_steps else [key, (data, True)]
+    return any(cache.peek(k) is not None or negative_cache.peek(k) is not None or (l2_cache is not None and k in l2_cache)
+               for k in keys)
+
+
+def put(key: tuple[bytes, bool], response: api.CalculatorHeader) -> bool:
+    '''
+    Function which caches the response in memory, client errors go to the negative cache (see negative)
+    Returns whether the response was cached
+    '''
+    if response.status_code == api.CalculatorHeader.STATUS_CLIENT_ERROR:
+        return NEGATIVE_CACHE_TTL > 0 and negative_cache.put(key, negative(response))
+    return cache.put(key, response)
+
+
+def negative(response: api.CalculatorHeader) -> api.CalculatorHeader:
+    '''
+    Function which caps the max-age of a client error response at NEGATIVE_CACHE_TTL
+    '''
+    if response.cache_control != INDEFINITE and response.cache_control <= NEGATIVE_CACHE_TTL:
+        return response
+    return response.copy(cache_control=NEGATIVE_CACHE_TTL)
+
+
+def without_steps(response: api.CalculatorHeader) -> api.CalculatorHeader:
+    '''
+    Function which derives a result-only response from a response with steps, keeping its time stamp and max-age
+    Errors never have steps, so they are returned as is.
+    '''
+    if response.status_code != api.CalculatorHeader.STATUS_OK:
+        return response.copy(show_steps=False)
+    result, _ = api.data_to_result(response)
+    return api.CalculatorHeader.from_result(result, [], response.cache_result, response.cache_control).copy(
+        unix_time_stamp=response.unix_time_stamp)
 
-        response = server_socket.recv(api.BUFFER_SIZE)
 
+def evicted(key: tuple[bytes, bool], response: api.CalculatorHeader) -> None:
+    '''
+    Function which is called for every response evicted from the memory tier, and demotes it to the disk tier
+    '''
+    hits.pop(key, None)
+    evictions.inc(labels=('memory',))
+    if l2_cache is not None:
+        l2_cache.put(key, response)
+
+
+def negative_evicted(key: tuple[bytes, bool], response: api.CalculatorHeader) -> None:
+    hits.pop(key, None)
+    evictions.inc(labels=('negative',))
+
+
+cache.on_evict = evicted
+negative_cache.on_evict = negative_evicted
+
+
+def persist_cache() -> None:
+    '''
+    Function which writes the memory tier to the disk tier, so a restarted proxy starts warm
+    '''
+    if l2_cache is not None:
+        print(f"Writing {len(cache)} cached responses to {l2_cache.path}")
+        l2_cache.put_many(list(cache.items()))
+        l2_cache.close()
+
+
+def fetch(request: api.CalculatorHeader, server_address: ServerAddress,
+          stale_response: typing.Optional[api.CalculatorHeader] = None) -> api.CalculatorHeader:
+    '''
+    Function which sends the request to the server and returns its response
+    If a stale response is given it's revalidated, and returned with a new time stamp and max-age if the server says it wasn't modified
+    With UPSTREAM_UDP the request is sent in a datagram if it fits, and over TCP if it or its response doesn't.
+    Servers on the same host may be reached over a Unix domain socket instead of TCP (see upstream.Address).
+    With several servers, the request goes to the server picked by the pool's policy. If the connection is refused
+    the next server is tried, and if the connection broke after the request was sent the next server is only tried
+    for idempotent (deterministic) requests.
+    '''
+    # We always accept compressed responses from the server, so the cache stores the compressed data
+    # Requests from sibling proxies become plain requests, the server only evaluates expressions
+    upstream_request = request.copy(reserved=request.reserved | api.CalculatorHeader.RESERVED_COMPRESSED,
+                                    status_code=api.CalculatorHeader.METHOD_EVALUATE)
+    if stale_response is not None:
+        # Revalidate the stale response, the server only sends the full response if it changed
+        upstream_request = upstream_request.make_conditional(api.response_validator(stale_response))
+
+    pool = upstream.pool_for(server_address)
+    response = b''
+    for candidate in pool.candidates(request.data):
+        sent = False
+        label = (address_label(candidate.address),)
+        started = time.perf_counter()
         try:
-            response = api.CalculatorHeader.unpack(response)
-        except Exception as e:
-            raise api.CalculatorClientError(
-                f'Error while unpacking request: {e}') from e
+            with tracing.span('upstream', upstream=label[0]):
+                traced_request = tracing.traced(upstream_request, candidate.address)
+                packed = traced_request.pack()
+                if UPSTREAM_UDP and isinstance(candidate.address, tuple) and datagram.fits(packed):
+                    # An empty answer means the response doesn't fit in a datagram, it's asked for again over TCP
+                    with pool.track(candidate):
+                        sent = True
+                        response = datagram.channel_for(candidate.address).exchange(packed, upstream.UPSTREAM_TIMEOUT)
+                if not response:
+                    with pool.connect(candidate) as server_socket:
+                        server_socket.sendall(packed)
+                        sent = True
+                        response = api.receive_message(server_socket, bytearray())
+            if not response:
+                raise ConnectionResetError("Server closed the connection without a response")
+            upstream_seconds.observe(time.perf_counter() - started, label)
+            pool.report_success(candidate)
+            break
+        except OSError as e:
+            upstream_failures.inc(labels=label)
+            pool.report_failure(candidate)
+            if sent and not is_deterministic(request):
+                raise api.CalculatorServerError(f"Connection to server broke while handling the request: {e}") from e
+    else:
+        raise api.CalculatorServerError(
+            "Connection refused by server and the request was not in the cache/it was stale")
+
+    try:
+        response = api.CalculatorHeader.unpack(response)
+    except Exception as e:
+        raise api.CalculatorClientError(
+            f'Error while unpacking request: {e}') from e
+
+    if response.is_request:
+        raise TypeError("Received a request instead of a response")
+    tracing.negotiate(candidate.address, traced_request, response)
+
+    if response.status_code == api.CalculatorHeader.STATUS_NOT_MODIFIED:
+        if stale_response is None:
+            raise api.CalculatorServerError("Got a not modified response to an unconditional request")
+        # The stale response is still valid, refresh its time stamp and max-age
+        # A client error keeps its max-age, the 304 carries the server's max-age for results (see negative)
+        cache_control = stale_response.cache_control if stale_response.status_code == api.CalculatorHeader.STATUS_CLIENT_ERROR \
+            else response.cache_control
+        response = stale_response.copy(unix_time_stamp=response.unix_time_stamp, cache_result=response.cache_result,
+                                       cache_control=cache_control)
+    return response
+
+
+def is_deterministic(request: api.CalculatorHeader) -> bool:
+    '''
+    Function which checks whether sending the request again can't change its result (e.g. it doesn't call rand)
+    '''
+    try:
+        return api.is_deterministic(api.data_to_expression(request.split_conditional()[0]))
+    except ValueError:
+        return False
+
+
+def store(key: tuple[bytes, bool], request: api.CalculatorHeader, response: api.CalculatorHeader) -> tuple[float, float, bool]:
+    '''
+    Function which caches the response if all sides agree to cache it and the admission policy lets it in
+    Server errors are never cached, and client errors are cached in the negative cache when the server allows it
+    (it only does for deterministic expressions, since the same request then always fails the same way).
+    Returns the time remaining before the server deems the response stale, the time remaining before the client deems the response stale, and whether we cached the response
+    '''
+    if response.status_code == api.CalculatorHeader.STATUS_CLIENT_ERROR:
+        response = negative(response)
+    server_time_remaining, client_time_remaining = api.time_remaining(request, response)
+    if response.status_code >= api.CalculatorHeader.STATUS_SERVER_ERROR:
+        return server_time_remaining, client_time_remaining, False
+    if request.cache_result and response.cache_result and (server_time_remaining > 0 and client_time_remaining > 0):
+        if put(key, response):
+            hits.pop(key, None)
+            data, show_steps = key
+            if show_steps:
+                # The response with steps replaces the one without, which can be derived from it (see lookup)
+                cache.pop((data, False), None)
+                negative_cache.pop((data, False), None)
+                hits.pop((data, False), None)
+            return server_time_remaining, client_time_remaining, True
+    return server_time_remaining, client_time_remaining, False
+
+
+def refresh_in_background(key: tuple[bytes, bool], request: api.CalculatorHeader, server_address: ServerAddress) -> None:
+    '''
+    Function which refreshes a cached response in a background thread, unless it's already being refreshed
+    '''
+    with refreshing_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+    # The refresh is on behalf of the proxy, so it accepts any age and always asks to cache the response
+    refresh_request = request.copy(cache_result=True, cache_control=INDEFINITE)
+    threading.Thread(target=refresh, args=(key, refresh_request, server_address), daemon=True).start()
+
+
+def refresh(key: tuple[bytes, bool], request: api.CalculatorHeader, server_address: ServerAddress) -> None:
+    '''
+    Function which revalidates a cached response with the server and caches the result
+    '''
+    try:
+        response = fetch(request, server_address, cache.peek(key))
+        store(key, request, response)
+    except Exception as e:
+        log.warning("Background refresh failed", error=e)
+    finally:
+        with refreshing_lock:
+            refreshing.discard(key)
+
+
+def preload(request: api.CalculatorHeader, server_address: ServerAddress) -> bool:
+    '''
+    Function which fetches and caches the response to a request on behalf of the proxy (when warming the cache),
+    unless it's cached already. Returns whether the response was cached.
+    '''
+    key = (request.data, request.show_steps)
+    if is_cached(key):
+        return False
+    request = request.copy(cache_result=True, cache_control=INDEFINITE)
+    _, _, cached = store(key, request, fetch(request, server_address))
+    return cached
+
+
+def warm_cache(path: str, top: int, server_address: ServerAddress) -> None:
+    '''
+    Function which caches the responses of the `top` most requested keys of a trace (see prefetch.popular),
+    at most prefetch.WARM_RATE per second
+    '''
+    started = time.perf_counter()
+    requests = prefetch.popular(path, top)
+    cached = prefetch.warm(requests, lambda request: preload(request, server_address), prefetch.WARM_RATE)
+    print(f"Warmed the cache with {cached} of the {len(requests)} most requested responses of {path} "
+          f"in {time.perf_counter() - started:.1f} s")
+
+
+def prefetch_in_background(keys: list[tuple[bytes, bool]], server_address: ServerAddress) -> None:
+    '''
+    Function which fetches the responses predicted to be requested next in background threads,
+    unless they are cached or being fetched already. Only deterministic expressions are predicted (see prefetchable).
+    '''
+    for key in keys:
+        if is_cached(key):
+            continue
+        data, show_steps = key
+        refresh_in_background(key, api.CalculatorHeader.from_request(data, show_steps, True, INDEFINITE, True), server_address)
+
 
-        if response.is_request:
-            raise TypeError("Received a request instead of a response")
+def prefetchable(key: tuple[bytes, bool]) -> bool:
+    '''
+    Function which checks whether the response of a key may be prefetched, only deterministic expressions are
+    '''
+    data, show_steps = key
+    return is_deterministic(api.CalculatorHeader.from_request(data, show_steps, False, 0))
 
-        current_time = int(time.time())
-        age = current_time - response.unix_time_stamp
-        res_cc = response.cache_control if response.cache_control != INDEFINITE else math.inf
-        req_cc = request.cache_control if request.cache_control != INDEFINITE else math.inf
-        server_time_remaining = res_cc - age
-        client_time_remaining = req_cc - age
-        # Cache the response if all sides agree to cache it
-        if request.cache_result and response.cache_result and (server_time_remaining > 0 and client_time_remaining > 0):
-            cache[(data, request.show_steps)] = response
-            cached = True
 
-    return response, server_time_remaining, client_time_remaining, False, was_stale, cached
+def for_client(response: api.CalculatorHeader, request: api.CalculatorHeader) -> api.CalculatorHeader:
+    '''
+    Function which decompresses the response if the client didn't say it accepts compressed responses (e.g. old clients)
+    A cached response with steps is turned into a result-only response if the client didn't ask for steps (see lookup).
+    '''
+    if response.show_steps and not request.show_steps:
+        response = without_steps(response)
+    if response.compressed and not request.compressed:
+        return response.decompress()
+    return response
 
 
-def proxy(proxy_address: tuple[str, int], server_adress: tuple[str, int]) -> None:
+def proxy(proxy_address: tuple[str, int], server_adress: ServerAddress) -> None:
     # socket(socket.AF_INET, socket.SOCK_STREAM)
     # (1) AF_INET is the address family for IPv4 (Address Family)
     # (2) SOCK_STREAM is the socket type for TCP (Socket Type) - [SOCK_DGRAM is the socket type for UDP]
     # Note: context manager ('with' keyword) closes the socket when the block is exited
+    global pool, upstreams
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as proxy_socket:
         # SO_REUSEADDR is a socket option that allows the socket to be bound to an address that is already in use.
         proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -100,8 +471,14 @@ def proxy(proxy_address: tuple[str, int], server_adress: tuple[str, int]) -> Non
         """
         # * Fill in end (1)
 
-        threads = []
-        print(f"Listening on {proxy_address[0]}:{proxy_address[1]}")
+        pool = workers.WorkerPool(client_handler, (server_adress,), MAX_WORKERS, QUEUE_DEPTH, SHED_AFTER)
+        datagrams = datagram.DatagramServer(proxy_address, handle_request, (server_adress,), MAX_WORKERS, QUEUE_DEPTH,
+                                            SHED_AFTER) if UDP else None
+        upstreams = upstream.pool_for(server_adress)
+        if METRICS_PORT is not None:
+            metrics.serve((proxy_address[0], METRICS_PORT))
+            print(f"Serving metrics on {proxy_address[0]}:{METRICS_PORT}/metrics")
+        print(f"Listening on {proxy_address[0]}:{proxy_address[1]}" + (" (TCP and UDP)" if UDP else ""))
 
         while True:
             try:
@@ -115,11 +492,9 @@ def proxy(proxy_address: tuple[str, int], server_adress: tuple[str, int]) -> Non
                 """
                 # * Fill in end (2)
 
-                # Create a new thread to handle the client request
-                thread = threading.Thread(target=client_handler, args=(
-                    client_socket, client_address, server_adress))
-                thread.start()
-                threads.append(thread)
+                # Hand the connection to a worker, or answer 503 if we are overloaded
+                if not pool.submit(client_socket, client_address):
+                    log.warning("Overloaded, rejected connection", client=address_label(client_address))
             except KeyboardInterrupt:
                 print("Shutting down...")
                 break
@@ -133,17 +508,20 @@ def proxy(proxy_address: tuple[str, int], server_adress: tuple[str, int]) -> Non
                 pass
             # end of added lines
 
-        for thread in threads:  # Wait for all threads to finish
-            thread.join()
+        pool.shutdown()  # Wait for all workers to finish
+        if datagrams is not None:
+            datagrams.close()
+
+    persist_cache()
 
     if flag_quit:  # after all threads where closed (finished handling the client) checking if a QUIT request was received
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        for server_address in upstream.pool_for(server_adress).addresses:
+            try:
                 print(f"{proxy_address[0]}:{proxy_address[1]} requesting to terminate server.py")
-                server_socket.connect((server_host, server_port))
-                server_socket.sendall("QUIT".encode("utf-8"))
-        except Exception as e:
-            print(f"\nError while closing server: {e}")
+                with upstream.create_connection(server_address) as server_socket:
+                    server_socket.sendall("QUIT".encode("utf-8"))
+            except Exception as e:
+                print(f"\nError while closing server: {e}")
         print(f"{proxy_address[0]}:{proxy_address[1]} terminating proxy...")
         try:
             proxy_socket.close()  # Close the proxi socket
@@ -152,23 +530,95 @@ def proxy(proxy_address: tuple[str, int], server_adress: tuple[str, int]) -> Non
             print(f"\nError while closing proxy socket: {e}")
 
 
+def handle_request(data: bytes, client: str, send: typing.Callable[[bytes], typing.Any], server_address: ServerAddress) -> None:
+    '''
+    Function which handles a request received from the client and sends the response with `send`
+    (over the client's connection, or in a datagram, see datagram.py)
+    '''
+    try:
+        # Process the request
+        received_at = time.time()
+        started = time.perf_counter()
+        try:
+            request, context = api.CalculatorHeader.unpack(data).split_traced()
+        except Exception as e:
+            raise api.CalculatorClientError(
+                f'Error while unpacking request: {e}') from e
+
+        log.debug("Got request", client=client, bytes=len(data))
+        received_bytes.inc(len(data))
+
+        # Our spans are children of the client's span if the request is traced
+        unpacked_at = time.time()
+        with tracing.request(context, start=received_at, header=request, client=client), admin.profiled():
+            tracing.record('unpack', received_at, unpacked_at)
+            response, server_time_remaining, client_time_remaining, cache_hit, was_stale, cached = process_request(
+                request, server_address)
+            # The response echoes the trace tag, which tells the client we understood the trace context
+            if response.trace_tag != request.trace_tag:
+                response = response.copy(trace_tag=request.trace_tag)
+            with tracing.span('pack'):
+                packed = response.pack()
+
+            # Send the response back to the client
+            # * Fill in start (4)
+            with tracing.span('send'):
+                send(packed)
+            """
+                see explanation about the accept method via server.py, line 199
+            """
+            # * Fill in end (4)
+
+        (cache_hits if cache_hit else cache_misses).inc()
+        if was_stale:
+            stale_responses.inc()
+        if cached:
+            cached_responses.inc()
+
+        if cache_hit and was_stale:
+            outcome = "Cache hit, stale response refreshing in the background"
+        elif cache_hit:
+            outcome = "Cache hit"
+        elif was_stale:
+            outcome = "Cache miss, stale response"
+        elif cached:
+            outcome = "Cache miss, response cached"
+        else:
+            outcome = "Cache miss, response not cached"
+
+        elapsed = time.perf_counter() - started
+        sent_bytes.inc(len(packed))
+        request_seconds.observe(elapsed)
+        log.info(outcome, client=client, server_time_remaining=f"{server_time_remaining:.2f}",
+                 client_time_remaining=f"{client_time_remaining:.2f}", bytes=len(packed), ms=f"{elapsed * 1000:.3f}")
+        capture.record(request, response, cache_hit, was_stale, cached, received_at, elapsed)
+        if predictor is not None and request.method == api.CalculatorHeader.METHOD_EVALUATE:
+            prefetch_in_background(predictor.observe(client, (request.data, request.show_steps)), server_address)
+
+    except Exception as e:
+        log.error("Unexpected proxy error", client=client, error=e)
+        send(api.CalculatorHeader.from_error(api.CalculatorServerError(
+            "Internal proxy error", e), api.CalculatorHeader.STATUS_SERVER_ERROR, False, 0).pack())
+
+
 def client_handler(client_socket: socket.socket, client_address: tuple[str, int],
-                   server_address: tuple[str, int]) -> None:
+                   server_address: ServerAddress) -> None:
     '''
     Function which handles client requests
     '''
     global flag_quit
-    client_prefix = f"{{{client_address[0]}:{client_address[1]}}}"
+    client = address_label(client_address)
     with client_socket:  # closes the socket when the block is exited
-        print(f"{client_prefix} Connected established")
+        log.debug("Connection established", client=client)
+        buffer = bytearray()  # bytes received after the last request, clients may send several requests without waiting
         while True:
             # Receive data from the client
             # * Fill in start (3) #
-            data = client_socket.recv(BUFFSIZE)
+            data = api.receive_message(client_socket, buffer)
             """
                 see explanation about the recv method via server.py, line 120
-                here we used the same buffer size as used in the server code, since both the proxy socket and the server socket are
-                handling the same data size. 
+                the requests are split by the total length in their header (see api.receive_message), so requests
+                sent back to back (pipelined) or split across several reads are each handled whole.
             """
             # checking if QUIT message was received.
             if len(data) == 4:  # implemented in this scope since request is never shorter than 12 bytes,
@@ -178,59 +628,19 @@ def client_handler(client_socket: socket.socket, client_address: tuple[str, int]
                     if "QUIT" in is_quiting:
                         #  when QUIT is received, break out of the loop to close the connection, send quit req to server
                         flag_quit = True
-                        print(f"{client_prefix} Received QUIT, closing connection")  # $ Added line $
+                        log.info("Received QUIT, closing connection", client=client)  # $ Added line $
                         break
                 except Exception as e:
-                    print(e)
+                    log.error("Invalid message", client=client, error=e)
             # * Fill in end (3)
 
             if not data:  # * Change in start (1)
                 break
                 # * Change in end (1)
-            try:
-                # Process the request
-                try:
-                    request = api.CalculatorHeader.unpack(data)
-                except Exception as e:
-                    raise api.CalculatorClientError(
-                        f'Error while unpacking request: {e}') from e
-
-                print(f"{client_prefix} Got request of length {len(data)} bytes")
-
-                response, server_time_remaining, client_time_remaining, cache_hit, was_stale, cached = process_request(
-                    request, server_address)
-
-                if cache_hit:
-                    print(f"{client_prefix} Cache hit", end=" ,")
-                elif was_stale:
-                    print(f"{client_prefix} Cache miss, stale response", end=" ,")
-                elif cached:
-                    print(f"{client_prefix} Cache miss, response cached", end=" ,")
-                else:
-                    print(
-                        f"{client_prefix} Cache miss, response not cached", end=" ,")
-                print(
-                    f"server time remaining: {server_time_remaining:.2f}, client time remaining: {client_time_remaining:.2f}")
-
-                response = response.pack()
-                print(
-                    f"{client_prefix} Sending response of length {len(response)} bytes")
-
-                # Send the response back to the client
-                # * Fill in start (4)
-                client_socket.sendall(response)
-                """
-                    see explanation about the accept method via server.py, line 199
-                """
-                # * Fill in end (4)
-
-            except Exception as e:
-                print(f"Unexpected server error: {e}")
-                client_socket.sendall(api.CalculatorHeader.from_error(api.CalculatorServerError(
-                    "Internal proxy error", e), api.CalculatorHeader.STATUS_SERVER_ERROR, False, 0).pack())
+            handle_request(data, client, client_socket.sendall, server_address)
 
     # * Change in start (2)
-    print(f"{client_prefix} Connection closed")
+    log.debug("Connection closed", client=client)
     # * Change in end (2)
 
 
@@ -246,12 +656,136 @@ if __name__ == '__main__':
                             default=api.DEFAULT_SERVER_PORT, help='The port that the server listens on.')
     arg_parser.add_argument('-sh', '--server_host', type=str, dest='server_host',
                             default=api.DEFAULT_SERVER_HOST, help='The host that the server listens on.')
+    arg_parser.add_argument('-swr', '--stale_while_revalidate', type=int, dest='stale_while_revalidate',
+                            default=STALE_WHILE_REVALIDATE, help='Serve responses stale by at most this many seconds while refreshing them in the background (0 = disabled).')
+    arg_parser.add_argument('-ra', '--refresh_ahead', type=int, dest='refresh_ahead',
+                            default=REFRESH_AHEAD, help='Refresh popular entries this many seconds before they go stale (0 = disabled).')
+    arg_parser.add_argument('-phits', '--popular_hits', type=int, dest='popular_hits',
+                            default=POPULAR_HITS, help='The number of hits after which an entry is refreshed ahead of time.')
+
+    arg_parser.add_argument('-cs', '--cache_size', type=int, dest='cache_size',
+                            default=CACHE_SIZE, help='The maximum number of cached responses (0 = unbounded).')
+    arg_parser.add_argument('--no_admission', action='store_false', dest='admission',
+                            default=ADMISSION, help='Cache every cacheable response, even if it is less popular than the one it evicts.')
+
+    arg_parser.add_argument('-dc', '--disk_cache', type=str, dest='disk_cache',
+                            default=None, help='A sqlite file for a second cache tier that survives restarts (default: none).')
+    arg_parser.add_argument('-dcs', '--disk_cache_size', type=int, dest='disk_cache_size',
+                            default=0, help='The maximum number of responses in the disk cache (0 = unbounded).')
+
+    arg_parser.add_argument('--server_uds', type=str, dest='server_uds',
+                            default=None, help='Reach the server over this Unix domain socket (started with --uds) instead of TCP (overrides --server_host/--server_port).')
+    arg_parser.add_argument('-u', '--upstream', type=upstream.parse_address, action='append', dest='upstreams',
+                            default=None, help='A server (host:port, or unix:/path for a Unix domain socket) to balance requests between, repeat for several servers (overrides --server_host/--server_port).')
+    arg_parser.add_argument('--upstream_timeout', type=float, dest='upstream_timeout',
+                            default=upstream.UPSTREAM_TIMEOUT, help='Seconds to wait for a server to connect and to send each part of its response (or to answer a datagram) before trying the next server.')
+    arg_parser.add_argument('-b', '--balance', type=str, dest='balance', choices=upstream.UpstreamPool.POLICIES,
+                            default='hash', help='How to pick a server: consistent hashing on the request or least outstanding requests.')
+
+    arg_parser.add_argument('--udp', action='store_true', dest='udp',
+                            default=UDP, help='Also serve requests sent as UDP datagrams on the proxy port (see datagram.py).')
+    arg_parser.add_argument('--upstream_udp', action='store_true', dest='upstream_udp',
+                            default=UPSTREAM_UDP, help='Send requests to the servers as UDP datagrams when they fit, the servers must be started with --udp.')
+
+    arg_parser.add_argument('--peer', type=upstream.parse_address, action='append', dest='peers',
+                            default=None, help='A sibling proxy (host:port) to share cached responses with, repeat for several siblings.')
+    arg_parser.add_argument('--peer_mode', type=str, dest='peer_mode', choices=peers.PeerGroup.MODES,
+                            default='ring', help='Forward misses to the sibling owning the key (ring) or ask siblings whose cache digest has it (digest).')
+    arg_parser.add_argument('--digest_interval', type=float, dest='digest_interval',
+                            default=peers.DIGEST_INTERVAL, help='Seconds between two fetches of the siblings\' cache digests.')
+
+    arg_parser.add_argument('-ncs', '--negative_cache_size', type=int, dest='negative_cache_size',
+                            default=NEGATIVE_CACHE_SIZE, help='The maximum number of cached client errors (0 = unbounded).')
+    arg_parser.add_argument('-nct', '--negative_cache_ttl', type=int, dest='negative_cache_ttl',
+                            default=NEGATIVE_CACHE_TTL, help='The maximum number of seconds a client error is cached for (0 = never cached).')
+
+    arg_parser.add_argument('-w', '--max_workers', type=int, dest='max_workers',
+                            default=MAX_WORKERS, help='The maximum number of client connections handled at once.')
+    arg_parser.add_argument('-q', '--queue_depth', type=int, dest='queue_depth',
+                            default=QUEUE_DEPTH, help='The maximum number of connections waiting for a worker, more are answered with 503.')
+    arg_parser.add_argument('--shed_after', type=float, dest='shed_after',
+                            default=SHED_AFTER, help='Answer 503 to connections that waited this many seconds for a worker (0 = never).')
+
+    arg_parser.add_argument('-mp', '--metrics_port', type=int, dest='metrics_port',
+                            default=METRICS_PORT, help='Serve metrics in the Prometheus text format on this port of the proxy host (default: disabled).')
+
+    arg_parser.add_argument('--log_level', type=str, dest='log_level', choices=logs.LEVELS,
+                            default='info', help='The minimal level of the logged records (debug logs every connection and request).')
+    arg_parser.add_argument('--log_format', type=str, dest='log_format', choices=logs.FORMATS,
+                            default='text', help='Log lines of text or JSON objects (one per line).')
+    arg_parser.add_argument('--log_sample', type=logs.parse_sample, action='append', dest='log_sample',
+                            default=None, help='Only log this fraction of the records of a level (level=rate, e.g. info=0.01), repeat for several levels.')
+
+    arg_parser.add_argument('--admin', action='store_true', dest='admin',
+                            default=False, help='Accept admin requests (profiling and the slow log, see admin.py).')
+    arg_parser.add_argument('--slow_log', type=float, dest='slow_log',
+                            default=0, help='Log the requests that took at least this many seconds, with the time spent in each step (0 = disabled).')
+    arg_parser.add_argument('--slow_log_file', type=str, dest='slow_log_file',
+                            default=None, help='The file of the slow log (default: in the working directory).')
+    arg_parser.add_argument('--trace_file', type=str, dest='trace_file',
+                            default=None, help='Append the spans of traced requests to this file (see tracing.py, default: not recorded).')
+    arg_parser.add_argument('--capture', type=str, dest='capture',
+                            default=None, help='Append every handled request and its outcome to this trace file, for benchmarks/replay.py (default: not recorded).')
+
+    arg_parser.add_argument('--warm_trace', type=str, dest='warm_trace',
+                            default=None, help='Cache the most requested responses of this trace (recorded with --capture) before accepting connections (default: start cold).')
+    arg_parser.add_argument('--warm_top', type=int, dest='warm_top',
+                            default=prefetch.WARM_TOP, help='The number of most requested responses of the trace to cache.')
+    arg_parser.add_argument('--warm_rate', type=float, dest='warm_rate',
+                            default=prefetch.WARM_RATE, help='The maximum number of requests per second sent to the servers while warming (0 = unlimited).')
+    arg_parser.add_argument('--warm_background', action='store_true', dest='warm_background',
+                            default=False, help='Warm the cache while accepting connections instead of before.')
+    arg_parser.add_argument('--prefetch', action='store_true', dest='prefetch',
+                            default=False, help='Learn which requests usually follow which on a client connection and fetch the likely next responses ahead of time.')
+    arg_parser.add_argument('--prefetch_confidence', type=float, dest='prefetch_confidence',
+                            default=prefetch.PREFETCH_CONFIDENCE, help='Prefetch a response once it followed the current request at least this fraction of the time.')
 
     args = arg_parser.parse_args()
 
+    logs.configure(args.log_level, args.log_format, dict(args.log_sample or []))
+    tracing.configure('proxy', args.trace_file)
+    capture.configure(args.capture)
+    admin.ENABLED = args.admin
+    admin.set_slow_log(args.slow_log, args.slow_log_file)
+
+    CACHE_SIZE = args.cache_size
+    ADMISSION = args.admission
+    cache.capacity = CACHE_SIZE
+    cache.admission = caching.TinyLFU(CACHE_SIZE) if ADMISSION and CACHE_SIZE > 0 else None
+    NEGATIVE_CACHE_SIZE = args.negative_cache_size
+    NEGATIVE_CACHE_TTL = args.negative_cache_ttl
+    negative_cache.capacity = NEGATIVE_CACHE_SIZE
+    if args.disk_cache is not None:
+        l2_cache = disk_cache.DiskCache(args.disk_cache, args.disk_cache_size)
+        print(f"Loaded {len(l2_cache)} cached responses from {args.disk_cache}")
+    if args.peers:
+        peer_group = peers.PeerGroup((args.proxy_host, args.proxy_port), args.peers, args.peer_mode, args.digest_interval)
+        peer_group.start()
+    MAX_WORKERS = args.max_workers
+    QUEUE_DEPTH = args.queue_depth
+    SHED_AFTER = args.shed_after
+    METRICS_PORT = args.metrics_port
+    UDP = args.udp
+    UPSTREAM_UDP = args.upstream_udp
+    STALE_WHILE_REVALIDATE = args.stale_while_revalidate
+    REFRESH_AHEAD = args.refresh_ahead
+    POPULAR_HITS = args.popular_hits
+
     proxy_host = args.proxy_host
     proxy_port = args.proxy_port
     server_host = args.server_host
     server_port = args.server_port
 
-    proxy((proxy_host, proxy_port), (server_host, server_port))
+    upstream.UPSTREAM_TIMEOUT = args.upstream_timeout
+    upstreams = upstream.UpstreamPool(args.upstreams or [args.server_uds or (server_host, server_port)], args.balance)
+
+    prefetch.WARM_RATE = args.warm_rate
+    if args.prefetch:
+        predictor = prefetch.Predictor(confidence=args.prefetch_confidence, prefetchable=prefetchable)
+    if args.warm_trace is not None:
+        if args.warm_background:
+            threading.Thread(target=warm_cache, args=(args.warm_trace, args.warm_top, upstreams), daemon=True).start()
+        else:
+            warm_cache(args.warm_trace, args.warm_top, upstreams)
+
+    proxy((proxy_host, proxy_port), upstreams)
@@ -1,14 +1,53 @@
 import numbers
+import os
+import stat
 import sys
 
 import api
 import argparse
 import socket
 import threading
+import time
+import typing
+
+import admin
+import datagram
+import logs
+import metrics
+import tracing
+import upstream
+import workers
 
 CACHE_POLICY = True  # whether to cache responses or not
 # the maximum time that the response can be cached for (in seconds)
 CACHE_CONTROL = 2 ** 16 - 1
+ERROR_CACHE_POLICY = True  # whether to cache client errors of deterministic expressions or not
+# the maximum time that a client error can be cached for (in seconds)
+ERROR_CACHE_CONTROL = 60
+
+# Connections handled at once, connections waiting for a worker, and seconds a connection may wait before it's shed
+MAX_WORKERS = 64
+QUEUE_DEPTH = 128
+SHED_AFTER = 1.0
+# The connections of a running server
+pool: typing.Optional[workers.WorkerPool] = None
+# Whether to also serve requests sent as UDP datagrams, on the same port (see datagram.py)
+UDP = False
+# Path of a Unix domain socket to also accept connections on, for a proxy on the same host (None = TCP only)
+UDS: typing.Optional[str] = None
+# Local port serving the metrics in the Prometheus text format (None = disabled)
+METRICS_PORT: typing.Optional[int] = None
+# What the server records for the metrics port, the pool state is read when the metrics are scraped
+responses = metrics.counter('server_responses_total', 'Responses sent, by status code.', ('status',))
+evaluation_seconds = metrics.histogram('server_evaluation_seconds', 'Time spent evaluating expressions.')
+request_seconds = metrics.histogram('server_request_seconds', 'Time from receiving a request to sending its response.')
+received_bytes = metrics.counter('server_received_bytes_total', 'Bytes of requests received.')
+sent_bytes = metrics.counter('server_sent_bytes_total', 'Bytes of responses sent.')
+metrics.callback('server_connections', 'Connections being handled.', lambda: pool.busy if pool else 0)
+metrics.callback('server_queued_connections', 'Connections waiting for a worker.', lambda: pool.queued if pool else 0)
+metrics.callback('server_shed_total', 'Connections answered with 503 (overloaded).', lambda: pool.shed if pool else 0, 'counter')
+
+log = logs.get_logger('server')
 
 global flag_quit  # Made to make the termination of the program easier. Not required for this exercise.
 
@@ -65,23 +104,77 @@ def calculate(expression: api.Expr, steps: list[str] = []) -> tuple[numbers.Real
 def process_request(request: api.CalculatorHeader) -> api.CalculatorHeader:
     '''
     Function which processes a CalculatorRequest and builds a CalculatorResponse.
+    If the request is conditional and the response would have the same validator, a header-only 304 response is built instead.
+    Client errors are cached for a shorter time, and not at all if the expression isn't deterministic (it may succeed next time).
     '''
     result, steps = None, []
+    expr = None
+    validator = None
     try:
         if request.is_request:
+            if request.method == api.CalculatorHeader.METHOD_ADMIN:
+                return admin.handle(request)
+            if request.method != api.CalculatorHeader.METHOD_EVALUATE:
+                raise ValueError(f"Unsupported request method: {request.method}")
+            request, validator = request.split_conditional()
             expr = api.data_to_expression(request)
-            result, steps = calculate(expr, steps)
+            # The result of a deterministic expression can't change, so the cached response is still valid
+            if validator is not None and api.is_deterministic(expr):
+                return api.CalculatorHeader.from_not_modified(request.show_steps, CACHE_POLICY, CACHE_CONTROL)
+            started = time.perf_counter()
+            try:
+                with tracing.span('evaluate'):
+                    result, steps = calculate(expr, steps)
+            finally:
+                evaluation_seconds.observe(time.perf_counter() - started)
         else:
             raise TypeError("Received a response instead of a request")
     except Exception as e:
-        return api.CalculatorHeader.from_error(e, api.CalculatorHeader.STATUS_CLIENT_ERROR, CACHE_POLICY, CACHE_CONTROL)
-
-    if request.show_steps:
-        steps = [api.stringify(step, add_brackets=True) for step in steps]
+        # Data that isn't an expression always fails the same way
+        cacheable = ERROR_CACHE_POLICY and (expr is None or api.is_deterministic(expr))
+        response = api.CalculatorHeader.from_error(e, api.CalculatorHeader.STATUS_CLIENT_ERROR, cacheable,
+                                                   ERROR_CACHE_CONTROL if cacheable else 0)
     else:
-        steps = []
+        if request.show_steps:
+            with tracing.span('stringify', steps=len(steps)):
+                steps = [api.stringify(step, add_brackets=True) for step in steps]
+        else:
+            steps = []
+        response = api.CalculatorHeader.from_result(result, steps, CACHE_POLICY, CACHE_CONTROL)
+
+    if validator is not None and api.response_validator(response) == validator:
+        return api.CalculatorHeader.from_not_modified(request.show_steps, response.cache_result, response.cache_control)
+    # Only compress the response if the client told us it can decompress it
+    if request.compressed:
+        with tracing.span('compress'):
+            response = response.compress()
+    return response
+
+
+def unix_listener(path: str) -> socket.socket:
+    '''
+    Function which listens on a Unix domain socket, replacing the socket file left by a previous run
+    '''
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unix_socket.bind(path)
+    unix_socket.listen(QUEUE_DEPTH)
+    return unix_socket
+
 
-    return api.CalculatorHeader.from_result(result, steps, CACHE_POLICY, CACHE_CONTROL)
+def accept_unix(unix_socket: socket.socket, path: str) -> None:
+    '''
+    Function which hands the connections accepted on the Unix domain socket to the worker pool, until the socket is closed
+    Their clients have no address, they are logged by the socket's path.
+    '''
+    while True:
+        try:
+            client_socket, _ = unix_socket.accept()
+        except OSError:  # closed
+            return
+        if not pool.submit(client_socket, path):
+            log.warning("Overloaded, rejected connection", client=upstream.address_label(path))
 
 
 def server(host: str, port: int) -> None:
@@ -89,7 +182,7 @@ def server(host: str, port: int) -> None:
     # (1) AF_INET is the address family for IPv4 (Address Family)
     # (2) SOCK_STREAM is the socket type for TCP (Socket Type) - [SOCK_DGRAM is the socket type for UDP]
     # Note: context manager ('with' keyword) closes the socket when the block is exited
-    global flag_quit
+    global flag_quit, pool
     flag_quit = False  # used for terminating the program when gets a message to do so
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
         # SO_REUSEADDR is a socket option that allows the socket to be bound to an address that is already in use.
@@ -104,21 +197,29 @@ def server(host: str, port: int) -> None:
             bind method prepares the server socket to listen for connection
             on the specific port and address (ip address) and allow clients to connect to the socket.   
         """
-        server_socket.listen(1)
+        server_socket.listen(QUEUE_DEPTH)
         """
             explanation-
                 listen method tells the server to wait for incoming connections. 
                 the numeric param tells the socket the max number of client connections 
-                he'll handle simultaneously. in this exercise the server will be handling 
-                one client at max, so we set the param to 1.
+                waiting to be accepted. the worker pool bounds how many are handled at once,
+                so the backlog only needs to absorb short bursts, we use the pool's queue depth.
 
         """
         server_socket.settimeout(1)  # setting a timeout for to accept method. if quit was received,
         # timeout will make sure new thread will not open
         # * Fill in end (1)
 
-        threads = []
-        print(f"Listening on {host}:{port}")
+        pool = workers.WorkerPool(client_handler, (), MAX_WORKERS, QUEUE_DEPTH, SHED_AFTER)
+        datagrams = datagram.DatagramServer((host, port), handle_request, (), MAX_WORKERS, QUEUE_DEPTH, SHED_AFTER) if UDP else None
+        unix_socket = unix_listener(UDS) if UDS is not None else None
+        if unix_socket is not None:
+            threading.Thread(target=accept_unix, args=(unix_socket, UDS), daemon=True).start()
+            print(f"Listening on {upstream.address_label(UDS)}")
+        if METRICS_PORT is not None:
+            metrics.serve((host, METRICS_PORT))
+            print(f"Serving metrics on {host}:{METRICS_PORT}/metrics")
+        print(f"Listening on {host}:{port}" + (" (TCP and UDP)" if UDP else ""))
 
         while True:
             try:
@@ -146,11 +247,9 @@ def server(host: str, port: int) -> None:
 
                 """
                 # * Fill in end (2)
-                # Create a new thread to handle the client request
-                thread = threading.Thread(target=client_handler, args=(
-                    client_socket, address))
-                thread.start()
-                threads.append(thread)
+                # Hand the connection to a worker, or answer 503 if we are overloaded
+                if not pool.submit(client_socket, address):
+                    log.warning("Overloaded, rejected connection", client=f"{address[0]}:{address[1]}")
             except KeyboardInterrupt:
                 print("Shutting down...")
                 break
@@ -164,8 +263,12 @@ def server(host: str, port: int) -> None:
                 pass
             # end of added lines
 
-        for thread in threads:  # Wait for all threads to finish
-            thread.join()
+        if unix_socket is not None:
+            unix_socket.close()
+            os.unlink(UDS)
+        pool.shutdown()  # Wait for all workers to finish
+        if datagrams is not None:
+            datagrams.close()
         # added lines-for terminating the program
         try:
             print("closing socket...")
@@ -177,18 +280,76 @@ def server(host: str, port: int) -> None:
         # end of added lines
 
 
-def client_handler(client_socket: socket.socket, client_address: tuple[str, int]) -> None:
+def handle_request(data: bytes, client: str, send: typing.Callable[[bytes], typing.Any]) -> None:
+    '''
+    Function which handles a request received from the client and sends the response with `send`
+    (over the client's connection, or in a datagram, see datagram.py)
+    '''
+    try:
+
+        received_at = time.time()
+        started = time.perf_counter()
+        try:
+            request, context = api.CalculatorHeader.unpack(data).split_traced()
+        except Exception as e:
+            raise api.CalculatorClientError(
+                f'Error while unpacking request: {e}') from e
+
+        log.debug("Got request", client=client, bytes=len(data))
+        received_bytes.inc(len(data))
+
+        # Our spans are children of the proxy's span if the request is traced
+        unpacked_at = time.time()
+        with tracing.request(context, start=received_at, header=request, client=client), admin.profiled():
+            tracing.record('unpack', received_at, unpacked_at)
+            response = process_request(request)
+            responses.inc(labels=(str(response.status_code),))
+
+            status = response.status_code
+            # The response echoes the trace tag, which tells the proxy we understood the trace context
+            if request.trace_tag:
+                response = response.copy(trace_tag=request.trace_tag)
+            with tracing.span('pack'):
+                response = response.pack()
+
+            # * Fill in start (4)
+            with tracing.span('send'):
+                send(response)
+        elapsed = time.perf_counter() - started
+        sent_bytes.inc(len(response))
+        request_seconds.observe(elapsed)
+        log.info("Sent response", client=client, status=status, bytes=len(response), ms=f"{elapsed * 1000:.3f}")
+        """
+            explanation - 
+                there's two method we can choose from in order to send data to the client while using
+                TCP protocol:
+                    send()- sends data up to some buffer size. it may not send all the data in one
+                        call, so it will require us to handle the sending of the remaining data.
+                    sendall- ensure the sending of the all the data, by internally loops, and handling the
+                        buffer limitation automatically.
+                we chose to use sendall method in order to make sure all the data is send to the client.
+        """
+    # * Fill in end (4)
+    except Exception as e:
+        log.error("Unexpected server error", client=client, error=e)
+        responses.inc(labels=(str(api.CalculatorHeader.STATUS_SERVER_ERROR),))
+        # Server errors are never cached, the next attempt may succeed
+        send(api.CalculatorHeader.from_error(
+            e, api.CalculatorHeader.STATUS_SERVER_ERROR, False, 0).pack())
+
+
+def client_handler(client_socket: socket.socket, client_address: upstream.Address) -> None:
     '''
     Function which handles client requests
     '''
     global flag_quit
-    client_addr = f"{client_address[0]}:{client_address[1]}"
-    client_prefix = f"{{{client_addr}}}"
+    client_addr = upstream.address_label(client_address)
     with client_socket:  # closes the socket when the block is exited
-        print(f"Conection established with {client_addr}")
+        log.debug("Connection established", client=client_addr)
+        buffer = bytearray()  # bytes received after the last request, a proxy may send several requests without waiting
         while True:
             # * Fill in start (3)
-            data = client_socket.recv(BUFFSIZE)
+            data = api.receive_message(client_socket, buffer)
             """
                 explanation - 
                     after a connection id established (accept method returned the client socket and address successfully)
@@ -196,61 +357,30 @@ def client_handler(client_socket: socket.socket, client_address: tuple[str, int]
                     the recv method is waiting to receive data from the client. 
                     reads up to BUFFSIZE bytes of data from the client socket, if the client closed the connection- the recv
                     method will return an empty bytes object.
+                    the received bytes are split into requests by the total length in their header (see api.receive_message).
 
             """
             try:  # checking if QUIT message was received.
                 if len(data) == 4:  # implemented in this scope since request is never shorter than 12 bytes,
                     # a 4 bytes data cant be a request.
                     is_quiting = data.decode("utf-8")  # decoding bytes to string
-                    print(is_quiting)
+                    log.info("Received message", client=client_addr, message=is_quiting)
                     if "QUIT" in is_quiting:
                         flag_quit = True
                         client_socket.close()  # making sure client soket is closed
                     break
             except Exception as e:
-                print(e)
+                log.error("Invalid message", client=client_addr, error=e)
             # * Fill in end (3)
             if not data:  # * Change in start (1)
                 # exit loop when receiving no data (means that client closed the connection).
                 # no need to close client socket since the with method handles this automatically
                 break
                 # * Change in end (1)
-            try:
-
-                try:
-                    request = api.CalculatorHeader.unpack(data)
-                except Exception as e:
-                    raise api.CalculatorClientError(
-                        f'Error while unpacking request: {e}') from e
-
-                print(f"{client_prefix} Got request of length {len(data)} bytes")
-
-                response = process_request(request)
-
-                response = response.pack()
-                print(
-                    f"{client_prefix} Sending response of length {len(response)} bytes")
-
-                # * Fill in start (4)
-                client_socket.sendall(response)
-                """
-                    explanation - 
-                        there's two method we can choose from in order to send data to the client while using
-                        TCP protocol:
-                            send()- sends data up to some buffer size. it may not send all the data in one
-                                call, so it will require us to handle the sending of the remaining data.
-                            sendall- ensure the sending of the all the data, by internally loops, and handling the
-                                buffer limitation automatically.
-                        we chose to use sendall method in order to make sure all the data is send to the client.
-                """
-            # * Fill in end (4)
-            except Exception as e:
-                print(f"Unexpected server error: {e}")
-                client_socket.sendall(api.CalculatorHeader.from_error(
-                    e, api.CalculatorHeader.STATUS_SERVER_ERROR, CACHE_POLICY, CACHE_CONTROL).pack())
+            handle_request(data, client_addr, client_socket.sendall)
 
     # * Change in start (2)
-    print(f"{client_prefix} Connection closed")
+    log.debug("Connection closed", client=client_addr)
     client_socket.close()  # same as line 254
     return
     # * Change in end (2)
@@ -265,9 +395,51 @@ if __name__ == '__main__':
     arg_parser.add_argument('-H', '--host', type=str,
                             default=api.DEFAULT_SERVER_HOST, help='The host to listen on.')
 
+    arg_parser.add_argument('-w', '--max_workers', type=int, default=MAX_WORKERS,
+                            help='The maximum number of connections handled at once.')
+    arg_parser.add_argument('-q', '--queue_depth', type=int, default=QUEUE_DEPTH,
+                            help='The maximum number of connections waiting for a worker, more are answered with 503.')
+    arg_parser.add_argument('--shed_after', type=float, default=SHED_AFTER,
+                            help='Answer 503 to connections that waited this many seconds for a worker (0 = never).')
+
+    arg_parser.add_argument('--udp', action='store_true',
+                            help='Also serve requests sent as UDP datagrams on the same port (see datagram.py).')
+    arg_parser.add_argument('--uds', type=str, default=UDS,
+                            help='Also accept connections on this Unix domain socket (e.g. /run/calc.sock), for a proxy on the same host (see --server_uds of proxy.py).')
+
+    arg_parser.add_argument('-mp', '--metrics_port', type=int, default=METRICS_PORT,
+                            help='Serve metrics in the Prometheus text format on this port of the server host (default: disabled).')
+
+    arg_parser.add_argument('--log_level', type=str, choices=logs.LEVELS, default='info',
+                            help='The minimal level of the logged records (debug logs every connection and request).')
+    arg_parser.add_argument('--log_format', type=str, choices=logs.FORMATS, default='text',
+                            help='Log lines of text or JSON objects (one per line).')
+    arg_parser.add_argument('--log_sample', type=logs.parse_sample, action='append', default=None,
+                            help='Only log this fraction of the records of a level (level=rate, e.g. info=0.01), repeat for several levels.')
+
+    arg_parser.add_argument('--admin', action='store_true',
+                            help='Accept admin requests (profiling and the slow log, see admin.py).')
+    arg_parser.add_argument('--slow_log', type=float, default=0,
+                            help='Log the requests that took at least this many seconds, with the time spent in each step (0 = disabled).')
+    arg_parser.add_argument('--slow_log_file', type=str, default=None,
+                            help='The file of the slow log (default: in the working directory).')
+    arg_parser.add_argument('--trace_file', type=str, default=None,
+                            help='Append the spans of traced requests to this file (see tracing.py, default: not recorded).')
+
     args = arg_parser.parse_args()
 
+    logs.configure(args.log_level, args.log_format, dict(args.log_sample or []))
+    tracing.configure('server', args.trace_file)
+    admin.ENABLED = args.admin
+    admin.set_slow_log(args.slow_log, args.slow_log_file)
+
     host = args.host
     port = args.port
+    MAX_WORKERS = args.max_workers
+    QUEUE_DEPTH = args.queue_depth
+    SHED_AFTER = args.shed_after
+    UDP = args.udp
+    UDS = args.uds
+    METRICS_PORT = args.metrics_port
 
     server(host, port)
@@ -0,0 +1,257 @@
+import argparse
+import atexit
+import json
+import random
+import threading
+import time
+import typing
+
+import api
+import logs
+
+# ========================================================================
+# ================================ Tracing ===============================
+# ========================================================================
+
+# region Tracing
+
+Context = tuple[int, int]  # trace ID and span ID
+
+# The component recording spans (e.g. 'proxy') and the writer of its trace file (None = spans aren't recorded)
+component = ''
+recorder: typing.Optional[logs.Writer] = None
+# Called with every finished root span and the spans finished under it (e.g. the slow log, see admin),
+# while it's set untraced requests get a local root span too, which isn't recorded or sent to peers
+on_request: typing.Optional[typing.Callable[['Span', list['Span']], None]] = None
+local = threading.local()
+# Peers that didn't echo the trace tag of a traced request, they get requests without a trace context
+unsupported: set[tuple[str, int]] = set()
+unsupported_lock = threading.Lock()
+
+
+def configure(name: str, path: typing.Optional[str]) -> None:
+    '''
+    Function which sets the component name and the file its spans are appended to (JSON lines, one span per line)
+    '''
+    global component, recorder
+    component = name
+    recorder = logs.Writer(open(path, 'a', encoding='utf-8'), 'json') if path is not None else None
+    if recorder is not None:
+        atexit.register(recorder.flush)
+
+
+def new_id() -> int:
+    return random.getrandbits(64) or 1
+
+
+def current() -> typing.Optional[Context]:
+    '''
+    Function which returns the context of the calling thread's innermost span, or None if its request isn't traced
+    '''
+    span = getattr(local, 'span', None)
+    return span.context if span is not None and span.traced else None
+
+
+class Span:
+    '''
+    A timed step of a request, the child of the span that was current when it started.
+    A root span (without a parent span) continues the sender's trace context, or starts a local trace if there is none.
+    Used as a context manager, it's the current span of the thread until it exits.
+    '''
+
+    def __init__(self, name: str, parent: typing.Optional['Span'], context: typing.Optional[Context] = None,
+                 start: typing.Optional[float] = None, header: typing.Optional[api.CalculatorHeader] = None,
+                 **fields: typing.Any) -> None:
+        self.name = name
+        if parent is not None:
+            self.trace_id, self.parent_id = parent.context
+            self.root = parent.root
+            self.traced = parent.traced
+        else:
+            self.trace_id, self.parent_id = context if context is not None else (new_id(), 0)
+            self.root = self
+            self.traced = context is not None
+        self.span_id = new_id()
+        self.start = time.time() if start is None else start
+        self.end: typing.Optional[float] = None
+        self.header = header  # the request of a root span
+        self.fields = fields
+        # The spans finished under a root span, if someone wants them
+        self.spans: typing.Optional[list[Span]] = [] if parent is None and on_request is not None else None
+        self.previous: typing.Optional[Span] = None
+
+    @property
+    def context(self) -> Context:
+        return self.trace_id, self.span_id
+
+    @property
+    def duration(self) -> float:
+        return (time.time() if self.end is None else self.end) - self.start
+
+    def __enter__(self) -> 'Span':
+        self.previous = getattr(local, 'span', None)
+        local.span = self
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        local.span = self.previous
+        self.finish()
+
+    def finish(self, end: typing.Optional[float] = None) -> None:
+        self.end = time.time() if end is None else end
+        if self.traced and recorder is not None:
+            recorder.append((self.start, 'info', component, self.name, {
+                'trace': f"{self.trace_id:016x}", 'span': f"{self.span_id:016x}", 'parent': f"{self.parent_id:016x}",
+                'start': self.start, 'duration': self.end - self.start, **self.fields}))
+        if self.root.spans is not None:
+            if self.root is not self:
+                self.root.spans.append(self)
+            elif on_request is not None:
+                on_request(self, self.spans)
+
+
+class NoSpan:
+    '''
+    Stands for a span of a request that isn't traced, so untraced requests only pay for a thread-local lookup
+    '''
+    context = None
+
+    def __enter__(self) -> 'NoSpan':
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        pass
+
+    def finish(self, end: typing.Optional[float] = None) -> None:
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def request(context: typing.Optional[Context], name: str = 'request', start: typing.Optional[float] = None,
+            header: typing.Optional[api.CalculatorHeader] = None, **fields: typing.Any) -> typing.Union[Span, NoSpan]:
+    '''
+    Function which starts the root span of a component for a request, as a child of the sender's span (see api.CalculatorHeader.split_traced)
+    '''
+    if context is None and on_request is None:
+        return NO_SPAN
+    return Span(name, None, context, start, header, **fields)
+
+
+def span(name: str, start: typing.Optional[float] = None, **fields: typing.Any) -> typing.Union[Span, NoSpan]:
+    '''
+    Function which starts a span as a child of the current span, if there is one
+    '''
+    parent = getattr(local, 'span', None)
+    if parent is None:
+        return NO_SPAN
+    return Span(name, parent, start=start, **fields)
+
+
+def record(name: str, start: float, end: float, **fields: typing.Any) -> None:
+    '''
+    Function which records a span that already ended (e.g. unpacking the request, before we knew it was traced)
+    '''
+    span(name, start, **fields).finish(end)
+
+
+def traced(request: api.CalculatorHeader, address: tuple[str, int], context: typing.Optional[Context] = None) -> api.CalculatorHeader:
+    '''
+    Function which adds the trace context (default: the current one) to a request sent to the address, if the request is traced and the peer supports it
+    '''
+    if context is None:
+        context = current()
+    if context is None:
+        return request
+    if address in unsupported:
+        return request.copy(trace_tag=context[0] & api.CalculatorHeader.MAX_TRACE_TAG or 1)
+    return request.make_traced(*context)
+
+
+def negotiate(address: tuple[str, int], request: api.CalculatorHeader, response: api.CalculatorHeader) -> None:
+    '''
+    Function which remembers that a peer doesn't support tracing if it didn't echo the trace tag of a traced request
+    Server errors (5xx) are ignored, they may be sent before the request was handled (e.g. a 503 when shedding load,
+    or an internal error) and then never echo the tag, even from peers that support tracing.
+    '''
+    if request.traced and response.status_code < api.CalculatorHeader.STATUS_SERVER_ERROR and \
+            response.trace_tag != request.trace_tag:
+        with unsupported_lock:
+            unsupported.add(address)
+
+# endregion
+
+# ========================================================================
+# ============================== Timelines ===============================
+# ========================================================================
+
+# region Timelines
+
+
+def load(paths: list[str]) -> dict[str, list[dict]]:
+    '''
+    Function which reads the spans of trace files, grouped by trace ID
+    '''
+    traces: dict[str, list[dict]] = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as trace_file:
+            for line in trace_file:
+                try:
+                    span = json.loads(line)
+                except json.JSONDecodeError:  # a line cut short when the process was killed
+                    continue
+                traces.setdefault(span['trace'], []).append(span)
+    return traces
+
+
+def timeline(spans: list[dict], width: int = 40) -> list[str]:
+    '''
+    Function which renders the spans of a trace as a tree, children under their parent in start order,
+    with their offset from the start of the trace, their duration and a bar
+    '''
+    begin = min(span['start'] for span in spans)
+    total = max(span['start'] + span['duration'] for span in spans) - begin or 1e-9
+    ids = {span['span'] for span in spans}
+    children: dict[typing.Optional[str], list[dict]] = {}
+    for span in spans:
+        # The root span of the trace has a parent that no process recorded
+        children.setdefault(span['parent'] if span['parent'] in ids else None, []).append(span)
+    lines = [f"trace {spans[0]['trace']}: {len(spans)} spans, {total * 1000:.3f} ms"]
+    stack = [(span, 0) for span in sorted(children.get(None, []), key=lambda span: span['start'], reverse=True)]
+    while stack:
+        span, depth = stack.pop()
+        offset = span['start'] - begin
+        left = int(offset / total * width)
+        length = max(1, int(span['duration'] / total * width))
+        bar = ' ' * left + '#' * min(length, width - left)
+        extra = ' '.join(f"{key}={value}" for key, value in span.items()
+                         if key not in ('time', 'level', 'logger', 'event', 'trace', 'span', 'parent', 'start', 'duration'))
+        name = f"{'  ' * depth}{span['logger']}:{span['event']}"
+        lines.append(f"{name:<32} {offset * 1000:9.3f} ms {span['duration'] * 1000:9.3f} ms |{bar:<{width}}| {extra}".rstrip())
+        stack.extend((child, depth + 1) for child in
+                     sorted(children.get(span['span'], []), key=lambda child: child['start'], reverse=True))
+    return lines
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Stitch the spans of the trace files of the client, proxy and server into one timeline per request.')
+    arg_parser.add_argument('paths', nargs='+', help='The trace files (see --trace_file of client.py, proxy.py and server.py).')
+    arg_parser.add_argument('-t', '--trace', type=str, default=None, help='Only show this trace ID (default: every trace).')
+    arg_parser.add_argument('-s', '--slowest', type=int, default=None, help='Only show the N slowest traces.')
+
+    args = arg_parser.parse_args()
+
+    traces = load(args.paths)
+    if args.trace is not None:
+        traces = {args.trace: traces.get(args.trace, [])} if args.trace in traces else {}
+    ordered = sorted(traces.values(), key=lambda spans: min(span['start'] for span in spans))
+    if args.slowest is not None:
+        ordered = sorted(ordered, key=lambda spans: max(span['start'] + span['duration'] for span in spans) -
+                         min(span['start'] for span in spans), reverse=True)[:args.slowest]
+    for spans in ordered:
+        print('\n'.join(timeline(spans)))
+        print()
+
+# endregion
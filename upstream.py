@@ -0,0 +1,204 @@
+import bisect
+import contextlib
+import hashlib
+import socket
+import threading
+import time
+import typing
+
+import logs
+
+# ========================================================================
+# ============================ Upstream Pool =============================
+# ========================================================================
+
+# region Upstream Pool
+
+# Number of points of every server on the hash ring, more points spread the keys more evenly
+VIRTUAL_NODES = 100
+# Consecutive failures after which a server is ejected, and for how many seconds
+EJECT_AFTER = 3
+EJECT_FOR = 10
+# Seconds to wait for a server to accept a connection, and then for each read of its response (or for the answer to
+# a datagram, see datagram.Channel), before failing over
+UPSTREAM_TIMEOUT = 30.0
+
+# A server address, (host, port) over TCP or the path of a Unix domain socket (for a server on the same host)
+Address = typing.Union[tuple[str, int], str]
+UNIX_PREFIX: typing.Final[str] = 'unix:'
+
+log = logs.get_logger('upstream')
+
+
+def parse_address(address: str) -> Address:
+    '''
+    Function which parses a 'host:port' string, or 'unix:/path/to/socket' for a Unix domain socket
+    '''
+    if address.startswith(UNIX_PREFIX):
+        path = address[len(UNIX_PREFIX):]
+        if not path:
+            raise ValueError(f"Invalid address '{address}' (expected unix:/path/to/socket)")
+        return path
+    host, _, port = address.rpartition(':')
+    if not host:
+        raise ValueError(f"Invalid address '{address}' (expected host:port or unix:/path/to/socket)")
+    return host, int(port)
+
+
+def address_label(address: Address) -> str:
+    return f"{UNIX_PREFIX}{address}" if isinstance(address, str) else f"{address[0]}:{address[1]}"
+
+
+def create_connection(address: Address, timeout: typing.Optional[float] = None) -> socket.socket:
+    '''
+    Function which connects to the address, over TCP or a Unix domain socket (same framing, without the loopback TCP stack)
+    '''
+    if not isinstance(address, str):
+        return socket.create_connection(address, timeout=timeout)
+    unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        unix_socket.settimeout(timeout)
+        unix_socket.connect(address)
+    except OSError:
+        unix_socket.close()
+        raise
+    return unix_socket
+
+
+class Upstream:
+    '''
+    A server the proxy sends requests to, with its passive health state
+    '''
+
+    def __init__(self, address: Address) -> None:
+        self.address = address
+        self.outstanding = 0  # requests sent and not answered yet
+        self.failures = 0  # consecutive failures
+        self.ejected_until = 0.0
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(address={self.address}, outstanding={self.outstanding}, failures={self.failures})'
+
+    @property
+    def healthy(self) -> bool:
+        # Once the ejection time passed the server is tried again, one more failure ejects it again
+        return time.monotonic() >= self.ejected_until
+
+
+class HashRing:
+    '''
+    Consistent hashing ring, a key is served by the first server clockwise from the key's hash.
+    Adding or removing a server only moves the keys of its neighbours, so the other servers keep their warm state.
+    '''
+
+    def __init__(self, upstreams: list[Upstream], virtual_nodes: int = VIRTUAL_NODES) -> None:
+        points = sorted(((self.hash(f"{address_label(upstream.address)}#{i}".encode()), upstream)
+                         for upstream in upstreams for i in range(virtual_nodes)), key=lambda point: point[0])
+        self.hashes = [point for point, _ in points]
+        self.upstreams = [upstream for _, upstream in points]
+        self.count = len(upstreams)
+
+    @staticmethod
+    def hash(data: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+    def preference(self, key: bytes) -> list[Upstream]:
+        '''
+        Returns every server in the order they should be tried for the key
+        '''
+        order: list[Upstream] = []
+        start = bisect.bisect(self.hashes, self.hash(key))
+        for i in range(len(self.upstreams)):
+            upstream = self.upstreams[(start + i) % len(self.upstreams)]
+            if upstream not in order:
+                order.append(upstream)
+                if len(order) == self.count:
+                    break
+        return order
+
+
+class UpstreamPool:
+    '''
+    The servers behind the proxy.
+    Requests are routed by consistent hashing on the cache key ('hash') or to the server with the fewest
+    outstanding requests ('least'). Servers that fail EJECT_AFTER times in a row are skipped for EJECT_FOR seconds.
+    '''
+    POLICIES: typing.Final[tuple[str, ...]] = ('hash', 'least')
+
+    def __init__(self, addresses: list[Address], policy: str = 'hash') -> None:
+        if not addresses:
+            raise ValueError('At least one upstream server is required')
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown balancing policy '{policy}' (must be one of {self.POLICIES})")
+        self.upstreams = [Upstream(address) for address in addresses]
+        self.policy = policy
+        self.ring = HashRing(self.upstreams)
+        self.lock = threading.Lock()
+
+    @property
+    def addresses(self) -> list[Address]:
+        return [upstream.address for upstream in self.upstreams]
+
+    def candidates(self, key: bytes) -> list[Upstream]:
+        '''
+        Returns the servers to try for the key in order, healthy servers first
+        '''
+        if self.policy == 'hash':
+            order = self.ring.preference(key)
+        else:
+            order = sorted(self.upstreams, key=lambda upstream: upstream.outstanding)
+        # Ejected servers are only tried when all the healthy ones failed
+        return [upstream for upstream in order if upstream.healthy] + [upstream for upstream in order if not upstream.healthy]
+
+    @contextlib.contextmanager
+    def track(self, upstream: Upstream) -> typing.Iterator[None]:
+        '''
+        Counts a request to the server as outstanding until the block exits
+        '''
+        with self.lock:
+            upstream.outstanding += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                upstream.outstanding -= 1
+
+    @contextlib.contextmanager
+    def connect(self, upstream: Upstream, timeout: typing.Optional[float] = None) -> typing.Iterator[socket.socket]:
+        '''
+        Connects to the server, counting the request as outstanding until the block exits
+        The connection and every read on it time out after `timeout` seconds (default: UPSTREAM_TIMEOUT),
+        so a hung server fails like a refused one instead of blocking the caller.
+        '''
+        timeout = UPSTREAM_TIMEOUT if timeout is None else timeout
+        with self.track(upstream), create_connection(upstream.address, timeout) as server_socket:
+            yield server_socket
+
+    def report_success(self, upstream: Upstream) -> None:
+        with self.lock:
+            upstream.failures = 0
+            upstream.ejected_until = 0.0
+
+    def report_failure(self, upstream: Upstream) -> None:
+        with self.lock:
+            upstream.failures += 1
+            if upstream.failures >= EJECT_AFTER:
+                upstream.ejected_until = time.monotonic() + EJECT_FOR
+                log.warning("Ejecting upstream", upstream=address_label(upstream.address), seconds=EJECT_FOR)
+
+
+# Pools of a single server, for callers that pass a plain address
+_single_pools: dict[Address, UpstreamPool] = {}
+
+
+def pool_for(server_address: typing.Union[Address, UpstreamPool]) -> UpstreamPool:
+    '''
+    Function which returns the pool for a pool or a single server address
+    '''
+    if isinstance(server_address, UpstreamPool):
+        return server_address
+    if server_address not in _single_pools:
+        _single_pools[server_address] = UpstreamPool([server_address])
+    return _single_pools[server_address]
+
+# endregion
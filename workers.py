@@ -0,0 +1,159 @@
+import queue
+import socket
+import threading
+import time
+import typing
+
+import api
+import logs
+
+# ========================================================================
+# ============================== Worker Pool =============================
+# ========================================================================
+
+# region Worker Pool
+
+# Seconds an idle worker waits for a connection before it exits
+IDLE_TIMEOUT = 30
+# Weight of the newest queueing delay in the moving average used for load shedding
+DELAY_SMOOTHING = 0.2
+
+log = logs.get_logger('workers')
+
+
+def overloaded_response() -> bytes:
+    '''
+    Function which returns the packed header-only 503 response sent to connections that are shed
+    '''
+    return api.CalculatorHeader.from_response(b'', api.CalculatorHeader.STATUS_OVERLOADED, False, False, 0).pack()
+
+
+def reject(client_socket: socket.socket) -> None:
+    '''
+    Function which tells the client we are overloaded and closes the connection, without waiting for it
+    '''
+    try:
+        client_socket.setblocking(False)
+        client_socket.sendall(overloaded_response())
+        client_socket.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+
+class WorkerPool:
+    '''
+    A bounded pool of threads handling accepted connections.
+    At most `max_workers` connections are handled at once and at most `queue_depth` wait for a worker,
+    further connections get an immediate 503 (overloaded) response.
+    Connections that waited more than `shed_after` seconds for a worker are answered with 503 instead of being handled,
+    and while the average wait is above it new connections are answered with 503 right away (0 = never shed).
+    Workers are started on demand and exit after IDLE_TIMEOUT idle seconds, so an idle process keeps no threads.
+    '''
+
+    def __init__(self, handler: typing.Callable[..., None], args: tuple = (), max_workers: int = 64,
+                 queue_depth: int = 128, shed_after: float = 1.0) -> None:
+        self.handler = handler
+        self.args = args
+        self.max_workers = max_workers
+        self.shed_after = shed_after
+        self.connections: queue.Queue[typing.Optional[tuple[socket.socket, tuple[str, int], float]]] = queue.Queue(queue_depth)
+        self.workers: list[threading.Thread] = []
+        self.idle = 0
+        self.waiting = 0  # queued connections no worker took yet, updated with idle so the two always cancel out
+        self.delay = 0.0  # moving average of the time connections wait for a worker
+        self.shed = 0  # number of connections answered with 503
+        self.lock = threading.Lock()
+
+    @property
+    def overloaded(self) -> bool:
+        # Once the queue drains the average no longer matters, it's only updated when connections are taken
+        return self.shed_after > 0 and self.delay > self.shed_after and not self.connections.empty()
+
+    @property
+    def busy(self) -> int:
+        # Number of connections being handled
+        return len(self.workers) - self.idle
+
+    @property
+    def queued(self) -> int:
+        # Number of connections waiting for a worker
+        return self.connections.qsize()
+
+    def submit(self, client_socket: socket.socket, client_address: tuple[str, int]) -> bool:
+        '''
+        Queues the connection for a worker, returns False if it was rejected instead
+        '''
+        with self.lock:
+            self.workers = [worker for worker in self.workers if worker.is_alive()]  # reap the exited workers
+            # Idle workers may not have taken the connections queued before this one yet
+            if self.idle <= self.waiting and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self.work, daemon=True)
+                self.workers.append(worker)
+                self.idle += 1
+                worker.start()
+        if self.overloaded:
+            self.reject(client_socket)
+            return False
+        with self.lock:
+            try:
+                self.connections.put_nowait((client_socket, client_address, time.monotonic()))
+                self.waiting += 1
+                return True
+            except queue.Full:
+                pass
+        self.reject(client_socket)
+        return False
+
+    def reject(self, client_socket: socket.socket) -> None:
+        with self.lock:
+            self.shed += 1
+        reject(client_socket)
+
+    def work(self) -> None:
+        while True:
+            try:
+                item = self.connections.get(timeout=IDLE_TIMEOUT)
+                timed_out = False
+            except queue.Empty:
+                item, timed_out = None, True
+            with self.lock:
+                if timed_out:
+                    # submit may have queued a connection for this worker after the wait timed out, while it still
+                    # counted as idle, so it's taken before exiting (submit queues holding the lock)
+                    try:
+                        item = self.connections.get_nowait()
+                    except queue.Empty:
+                        pass
+                self.idle -= 1
+                if item is not None:
+                    self.waiting -= 1
+            if item is None:  # idle for too long, or shutting down
+                return
+            client_socket, client_address, queued_at = item
+            delay = time.monotonic() - queued_at
+            self.delay = (1 - DELAY_SMOOTHING) * self.delay + DELAY_SMOOTHING * delay
+            try:
+                if self.shed_after > 0 and delay > self.shed_after:
+                    self.reject(client_socket)
+                else:
+                    self.handler(client_socket, client_address, *self.args)
+            except Exception as e:
+                log.error("Unexpected error in worker", error=e)
+            finally:
+                with self.lock:
+                    self.idle += 1
+
+    def shutdown(self) -> None:
+        '''
+        Lets the workers finish the queued connections, then waits for them to exit
+        '''
+        with self.lock:
+            workers = list(self.workers)
+        for _ in workers:
+            self.connections.put(None)
+        for worker in workers:
+            worker.join()
+
+# endregion